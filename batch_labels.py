@@ -0,0 +1,198 @@
+"""
+Render nutrition labels (PNG, SVG or PDF) for every saved formulation in a folder.
+
+    python batch_labels.py saves --out etiquetas --portion-size 30 --breakdown-fat --format pdf
+
+Formulations are parsed in a pool of worker processes, the union of their FDC IDs is
+fetched once into the shared on-disk food cache, and each worker draws its labels
+(with and without background) straight from label data with the GUI's label renderer.
+"""
+
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List
+
+from services import usda_api
+from services.formulation_io import find_formulation_files, hydrate_items, load_formulation_file
+from services.label_builder import HOUSEHOLD_MEASURE_OPTIONS, build_label_for_items, fraction_from_ratio
+from services.nutrition_label import ADDITIONAL_LABEL_NUTRIENTS, NO_SIGNIFICANT_THRESHOLDS, LabelSettings
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "epic_food_formulator" / "usda"
+DEFAULT_LABEL_WIDTH = 420
+DEFAULT_DPI = 300
+PREFETCH_THREADS = 4
+
+# Per worker process: the GUI application object that fonts and painting need.
+_app = None
+
+
+def _init_worker(cache_dir: str) -> None:
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    usda_api.set_disk_cache_dir(cache_dir)
+
+
+def _ensure_gui_app() -> None:
+    global _app
+    if _app is None:
+        from PySide6.QtGui import QGuiApplication
+
+        _app = QGuiApplication.instance() or QGuiApplication([])
+
+
+def _parse_job(path: str) -> tuple[str, list[Dict[str, Any]], str]:
+    try:
+        base_items, _ = load_formulation_file(path)
+    except Exception as exc:  # noqa: BLE001 - reported per file
+        return path, [], str(exc)
+    return path, base_items, ""
+
+
+def _render_job(
+    job: tuple[str, list[Dict[str, Any]], LabelSettings, str, int, str, int]
+) -> tuple[str, list[str], str]:
+    path, base_items, settings, out_dir, width, fmt, dpi = job
+    try:
+        items = hydrate_items(base_items)
+        label = build_label_for_items(items, settings)
+        _ensure_gui_app()
+        from ui.label_renderer import LabelRenderer, LabelStyle
+
+        # --width is given in screen pixels (96 dpi), the renderer works in points.
+        renderer = LabelRenderer(label, LabelStyle(width_pt=width * 72 / 96))
+        target_dir = Path(out_dir)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        outputs: list[str] = []
+        for with_background, suffix in ((True, "con_fondo"), (False, "sin_fondo")):
+            target = target_dir / f"{Path(path).stem}_{suffix}.{fmt}"
+            if not renderer.save(target, dpi=dpi, with_background=with_background):
+                return path, outputs, f"No se pudo guardar {target}"
+            outputs.append(str(target))
+    except Exception as exc:  # noqa: BLE001 - reported per file
+        return path, [], str(exc)
+    return path, outputs, ""
+
+
+def _prefetch_foods(fdc_ids: set[int], max_attempts: int = 4) -> dict[int, str]:
+    """Fetch missing food details into the disk cache; returns FDC ID -> error."""
+    missing = sorted(fdc for fdc in fdc_ids if not usda_api.has_cached_food(fdc, "abridged"))
+    errors: dict[int, str] = {}
+
+    def fetch(fdc_id: int) -> None:
+        try:
+            hydrate_items([{"fdc_id": fdc_id}], max_attempts=max_attempts)
+        except Exception as exc:  # noqa: BLE001 - the affected files report it again
+            errors[fdc_id] = str(exc)
+
+    if missing:
+        print(f"Descargando {len(missing)} alimentos de USDA...")
+        with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as pool:
+            list(pool.map(fetch, missing))
+    return errors
+
+
+def settings_from_args(args: argparse.Namespace) -> LabelSettings:
+    household_amount = args.household_amount.strip()
+    if not household_amount and args.portion_unit == "ml":
+        capacity = dict(HOUSEHOLD_MEASURE_OPTIONS).get(args.household_unit)
+        if capacity and args.portion_size > 0:
+            household_amount = fraction_from_ratio(args.portion_size / float(capacity))
+    return LabelSettings(
+        portion_size=float(args.portion_size),
+        portion_unit=args.portion_unit,
+        household_amount=household_amount,
+        household_unit=args.household_unit,
+        breakdown_fat=args.breakdown_fat,
+        breakdown_carb=args.breakdown_carb,
+        no_significant=tuple(args.no_significant or ()),
+        additional_selected=tuple(args.additional or ()),
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Genera etiquetas para un directorio de formulaciones.")
+    parser.add_argument("folder", type=Path, help="Carpeta con formulaciones (.json/.xlsx)")
+    parser.add_argument("--out", type=Path, default=Path("etiquetas"), help="Carpeta de salida")
+    parser.add_argument("--recursive", action="store_true", help="Incluir subcarpetas")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--cache-dir", type=Path, default=Path(os.getenv("USDA_CACHE_DIR") or DEFAULT_CACHE_DIR))
+    parser.add_argument("--width", type=int, default=DEFAULT_LABEL_WIDTH, help="Ancho de la tabla en px (a 96 dpi)")
+    parser.add_argument("--format", choices=("png", "svg", "pdf"), default="png", help="Formato de salida")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI, help="Resolución de PNG/PDF")
+    parser.add_argument("--portion-size", type=float, default=100.0)
+    parser.add_argument("--portion-unit", choices=("g", "ml"), default="g")
+    parser.add_argument("--household-amount", default="", help="Ej.: 1/2 (vacío: automático para ml)")
+    parser.add_argument("--household-unit", default="Unidad")
+    parser.add_argument("--breakdown-fat", action="store_true")
+    parser.add_argument("--breakdown-carb", action="store_true")
+    parser.add_argument(
+        "--additional",
+        action="append",
+        choices=[n["name"] for n in ADDITIONAL_LABEL_NUTRIENTS],
+        help="Nutriente adicional (repetible)",
+    )
+    parser.add_argument(
+        "--no-significant",
+        action="append",
+        choices=list(NO_SIGNIFICANT_THRESHOLDS),
+        help="Declarar como no significativo si corresponde (repetible)",
+    )
+    return parser
+
+
+def main(argv: List[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    files = find_formulation_files(args.folder, recursive=args.recursive)
+    if not files:
+        print(f"No se encontraron formulaciones en {args.folder}")
+        return 1
+
+    started = time.perf_counter()
+    settings = settings_from_args(args)
+    cache_dir = str(args.cache_dir)
+    usda_api.set_disk_cache_dir(cache_dir)
+    failures = 0
+    # Spawned workers: forking a process that may hold Qt/HTTP state is not safe.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=max(1, args.workers),
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(cache_dir,),
+    ) as pool:
+        parsed = list(pool.map(_parse_job, [str(p) for p in files]))
+        jobs = []
+        for path, base_items, error in parsed:
+            if error:
+                failures += 1
+                print(f"ERROR {path}: {error}")
+                continue
+            out_dir = args.out / Path(path).parent.relative_to(args.folder)
+            jobs.append((path, base_items, settings, str(out_dir), args.width, args.format, args.dpi))
+
+        # Re-imported exports carry their own nutrients; only the rest needs USDA data.
+        fdc_ids = {
+            int(item["fdc_id"]) for _, base_items, *_ in jobs for item in base_items if "details" not in item
+        }
+        _prefetch_foods(fdc_ids)
+
+        for path, outputs, error in pool.map(_render_job, jobs):
+            if error:
+                failures += 1
+                print(f"ERROR {path}: {error}")
+            else:
+                print(f"OK {path} -> {', '.join(outputs)}")
+
+    elapsed = time.perf_counter() - started
+    print(f"{len(files) - failures}/{len(files)} etiquetas generadas en {elapsed:.1f} s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
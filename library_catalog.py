@@ -0,0 +1,92 @@
+"""
+Index saved formulations in a local SQLite catalog and query it without opening files.
+
+    python library_catalog.py update saves
+    python library_catalog.py uses 173757
+    python library_catalog.py nutrient sodium --min 400 --unit mg
+    python library_catalog.py list lentejas
+
+``update`` only re-reads files whose modification time or size changed; foods are
+fetched once per scan through the shared on-disk USDA cache.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+from services import usda_api
+from services.formulation_catalog import CatalogEntry, FormulationCatalog
+
+DEFAULT_DATA_DIR = Path.home() / ".cache" / "epic_food_formulator"
+DEFAULT_DB = DEFAULT_DATA_DIR / "catalog.sqlite3"
+DEFAULT_CACHE_DIR = DEFAULT_DATA_DIR / "usda"
+
+
+def _print_entries(entries: list[CatalogEntry]) -> None:
+    for entry in entries:
+        amount = "" if entry.amount is None else f"{entry.amount:.2f} {entry.unit}".rstrip()
+        print(f"{amount:>16}  {entry.name}  ({entry.path})")
+    print(f"{len(entries)} formulaciones")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Catálogo local de formulaciones guardadas.")
+    parser.add_argument("--db", type=Path, default=Path(os.getenv("FORMULATION_CATALOG") or DEFAULT_DB))
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    update = commands.add_parser("update", help="Indexar formulaciones nuevas o modificadas")
+    update.add_argument("folder", type=Path, help="Carpeta con formulaciones (.json/.xlsx)")
+    update.add_argument("--no-recursive", action="store_true", help="No incluir subcarpetas")
+    update.add_argument(
+        "--cache-dir", type=Path, default=Path(os.getenv("USDA_CACHE_DIR") or DEFAULT_CACHE_DIR)
+    )
+
+    uses = commands.add_parser("uses", help="Formulaciones que usan un FDC ID")
+    uses.add_argument("fdc_id", type=int)
+
+    nutrient = commands.add_parser("nutrient", help="Filtrar por total de un nutriente (por 100 g)")
+    nutrient.add_argument("name", help="Inicio del nombre USDA, ej.: sodium")
+    nutrient.add_argument("--min", type=float, default=None)
+    nutrient.add_argument("--max", type=float, default=None)
+    nutrient.add_argument("--unit", default="", help="Ej.: kcal para Energy")
+
+    listing = commands.add_parser("list", help="Listar formulaciones indexadas")
+    listing.add_argument("name", nargs="?", default="", help="Parte del nombre")
+    return parser
+
+
+def main(argv: List[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    started = time.perf_counter()
+    with FormulationCatalog(args.db) as catalog:
+        if args.command == "update":
+            usda_api.set_disk_cache_dir(str(args.cache_dir))
+            result = catalog.update(args.folder, recursive=not args.no_recursive, progress=print)
+            for path, message in result.errors.items():
+                print(f"ERROR {path}: {message}")
+            print(
+                f"{len(result.added)} nuevas, {len(result.updated)} actualizadas, "
+                f"{len(result.removed)} eliminadas, {result.unchanged} sin cambios "
+                f"({len(catalog)} en el catálogo)"
+            )
+            status = 1 if result.errors else 0
+        elif args.command == "uses":
+            _print_entries(catalog.using_ingredient(args.fdc_id))
+            status = 0
+        elif args.command == "nutrient":
+            _print_entries(catalog.by_nutrient(args.name, args.min, args.max, args.unit))
+            status = 0
+        else:
+            _print_entries(catalog.formulations(args.name))
+            status = 0
+    print(f"{time.perf_counter() - started:.3f} s")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
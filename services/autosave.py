@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import json
+import logging
+import queue
+import threading
+from pathlib import Path
+from typing import Any, Dict, List
+
+from services.formulation_export import atomic_write
+
+SNAPSHOT_NAME = "snapshot.json"
+JOURNAL_NAME = "journal.jsonl"
+# Operations appended before the journal is folded into a new snapshot.
+COMPACT_EVERY = 200
+
+
+def portable_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Formulation item without process-local nutrient IDs, ready for JSON."""
+    return {
+        "fdc_id": item.get("fdc_id"),
+        "description": item.get("description", ""),
+        "brand": item.get("brand", ""),
+        "data_type": item.get("data_type", ""),
+        "amount_g": float(item.get("amount_g", 0.0) or 0.0),
+        "locked": bool(item.get("locked", False)),
+        "nutrients": portable_nutrients(item.get("nutrients", [])),
+    }
+
+
+def portable_nutrients(nutrients: List[Dict[str, Any]]) -> list[Dict[str, Any]]:
+    return [{k: v for k, v in entry.items() if k != "nid"} for entry in nutrients or []]
+
+
+def empty_state() -> Dict[str, Any]:
+    return {
+        "items": [],
+        "quantity_mode": "g",
+        "formula_name": "",
+        "nutrient_export_flags": {},
+        "label": {},
+        "overrides": {},
+    }
+
+
+def apply_operation(state: Dict[str, Any], op: Dict[str, Any]) -> None:
+    """Replay one journal operation onto a state dict (see empty_state); unknown ops are skipped."""
+    kind = op.get("op")
+    items: list[Dict[str, Any]] = state["items"]
+    index = op.get("index")
+    if index is not None and not 0 <= index < len(items) and kind != "add":
+        return
+    if kind == "add":
+        # "index" inserts (undo of a removal); plain adds append.
+        items.insert(len(items) if index is None else index, dict(op["item"]))
+    elif kind == "remove":
+        del items[index]
+    elif kind == "amount":
+        items[index]["amount_g"] = float(op["amount_g"])
+    elif kind == "amounts":
+        for item, amount in zip(items, op["amounts"]):
+            item["amount_g"] = float(amount)
+    elif kind == "lock":
+        items[index]["locked"] = bool(op["locked"])
+    elif kind == "nutrients":
+        items[index]["nutrients"] = op["nutrients"]
+    elif kind == "mode":
+        state["quantity_mode"] = op["mode"]
+    elif kind == "name":
+        state["formula_name"] = op["name"]
+    elif kind == "flags":
+        state["nutrient_export_flags"] = dict(op["flags"])
+    elif kind == "label":
+        state["label"] = dict(op["settings"])
+    elif kind == "override":
+        if op.get("value") is None:
+            state["overrides"].pop(op["name"], None)
+        else:
+            state["overrides"][op["name"]] = float(op["value"])
+
+
+def load_autosave(directory: str | Path) -> Dict[str, Any] | None:
+    """
+    Last autosaved state: the snapshot plus the journal operations written after it.
+
+    A torn last line (crash mid-append) ends the replay. Returns None when there is
+    nothing worth recovering.
+    """
+    directory = Path(directory)
+    state = empty_state()
+    seq = 0
+    try:
+        snapshot = json.loads((directory / SNAPSHOT_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        snapshot = None
+    if isinstance(snapshot, dict):
+        seq = int(snapshot.pop("seq", 0) or 0)
+        snapshot.pop("version", None)
+        state.update(snapshot)
+
+    try:
+        with open(directory / JOURNAL_NAME, encoding="utf-8") as handle:
+            for line in handle:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    break
+                # Operations already folded into the snapshot (crash during compaction).
+                if int(op.get("seq", 0)) <= seq:
+                    continue
+                try:
+                    apply_operation(state, op)
+                except (KeyError, TypeError, ValueError) as exc:
+                    logging.warning(f"autosave: skipping operation {op.get('op')}: {exc}")
+    except OSError:
+        pass
+
+    if not state["items"] and not state["formula_name"]:
+        return None
+    return state
+
+
+class AutosaveJournal:
+    """
+    Append-only journal of formulation edits with periodic snapshot compaction.
+
+    ``record`` serializes one operation (cost proportional to the change) and hands
+    it to a writer thread, which appends and flushes in batches. ``compact`` writes
+    the full state atomically and starts an empty journal; sequence numbers make a
+    crash between the two steps harmless.
+    """
+
+    def __init__(self, directory: str | Path, compact_every: int = COMPACT_EVERY) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.compact_every = compact_every
+        self._seq = 0
+        self._since_compaction = 0
+        self._queue: "queue.Queue[tuple[str, str]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+        self._thread.start()
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self._since_compaction >= self.compact_every
+
+    def record(self, op: str, **data: Any) -> None:
+        self._seq += 1
+        self._since_compaction += 1
+        self._queue.put(("append", json.dumps({"seq": self._seq, "op": op, **data}, ensure_ascii=False)))
+
+    def compact(self, state: Dict[str, Any]) -> None:
+        """Replace snapshot and journal with ``state`` (serialized now, written in the background)."""
+        self._since_compaction = 0
+        payload = json.dumps({**state, "seq": self._seq, "version": 1}, ensure_ascii=False)
+        self._queue.put(("compact", payload))
+
+    def flush(self) -> None:
+        """Block until every queued operation is on disk."""
+        self._queue.join()
+
+    def close(self, discard: bool = False) -> None:
+        """Stop the writer; ``discard`` removes the autosave (clean shutdown)."""
+        if discard:
+            self._queue.put(("discard", ""))
+        self._queue.put(("stop", ""))
+        self._thread.join()
+
+    def _run(self) -> None:
+        journal_path = self.directory / JOURNAL_NAME
+        snapshot_path = self.directory / SNAPSHOT_NAME
+        journal = None
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for kind, payload in batch:
+                    if kind == "append":
+                        if journal is None:
+                            journal = open(journal_path, "a", encoding="utf-8")
+                        journal.write(payload + "\n")
+                        continue
+                    if journal is not None:
+                        journal.close()
+                        journal = None
+                    if kind == "compact":
+                        atomic_write(snapshot_path, lambda tmp, text=payload: tmp.write_text(text, encoding="utf-8"))
+                        # Everything journaled so far is in the snapshot now.
+                        journal_path.write_text("", encoding="utf-8")
+                    elif kind == "discard":
+                        journal_path.unlink(missing_ok=True)
+                        snapshot_path.unlink(missing_ok=True)
+                    elif kind == "stop":
+                        running = False
+                # One flush per batch: a burst of edits costs a single write call.
+                if journal is not None:
+                    journal.flush()
+            except OSError as exc:
+                # Autosave is best effort; editing must never fail because of it.
+                logging.error(f"autosave: {exc}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        if journal is not None:
+            journal.close()
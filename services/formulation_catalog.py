@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from services.formulation_compare import hydrate_shared, load_formulations
+from services.formulation_engine import FormulationEngine
+from services.formulation_io import find_formulation_files
+from services.nutrient_registry import NutrientRegistry, get_registry
+from services.usda_api import get_food_details
+
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE formulations (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    name TEXT NOT NULL COLLATE NOCASE,
+    total_weight REAL,
+    indexed_at REAL NOT NULL,
+    error TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE ingredients (
+    formulation_id INTEGER NOT NULL REFERENCES formulations(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    fdc_id INTEGER NOT NULL,
+    description TEXT NOT NULL COLLATE NOCASE,
+    amount_g REAL NOT NULL,
+    PRIMARY KEY (formulation_id, position)
+);
+CREATE INDEX ingredients_fdc ON ingredients (fdc_id);
+CREATE TABLE totals (
+    formulation_id INTEGER NOT NULL REFERENCES formulations(id) ON DELETE CASCADE,
+    nutrient_key TEXT NOT NULL,
+    name TEXT NOT NULL COLLATE NOCASE,
+    unit TEXT NOT NULL,
+    amount REAL NOT NULL,
+    PRIMARY KEY (formulation_id, nutrient_key)
+);
+CREATE INDEX totals_name_amount ON totals (name, amount);
+"""
+
+
+@dataclass
+class CatalogUpdate:
+    """Outcome of one incremental scan."""
+
+    added: List[str] = field(default_factory=list)
+    updated: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    unchanged: int = 0
+    # Indexed without totals (ingredients are still searchable): path -> message.
+    errors: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    path: str
+    name: str
+    # Matched ingredient grams or nutrient amount per 100 g, depending on the query.
+    amount: float | None = None
+    unit: str = ""
+
+
+class FormulationCatalog:
+    """
+    SQLite index of saved formulations: names, ingredients and per 100 g totals.
+
+    ``update`` only re-reads files whose mtime/size changed, so keeping a large
+    library indexed is cheap, and queries never open the formulation files.
+    """
+
+    def __init__(self, db_path: str | Path, registry: NutrientRegistry | None = None) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._registry = registry if registry is not None else get_registry()
+        self._conn = sqlite3.connect(str(self.db_path))
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._ensure_schema()
+
+    def __enter__(self) -> "FormulationCatalog":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _ensure_schema(self) -> None:
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        # The catalog is a cache of the files: rebuild it rather than migrate.
+        with self._conn:
+            for table in ("totals", "ingredients", "formulations"):
+                self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._conn.executescript(_SCHEMA)
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    # ---- Indexing ----
+    def update(
+        self,
+        folder: str | Path,
+        recursive: bool = True,
+        max_attempts: int = 4,
+        read_timeout: float = 8.0,
+        fetch: Callable[..., Dict[str, Any]] = get_food_details,
+        progress: Callable[[str], None] | None = None,
+    ) -> CatalogUpdate:
+        """Index new or modified formulations under ``folder`` and drop deleted ones."""
+        root = Path(folder).resolve()
+        result = CatalogUpdate()
+        # LIKE narrows the scan; the prefix may also match sibling folders ("saves2").
+        # Rows whose foods failed to load are stored with mtime 0, so they stay stale.
+        known = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in self._conn.execute(
+                "SELECT path, mtime_ns, size FROM formulations WHERE path LIKE ? ESCAPE '\\'",
+                (_like_prefix(str(root)),),
+            )
+            if Path(path).is_relative_to(root)
+        }
+        stats: Dict[str, tuple[int, int]] = {}
+        for file in find_formulation_files(root, recursive=recursive):
+            st = file.stat()
+            stats[str(file)] = (st.st_mtime_ns, st.st_size)
+
+        stale = [path for path, stat in stats.items() if known.get(path) != stat]
+        result.unchanged = len(stats) - len(stale)
+        gone = [
+            path
+            for path in known
+            if path not in stats and (recursive or Path(path).parent == root)
+        ]
+        if gone:
+            with self._conn:
+                self._conn.executemany("DELETE FROM formulations WHERE path = ?", [(p,) for p in gone])
+            result.removed.extend(gone)
+        if not stale:
+            return result
+
+        if progress:
+            progress(f"Leyendo {len(stale)} formulaciones...")
+        loaded, load_errors = load_formulations(stale)
+        if progress:
+            progress("Cargando ingredientes...")
+        hydrated, failures, _ = hydrate_shared(
+            [base_items for _, base_items, _ in loaded],
+            max_attempts,
+            read_timeout,
+            fetch,
+            self._registry,
+        )
+
+        with self._conn:
+            for path, message in load_errors.items():
+                self._store(path, stats[path], Path(path).stem, [], None, message)
+                result.errors[path] = message
+            for (path, base_items, meta), items in zip(loaded, hydrated):
+                error = ""
+                if items is None:
+                    missing = sorted({int(i["fdc_id"]) for i in base_items} & set(failures))
+                    error = "; ".join(f"FDC {fdc_id}: {failures[fdc_id]}" for fdc_id in missing)
+                    result.errors[path] = error
+                # Fetch failures may be transient: a zero mtime retries them next update.
+                # Unreadable files (load_errors) keep their stat until the file changes.
+                stat = (0, stats[path][1]) if items is None else stats[path]
+                name = meta.get("formula_name") or Path(path).stem
+                self._store(path, stat, name, items or base_items, items, error)
+            for path in stale:
+                (result.updated if path in known else result.added).append(path)
+        return result
+
+    def _store(
+        self,
+        path: str,
+        stat: tuple[int, int],
+        name: str,
+        ingredients: List[Dict[str, Any]],
+        hydrated: List[Dict[str, Any]] | None,
+        error: str,
+    ) -> None:
+        conn = self._conn
+        conn.execute("DELETE FROM formulations WHERE path = ?", (path,))
+        total_weight = sum(float(item.get("amount_g", 0.0) or 0.0) for item in ingredients)
+        cursor = conn.execute(
+            "INSERT INTO formulations (path, mtime_ns, size, name, total_weight, indexed_at, error)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, stat[0], stat[1], name, total_weight, time.time(), error),
+        )
+        formulation_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT INTO ingredients (formulation_id, position, fdc_id, description, amount_g)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    formulation_id,
+                    position,
+                    int(item["fdc_id"]),
+                    item.get("description", "") or "",
+                    float(item.get("amount_g", 0.0) or 0.0),
+                )
+                for position, item in enumerate(ingredients)
+            ],
+        )
+        if hydrated is None:
+            return
+        engine = FormulationEngine(self._registry)
+        engine.sync(hydrated)
+        conn.executemany(
+            "INSERT INTO totals (formulation_id, nutrient_key, name, unit, amount) VALUES (?, ?, ?, ?, ?)",
+            [
+                (formulation_id, key, total["name"], total["unit"], total["amount"])
+                for key, total in engine.totals().items()
+            ],
+        )
+
+    # ---- Queries ----
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM formulations").fetchone()[0]
+
+    def formulations(self, name: str = "") -> list[CatalogEntry]:
+        """Indexed formulations, optionally filtered by a name fragment."""
+        rows = self._conn.execute(
+            "SELECT path, name, total_weight FROM formulations WHERE name LIKE ? ESCAPE '\\'"
+            " ORDER BY name, path",
+            (f"%{_like_escape(name)}%",),
+        )
+        return [CatalogEntry(path, fname, weight, "g") for path, fname, weight in rows]
+
+    def using_ingredient(self, fdc_id: int) -> list[CatalogEntry]:
+        """Formulations containing the food, with its grams in each."""
+        rows = self._conn.execute(
+            "SELECT f.path, f.name, SUM(i.amount_g) FROM ingredients i"
+            " JOIN formulations f ON f.id = i.formulation_id"
+            " WHERE i.fdc_id = ? GROUP BY f.id ORDER BY f.name, f.path",
+            (int(fdc_id),),
+        )
+        return [CatalogEntry(path, name, amount, "g") for path, name, amount in rows]
+
+    def by_nutrient(
+        self,
+        nutrient: str,
+        minimum: float | None = None,
+        maximum: float | None = None,
+        unit: str = "",
+    ) -> list[CatalogEntry]:
+        """
+        Formulations whose total per 100 g of a nutrient lies within [minimum, maximum].
+
+        ``nutrient`` matches the start of the USDA name, case-insensitively
+        ("sodium" finds "Sodium, Na"); ``unit`` narrows e.g. Energy to kcal.
+        """
+        clauses = ["t.name LIKE ? ESCAPE '\\'"]
+        params: list[Any] = [f"{_like_escape(nutrient.strip())}%"]
+        if unit:
+            clauses.append("t.unit = ?")
+            params.append(unit)
+        if minimum is not None:
+            clauses.append("t.amount >= ?")
+            params.append(float(minimum))
+        if maximum is not None:
+            clauses.append("t.amount <= ?")
+            params.append(float(maximum))
+        rows = self._conn.execute(
+            "SELECT f.path, f.name, t.amount, t.unit FROM totals t"
+            " JOIN formulations f ON f.id = t.formulation_id"
+            f" WHERE {' AND '.join(clauses)} ORDER BY t.amount DESC, f.name",
+            params,
+        )
+        return [CatalogEntry(path, name, amount, unit_name) for path, name, amount, unit_name in rows]
+
+    def errors(self) -> Dict[str, str]:
+        """Files indexed without totals (unreadable, or foods that could not be loaded)."""
+        rows = self._conn.execute("SELECT path, error FROM formulations WHERE error != '' ORDER BY path")
+        return dict(rows.fetchall())
+
+
+def _like_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _like_prefix(folder: str) -> str:
+    return _like_escape(folder) + "%"
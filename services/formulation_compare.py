@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+from services.formulation_engine import FormulationEngine
+from services.formulation_export import collect_nutrient_columns
+from services.formulation_io import FormulationFileError, hydrate_item, hydrate_items, load_formulation_file
+from services.nutrient_registry import NutrientRegistry, get_registry
+from services.usda_api import get_food_details
+
+LOAD_THREADS = 4
+FETCH_THREADS = 4
+
+
+@dataclass(frozen=True)
+class FormulationComparison:
+    """Totals per 100 g of several formulations over one shared set of nutrient columns."""
+
+    names: tuple[str, ...]
+    paths: tuple[str, ...]
+    headers: tuple[str, ...]
+    categories: tuple[str, ...]
+    # formulations x headers; NaN where a formulation has no value for the nutrient.
+    totals: np.ndarray
+    total_weights: np.ndarray
+    ingredient_counts: tuple[int, ...]
+    # Files that could not be loaded or hydrated: path -> message.
+    errors: Dict[str, str]
+    # USDA detail payloads requested for the whole set.
+    fetched: int
+
+
+def _load_one(path: str) -> tuple[str, list[Dict[str, Any]], Dict[str, Any], str]:
+    try:
+        base_items, meta = load_formulation_file(path)
+    except FormulationFileError as exc:
+        return path, [], {}, f"{exc.title}: {exc}"
+    return path, base_items, meta, ""
+
+
+def load_formulations(
+    paths: List[str | Path], max_workers: int = LOAD_THREADS
+) -> tuple[list[tuple[str, list[Dict[str, Any]], Dict[str, Any]]], Dict[str, str]]:
+    """Parse formulation files in parallel; returns (path, base items, meta) in input order plus errors."""
+    loaded: list[tuple[str, list[Dict[str, Any]], Dict[str, Any]]] = []
+    errors: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        for path, base_items, meta, error in pool.map(_load_one, [str(p) for p in paths]):
+            if error:
+                errors[path] = error
+            else:
+                loaded.append((path, base_items, meta))
+    return loaded, errors
+
+
+def hydrate_shared(
+    base_lists: List[List[Dict[str, Any]]],
+    max_attempts: int = 4,
+    read_timeout: float = 8.0,
+    fetch: Callable[..., Dict[str, Any]] = get_food_details,
+    registry: NutrientRegistry | None = None,
+    max_workers: int = FETCH_THREADS,
+) -> tuple[list[list[Dict[str, Any]] | None], Dict[int, str], int]:
+    """
+    Hydrate several formulations with one fetch per distinct FDC ID.
+
+    Items of the same food share one nutrients list (and so one matrix row downstream).
+    Returns the hydrated lists (None where some food failed), FDC ID -> error and the
+    number of foods fetched.
+    """
+    registry = registry if registry is not None else get_registry()
+    wanted = sorted(
+        {int(item["fdc_id"]) for items in base_lists for item in items if "details" not in item}
+    )
+    shared: Dict[int, Dict[str, Any]] = {}
+    failures: Dict[int, str] = {}
+
+    def hydrate(fdc_id: int) -> None:
+        try:
+            shared[fdc_id] = hydrate_items(
+                [{"fdc_id": fdc_id}], max_attempts, read_timeout, fetch, registry
+            )[0]
+        except Exception as exc:  # noqa: BLE001 - reported for the files that use it
+            failures[fdc_id] = str(exc)
+
+    if wanted:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            list(pool.map(hydrate, wanted))
+
+    hydrated: list[list[Dict[str, Any]] | None] = []
+    for items in base_lists:
+        result: list[Dict[str, Any]] | None = []
+        for item in items:
+            if "details" in item:
+                result.append(hydrate_item(item, item["details"], registry))
+                continue
+            food = shared.get(int(item["fdc_id"]))
+            if food is None:
+                result = None
+                break
+            result.append(
+                {
+                    **food,
+                    "amount_g": float(item.get("amount_g", 0.0) or 0.0),
+                    "locked": bool(item.get("locked", False)),
+                }
+            )
+        hydrated.append(result)
+    return hydrated, failures, len(wanted)
+
+
+def compare_formulations(
+    paths: List[str | Path],
+    data_type_priority: Dict[str, int] | None = None,
+    max_attempts: int = 4,
+    read_timeout: float = 8.0,
+    fetch: Callable[..., Dict[str, Any]] = get_food_details,
+    registry: NutrientRegistry | None = None,
+) -> FormulationComparison:
+    """
+    Load, hydrate and total several formulations side by side.
+
+    Distinct ingredients across all files form one ingredients x nutrients matrix
+    (built by FormulationEngine); the grams of every formulation form a second
+    matrix, so all totals come out of a single matrix product.
+    """
+    registry = registry if registry is not None else get_registry()
+    loaded, errors = load_formulations(paths)
+    hydrated, failures, fetched = hydrate_shared(
+        [base_items for _, base_items, _ in loaded], max_attempts, read_timeout, fetch, registry
+    )
+
+    formulations: list[tuple[str, str, list[Dict[str, Any]]]] = []
+    for (path, base_items, meta), items in zip(loaded, hydrated):
+        if items is None:
+            missing = sorted({int(i["fdc_id"]) for i in base_items} & set(failures))
+            errors[path] = "; ".join(f"FDC {fdc_id}: {failures[fdc_id]}" for fdc_id in missing)
+            continue
+        formulations.append((path, meta.get("formula_name") or Path(path).stem, items))
+
+    # One row per distinct nutrients list: foods shared between files are stored once.
+    rows: Dict[int, int] = {}
+    unique_items: list[Dict[str, Any]] = []
+    for _, _, items in formulations:
+        for item in items:
+            if id(item["nutrients"]) not in rows:
+                rows[id(item["nutrients"])] = len(unique_items)
+                unique_items.append(item)
+    amounts = np.zeros((len(formulations), len(unique_items)), dtype=float)
+    for index, (_, _, items) in enumerate(formulations):
+        for item in items:
+            amounts[index, rows[id(item["nutrients"])]] += float(item.get("amount_g", 0.0) or 0.0)
+
+    engine = FormulationEngine(registry)
+    engine.sync(unique_items)
+    matrix = engine.matrix
+    column_by_nid = {nid: column for column, nid in enumerate(engine.nutrient_ids)}
+    # A nutrient is blank (not zero) in a formulation when none of its ingredients reports it.
+    reported = np.zeros(matrix.shape, dtype=bool)
+    for row, item in enumerate(unique_items):
+        for entry in item["nutrients"]:
+            if entry.get("amount") is not None:
+                column = column_by_nid.get(registry.resolve_entry(entry))
+                if column is not None:
+                    reported[row, column] = True
+
+    weights = amounts.sum(axis=1)
+    # Same convention as FormulationSnapshot: per 100 g of product (per 100 g input when empty).
+    by_nid = (amounts @ matrix) / np.where(weights > 0, weights, 100.0)[:, None]
+    present = (amounts > 0).astype(float) @ reported > 0
+
+    headers, categories, key_map = collect_nutrient_columns(
+        unique_items, {}, data_type_priority or {}, registry
+    )
+    columns = [column_by_nid[registry.id_for_key(key_map[header])] for header in headers]
+    totals = np.where(present[:, columns], by_nid[:, columns], np.nan)
+
+    return FormulationComparison(
+        names=tuple(name for _, name, _ in formulations),
+        paths=tuple(path for path, _, _ in formulations),
+        headers=tuple(headers),
+        categories=tuple(categories[header] for header in headers),
+        totals=totals,
+        total_weights=weights,
+        ingredient_counts=tuple(len(items) for _, _, items in formulations),
+        errors=errors,
+        fetched=fetched,
+    )
@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+import numpy as np
+
+from services.nutrient_registry import (
+    NutrientRegistry,
+    get_registry,
+    sort_nutrients_for_display,
+)
+
+
+@dataclass(frozen=True)
+class FormulationSnapshot:
+    """Immutable copy of the running sums, safe to hand to a worker thread."""
+
+    weighted: np.ndarray
+    total_weight: float
+    nutrient_ids: tuple[int, ...]
+    columns: tuple[tuple[str, str, str, float | None], ...]
+    # Engine state version; equal versions mean equal totals.
+    version: int = 0
+
+    def totals_vector(self) -> np.ndarray:
+        """Nutrient totals per 100 g of final product, aligned to nutrient_ids."""
+        if not self.nutrient_ids:
+            return np.zeros(0, dtype=float)
+        if self.total_weight > 0:
+            return self.weighted / self.total_weight
+        return self.weighted / 100.0
+
+    def totals(self) -> Dict[str, Dict[str, Any]]:
+        """Return totals keyed by header key, shaped like the previous dict-based sum."""
+        vector = self.totals_vector()
+        totals: Dict[str, Dict[str, Any]] = {}
+        for col, nid in enumerate(self.nutrient_ids):
+            key, name, unit, order = self.columns[col]
+            totals[key] = {
+                "nid": nid,
+                "name": name,
+                "unit": unit,
+                "amount": float(vector[col]),
+                "order": order if order is not None else float(col),
+            }
+        return totals
+
+
+class FormulationEngine:
+    """
+    Qt-free formulation math.
+
+    Ingredient amounts live in a vector and nutrient values (per 100 g of ingredient)
+    in a dense items x nutrients matrix whose columns are interned nutrient IDs, so
+    totals per 100 g of final product are a single matrix-vector product.
+
+    Weighted sums are kept running: amount-only edits apply a delta in O(nutrients)
+    and the matrix is only rebuilt on structural changes (items added/removed/reloaded).
+    """
+
+    # Full recompute after this many delta updates to bound floating point drift.
+    MAX_DELTA_UPDATES = 256
+
+    def __init__(self, registry: NutrientRegistry | None = None) -> None:
+        self._registry = registry if registry is not None else get_registry()
+        self._sources: List[Any] = []
+        self._amounts = np.zeros(0, dtype=float)
+        self._matrix = np.zeros((0, 0), dtype=float)
+        self._weighted = np.zeros(0, dtype=float)
+        self._total_weight = 0.0
+        self._delta_updates = 0
+        self._col_nids: List[int] = []
+        self._col_meta: List[tuple[str, str, str, float | None]] = []
+        self._registry_version = -1
+        self._version = 0
+
+    # ---- Sync with the UI item dicts ----
+    def sync(self, items: List[Dict[str, Any]]) -> None:
+        """
+        Bring the engine in line with the UI item dicts.
+        Structural changes rebuild the matrix; amount changes become delta updates.
+        """
+        amounts = np.fromiter(
+            (float(item.get("amount_g", 0) or 0) for item in items),
+            dtype=float,
+            count=len(items),
+        )
+        sources = [item.get("nutrients") for item in items]
+        if (
+            len(sources) != len(self._sources)
+            or any(a is not b for a, b in zip(sources, self._sources))
+            or self._registry_version != self._registry.version
+        ):
+            self._rebuild(items)
+            self._amounts = amounts
+            self._recompute_sums()
+            return
+        changed = np.flatnonzero(amounts != self._amounts)
+        if len(changed) * 2 > len(amounts):
+            self._amounts = amounts
+            self._recompute_sums()
+            return
+        for row in changed:
+            self.set_amount(int(row), float(amounts[row]))
+
+    def set_amount(self, index: int, amount_g: float) -> None:
+        """Change one ingredient amount, updating the running sums in O(nutrients)."""
+        if not 0 <= index < len(self._amounts):
+            # Not synced yet; the next sync() rebuilds from the item dicts.
+            return
+        delta = float(amount_g) - float(self._amounts[index])
+        if delta == 0.0:
+            return
+        self._amounts[index] = amount_g
+        self._delta_updates += 1
+        self._version += 1
+        if self._delta_updates >= self.MAX_DELTA_UPDATES:
+            self._recompute_sums()
+            return
+        if self._matrix.shape[1]:
+            self._weighted += delta * self._matrix[index]
+        self._total_weight += delta
+        if self._total_weight <= 1e-9:
+            # Avoid dividing by cancellation noise when the formula empties out.
+            self._recompute_sums()
+
+    def _recompute_sums(self) -> None:
+        if self._matrix.shape[1]:
+            self._weighted = self._amounts @ self._matrix
+        else:
+            self._weighted = np.zeros(0, dtype=float)
+        self._total_weight = float(self._amounts.sum())
+        self._delta_updates = 0
+        self._version += 1
+
+    def _rebuild(self, items: List[Dict[str, Any]]) -> None:
+        registry = self._registry
+        columns: Dict[int, int] = {}
+        col_nids: List[int] = []
+        cells: List[tuple[int, int, float]] = []
+        for row, item in enumerate(items):
+            for entry in sort_nutrients_for_display(item.get("nutrients", []) or [], registry):
+                amount = entry.get("amount")
+                if amount is None:
+                    continue
+                nid = registry.resolve_entry(entry)
+                if nid is None:
+                    continue
+                col = columns.get(nid)
+                if col is None:
+                    col = columns[nid] = len(col_nids)
+                    col_nids.append(nid)
+                cells.append((row, col, float(amount)))
+
+        matrix = np.zeros((len(items), len(col_nids)), dtype=float)
+        for row, col, amount in cells:
+            # Duplicated nutrients within one ingredient add up, as in the per-dict sum.
+            matrix[row, col] += amount
+
+        col_meta: List[tuple[str, str, str, float | None]] = []
+        for nid in col_nids:
+            info = registry.info(nid)
+            col_meta.append((info.key, info.name, info.unit, info.order))
+
+        self._sources = [item.get("nutrients") for item in items]
+        self._matrix = matrix
+        self._col_nids = col_nids
+        self._col_meta = col_meta
+        self._registry_version = registry.version
+
+    # ---- Queries ----
+    @property
+    def amounts(self) -> np.ndarray:
+        return self._amounts
+
+    @property
+    def nutrient_ids(self) -> List[int]:
+        return list(self._col_nids)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Read-only items x nutrient_ids matrix of values per 100 g of ingredient."""
+        view = self._matrix.view()
+        view.flags.writeable = False
+        return view
+
+    def total_weight(self) -> float:
+        return self._total_weight
+
+    @property
+    def version(self) -> int:
+        """Bumped on every change to the sums (cache key for derived label math)."""
+        return self._version
+
+    def snapshot(self) -> FormulationSnapshot:
+        """Copy the running sums so totals can be evaluated off the GUI thread."""
+        weighted = self._weighted.copy()
+        weighted.flags.writeable = False
+        return FormulationSnapshot(
+            weighted=weighted,
+            total_weight=self._total_weight,
+            nutrient_ids=tuple(self._col_nids),
+            columns=tuple(self._col_meta),
+            version=self._version,
+        )
+
+    def totals_vector(self) -> np.ndarray:
+        return self.snapshot().totals_vector()
+
+    def totals(self) -> Dict[str, Dict[str, Any]]:
+        return self.snapshot().totals()
@@ -0,0 +1,395 @@
+from __future__ import annotations
+
+import json
+import os
+import stat
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, NamedStyle, PatternFill
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.cell_range import CellRange
+
+from services.nutrient_registry import NutrientRegistry, get_registry, sort_nutrients_for_display
+
+BASE_HEADERS = [
+    "FDC ID",
+    "Ingrediente",
+    "Marca / Origen",
+    "Tipo de dato",
+    "Cantidad (g)",
+    "Cantidad (%)",
+]
+BASE_COLUMN_WIDTHS = {"A": 12, "B": 35, "C": 18, "D": 14, "E": 12, "F": 12}
+
+PROGRESS_EVERY = 25
+
+HEADER_COLOR = "D9D9D9"
+TOTAL_COLOR = "FFF2CC"
+CATEGORY_COLORS = {
+    "Proximates": "DAEEF3",
+    "Carbohydrates": "E6B8B7",
+    "Minerals": "C4D79B",
+    "Vitamins and Other Components": "FFF2CC",
+    "Lipids": "D9E1F2",
+    "Amino acids": "E4DFEC",
+}
+
+# When several USDA entries land in one column, the higher priority name wins.
+_ALIAS_PRIORITY = {
+    "carbohydrate, by difference": 2,
+    "carbohydrate, by summation": 1,
+    "carbohydrate by summation": 1,
+    "sugars, total": 2,
+    "total sugars": 1,
+}
+
+_TITLE_STYLE = "Formulación título"
+_HEADER_STYLE = "Formulación encabezado"
+_GRAMS_STYLE = "Formulación gramos"
+_PERCENT_STYLE = "Formulación porcentaje"
+_TOTAL_STYLE = "Formulación total"
+_TOTAL_GRAMS_STYLE = "Formulación total gramos"
+_TOTAL_PERCENT_STYLE = "Formulación total porcentaje"
+
+
+def split_header_unit(header: str) -> tuple[str, str]:
+    """Split "Name (unit)" export headers into (name, unit)."""
+    if header.endswith(")") and " (" in header:
+        name, unit = header.rsplit(" (", 1)
+        return name, unit[:-1]
+    return header, ""
+
+
+def _alias_priority(entry: Dict[str, Any]) -> int:
+    name = ((entry.get("nutrient") or {}).get("name") or "").strip().lower()
+    return _ALIAS_PRIORITY.get(name, 0)
+
+
+def nutrient_cells(
+    nutrients: List[Dict[str, Any]],
+    column_by_nid: Dict[int, int],
+    width: int,
+    registry: NutrientRegistry,
+) -> list[Any]:
+    """Per 100 g amounts of one ingredient aligned to the nutrient columns (None when absent)."""
+    chosen: Dict[int, Dict[str, Any]] = {}
+    for entry in nutrients:
+        if entry.get("amount") is None:
+            continue
+        column = column_by_nid.get(registry.resolve_entry(entry))
+        if column is None:
+            continue
+        # Priorities only matter when two entries share a column (e.g. carbohydrate aliases).
+        previous = chosen.get(column)
+        if previous is not None and _alias_priority(entry) < _alias_priority(previous):
+            continue
+        chosen[column] = entry
+    values: list[Any] = [None] * width
+    for column, entry in chosen.items():
+        values[column] = entry["amount"]
+    return values
+
+
+def collect_nutrient_columns(
+    items: List[Dict[str, Any]],
+    export_flags: Dict[str, bool],
+    data_type_priority: Dict[str, int],
+    registry: NutrientRegistry | None = None,
+) -> tuple[list[str], Dict[str, str], Dict[str, str]]:
+    """
+    Ordered nutrient headers with their categories and header keys.
+
+    Catalog order drives the grouping; only nutrients with a value in some
+    ingredient (and not disabled in ``export_flags``) get a column.
+    """
+    registry = registry if registry is not None else get_registry()
+    candidates: Dict[str, Dict[str, Any]] = {}
+    categories_seen_order: Dict[str, int] = {}
+    preferred_order = [cat for cat, _ in registry.catalog]
+    preferred_count = len(preferred_order)
+    for item in items:
+        data_priority = data_type_priority.get(
+            (item.get("data_type") or "").strip(), len(data_type_priority)
+        )
+        for entry in sort_nutrients_for_display(item.get("nutrients", []), registry):
+            amount = entry.get("amount")
+            if amount is None:
+                continue
+            nid = registry.resolve_entry(entry)
+            if nid is None:
+                continue
+            info = registry.info(nid)
+            header_key = info.key
+            if not export_flags.get(header_key, True):
+                continue
+            if not info.name:
+                continue
+
+            category = info.category
+            if category not in categories_seen_order:
+                categories_seen_order[category] = len(categories_seen_order)
+
+            order = registry.catalog_order.get(info.name.strip().lower())
+            if order is None:
+                order = info.order if info.order is not None else float(len(candidates))
+            # Keep kcal ahead of kJ when both present
+            unit_lower = info.unit.strip().lower()
+            if info.name.strip().lower() == "energy":
+                if unit_lower == "kcal":
+                    order = order - 0.1
+                elif unit_lower == "kj":
+                    order = order + 0.1
+
+            header = info.header
+
+            existing = candidates.get(header_key)
+            if existing is None or (
+                data_priority < existing["data_priority"]
+                or (
+                    data_priority == existing["data_priority"]
+                    and order < existing["order"]
+                )
+                or (
+                    data_priority == existing["data_priority"]
+                    and order == existing["order"]
+                    and header < existing["header"]
+                )
+            ):
+                candidates[header_key] = {
+                    "header_key": header_key,
+                    "header": header,
+                    "category": category,
+                    "order": order,
+                    "data_priority": data_priority,
+                }
+
+    def category_rank(cat: str) -> int:
+        if cat in preferred_order:
+            return preferred_order.index(cat)
+        return preferred_count + categories_seen_order.get(cat, preferred_count)
+
+    sorted_candidates = sorted(
+        candidates.values(),
+        key=lambda c: (
+            category_rank(c["category"]),
+            c["order"],
+            c["header"].lower(),
+        ),
+    )
+
+    ordered_headers: list[str] = [c["header"] for c in sorted_candidates]
+    categories: Dict[str, str] = {c["header"]: c["category"] for c in sorted_candidates}
+    header_key_map: Dict[str, str] = {c["header"]: c["header_key"] for c in sorted_candidates}
+
+    return ordered_headers, categories, header_key_map
+
+
+def _category_style(category: str) -> str:
+    return f"Formulación {category}"
+
+
+def _add_named_styles(wb: Workbook, categories: set[str]) -> None:
+    center = Alignment(horizontal="center", vertical="center")
+    header_fill = PatternFill("solid", fgColor=HEADER_COLOR)
+    total_fill = PatternFill("solid", fgColor=TOTAL_COLOR)
+    styles = [
+        NamedStyle(_TITLE_STYLE, alignment=center),
+        NamedStyle(_HEADER_STYLE, fill=header_fill, alignment=center),
+        NamedStyle(_GRAMS_STYLE, number_format="0.0"),
+        NamedStyle(_PERCENT_STYLE, number_format="0.00%"),
+        NamedStyle(_TOTAL_STYLE, fill=total_fill),
+        NamedStyle(_TOTAL_GRAMS_STYLE, fill=total_fill, number_format="0.0"),
+        NamedStyle(_TOTAL_PERCENT_STYLE, fill=total_fill, number_format="0.00%"),
+    ]
+    for category in sorted(categories):
+        color = CATEGORY_COLORS.get(category, HEADER_COLOR)
+        styles.append(
+            NamedStyle(_category_style(category), fill=PatternFill("solid", fgColor=color), alignment=center)
+        )
+    for style in styles:
+        wb.add_named_style(style)
+
+
+def write_formulation_workbook(
+    filepath: str | Path,
+    items: List[Dict[str, Any]],
+    nutrient_headers: List[str],
+    header_categories: Dict[str, str],
+    header_key_map: Dict[str, str],
+    registry: NutrientRegistry | None = None,
+    progress: Callable[[int, int], None] | None = None,
+) -> None:
+    """
+    Stream the formulation workbook (Ingredientes + Totales) row by row.
+
+    Uses openpyxl's write-only mode with shared named styles, so memory stays flat
+    however many ingredients and nutrient columns are exported. ``progress`` gets
+    (rows written, total rows) every few ingredients.
+    """
+    registry = registry if registry is not None else get_registry()
+    base_count = len(BASE_HEADERS)
+    column_count = base_count + len(nutrient_headers)
+    letters = [get_column_letter(col) for col in range(1, column_count + 1)]
+    categories = [header_categories.get(header, "Nutrientes") for header in nutrient_headers]
+    column_by_nid: Dict[int, int] = {}
+    for column, header in enumerate(nutrient_headers):
+        nid = registry.id_for_key(header_key_map.get(header, ""))
+        if nid is not None:
+            column_by_nid[nid] = column
+
+    wb = Workbook(write_only=True)
+    _add_named_styles(wb, set(categories))
+    ws = wb.create_sheet("Ingredientes")
+    totals_sheet = wb.create_sheet("Totales")
+
+    def styled(sheet, value: Any, style: str) -> WriteOnlyCell:
+        cell = WriteOnlyCell(sheet, value=value)
+        cell.style = style
+        return cell
+
+    # Sheet layout has to be set before the first row is streamed.
+    for col_letter, width in BASE_COLUMN_WIDTHS.items():
+        ws.column_dimensions[col_letter].width = width
+    freeze_col = base_count + 1 if nutrient_headers else 1
+    ws.freeze_panes = f"{get_column_letter(freeze_col)}3"
+
+    # Row 1: group titles (base + nutrient categories)
+    group_row: list[Any] = [styled(ws, "Detalles de formulación", _TITLE_STYLE)] + [None] * (column_count - 1)
+    ws.merged_cells.add(CellRange(min_col=1, min_row=1, max_col=base_count, max_row=1))
+    run_start = 0
+    while run_start < len(categories):
+        run_end = run_start
+        while run_end + 1 < len(categories) and categories[run_end + 1] == categories[run_start]:
+            run_end += 1
+        category = categories[run_start]
+        group_row[base_count + run_start] = styled(ws, category, _category_style(category))
+        ws.merged_cells.add(
+            CellRange(min_col=base_count + run_start + 1, min_row=1, max_col=base_count + run_end + 1, max_row=1)
+        )
+        run_start = run_end + 1
+    ws.append(group_row)
+
+    # Row 2: headers
+    ws.append(
+        [styled(ws, name, _HEADER_STYLE) for name in BASE_HEADERS]
+        + [styled(ws, name, _category_style(cat)) for name, cat in zip(nutrient_headers, categories)]
+    )
+
+    start_row = 3
+    end_row = start_row + len(items) - 1
+    total_row = end_row + 1
+    grams = letters[BASE_HEADERS.index("Cantidad (g)")]
+    percent = letters[BASE_HEADERS.index("Cantidad (%)")]
+    grams_range = f"${grams}${start_row}:${grams}${end_row}"
+    percent_range = f"${percent}${start_row}:${percent}${end_row}"
+
+    for row, item in enumerate(items, start=start_row):
+        ws.append(
+            [
+                item.get("fdc_id", ""),
+                item.get("description", ""),
+                item.get("brand", ""),
+                item.get("data_type", ""),
+                styled(ws, float(item.get("amount_g", 0.0) or 0.0), _GRAMS_STYLE),
+                styled(ws, f"={grams}{row}/SUM({grams_range})", _PERCENT_STYLE),
+            ]
+            + nutrient_cells(item.get("nutrients", []), column_by_nid, len(nutrient_headers), registry)
+        )
+        done = row - start_row + 1
+        if progress and (done % PROGRESS_EVERY == 0 or done == len(items)):
+            progress(done, len(items))
+
+    ws.append(
+        ["Total", "Formulado", "Formulado", "Formulado"]
+        + [
+            styled(ws, f"=SUBTOTAL(9,{grams}{start_row}:{grams}{end_row})", _TOTAL_GRAMS_STYLE),
+            styled(ws, "100%", _TOTAL_PERCENT_STYLE),
+        ]
+        + [
+            styled(ws, f"=SUMPRODUCT({percent_range},${letter}${start_row}:${letter}${end_row})", _TOTAL_STYLE)
+            for letter in letters[base_count:]
+        ]
+    )
+
+    # Totales sheet: simple reference to totals row
+    totals_sheet.append([styled(totals_sheet, name, _HEADER_STYLE) for name in ("Nutriente", "Total", "Unidad")])
+    for header, letter in zip(nutrient_headers, letters[base_count:]):
+        name_part, unit = split_header_unit(header)
+        totals_sheet.append([name_part, f"=Ingredientes!{letter}{total_row}", unit or ""])
+
+    wb.save(str(filepath))
+
+
+def _process_umask() -> int:
+    # os.umask can only be read by setting it; do it once, before export threads start.
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+_UMASK = _process_umask()
+
+
+def atomic_write(path: str | Path, write: Callable[[Path], None]) -> None:
+    """
+    Call ``write`` with a temporary path next to ``path`` and rename it into place.
+
+    The temporary file keeps the target suffix (some writers pick the format from
+    it); readers never see a partially written export, and a failed export leaves
+    any existing file untouched. The result keeps the permissions of the file it
+    replaces, or gets the usual umask-based mode when new (mkstemp creates 0600).
+    """
+    target = Path(path)
+    try:
+        fd, tmp_name = tempfile.mkstemp(prefix=f".{target.stem}-", suffix=target.suffix, dir=target.parent)
+    except OSError as exc:
+        raise OSError(exc.errno, exc.strerror, str(target)) from exc
+    os.close(fd)
+    try:
+        write(Path(tmp_name))
+        try:
+            mode = stat.S_IMODE(target.stat().st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_name, mode)
+        os.replace(tmp_name, target)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
+def state_payload(
+    items: List[Dict[str, Any]],
+    quantity_mode: str,
+    export_flags: Dict[str, bool],
+    formula_name: str,
+) -> Dict[str, Any]:
+    """JSON state (ingredients + amounts + flags) as read back by load_state_from_json."""
+    return {
+        "quantity_mode": quantity_mode,
+        "items": [
+            {
+                "fdc_id": item.get("fdc_id"),
+                "description": item.get("description", ""),
+                "brand": item.get("brand", ""),
+                "data_type": item.get("data_type", ""),
+                "amount_g": float(item.get("amount_g", 0.0) or 0.0),
+                "locked": bool(item.get("locked", False)),
+            }
+            for item in items
+        ],
+        "nutrient_export_flags": dict(export_flags),
+        "formula_name": formula_name,
+        "version": 2,
+    }
+
+
+def write_state_json(path: str | Path, payload: Dict[str, Any]) -> None:
+    Path(path).write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+from services.autosave import portable_item
+
+# Undo steps kept; older ones are dropped first.
+HISTORY_LIMIT = 500
+
+
+@dataclass(frozen=True, slots=True)
+class ItemState:
+    """
+    One ingredient as of a snapshot.
+
+    ``nutrients`` is the item's own list, shared rather than copied: nutrient
+    payloads are replaced, never edited, once an item is in the formulation.
+    """
+
+    fdc_id: Any
+    description: str
+    brand: str
+    data_type: str
+    amount_g: float
+    locked: bool
+    nutrients: List[Dict[str, Any]]
+
+    def fields(self) -> tuple[Any, ...]:
+        return (self.fdc_id, self.description, self.brand, self.data_type, self.amount_g, self.locked)
+
+    def to_item(self) -> Dict[str, Any]:
+        return {
+            "fdc_id": self.fdc_id,
+            "description": self.description,
+            "brand": self.brand,
+            "data_type": self.data_type,
+            "amount_g": self.amount_g,
+            "locked": self.locked,
+            "nutrients": self.nutrients,
+        }
+
+
+def _item_fields(item: Dict[str, Any]) -> tuple[Any, ...]:
+    return (
+        item.get("fdc_id"),
+        item.get("description", "") or "",
+        item.get("brand", "") or "",
+        item.get("data_type", "") or "",
+        float(item.get("amount_g", 0.0) or 0.0),
+        bool(item.get("locked", False)),
+    )
+
+
+@dataclass(frozen=True, slots=True)
+class FormulationState:
+    """Immutable formulation: a tuple of ItemState, sharing unchanged items with earlier states."""
+
+    items: tuple[ItemState, ...] = ()
+
+    @classmethod
+    def capture(
+        cls, items: List[Dict[str, Any]], previous: "FormulationState | None" = None
+    ) -> "FormulationState":
+        """
+        Snapshot the mutable item dicts.
+
+        Items whose fields and nutrients list match ``previous`` reuse its ItemState,
+        so a snapshot after editing one amount costs one new ItemState plus the tuple.
+        """
+        known = {id(state.nutrients): state for state in previous.items} if previous else {}
+        states: list[ItemState] = []
+        for item in items:
+            fields = _item_fields(item)
+            nutrients = item.get("nutrients")
+            if nutrients is None:
+                nutrients = []
+            candidate = known.get(id(nutrients))
+            if candidate is not None and candidate.fields() == fields:
+                states.append(candidate)
+            else:
+                states.append(ItemState(*fields, nutrients))
+        if previous is not None and len(states) == len(previous.items) and all(
+            a is b for a, b in zip(states, previous.items)
+        ):
+            return previous
+        return cls(tuple(states))
+
+    def to_items(self) -> list[Dict[str, Any]]:
+        """Fresh item dicts (safe to mutate); nutrient lists stay shared."""
+        return [state.to_item() for state in self.items]
+
+
+def journal_operations(
+    old: FormulationState, new: FormulationState
+) -> list[tuple[str, Dict[str, Any]]]:
+    """
+    Autosave journal operations turning ``old`` into ``new``.
+
+    Items are matched by their shared nutrients list, so an undo/redo costs
+    operations proportional to what differs: removals and inserts for the changed
+    span, then amount and lock updates. Only inserted items carry nutrients.
+    """
+    before, after = old.items, new.items
+    start = 0
+    limit = min(len(before), len(after))
+    while start < limit and before[start].nutrients is after[start].nutrients:
+        start += 1
+    end = 0
+    while (
+        end < limit - start
+        and before[len(before) - 1 - end].nutrients is after[len(after) - 1 - end].nutrients
+    ):
+        end += 1
+
+    ops: list[tuple[str, Dict[str, Any]]] = []
+    ops.extend(("remove", {"index": start}) for _ in range(len(before) - end - start))
+    inserted = range(start, len(after) - end)
+    ops.extend(("add", {"index": i, "item": portable_item(after[i].to_item())}) for i in inserted)
+
+    # Position in ``before`` of every kept item of ``after``.
+    kept = [
+        (i, i if i < start else i - len(after) + len(before))
+        for i in range(len(after))
+        if i not in inserted
+    ]
+    changed = [i for i, j in kept if after[i].amount_g != before[j].amount_g]
+    if len(changed) == 1:
+        ops.append(("amount", {"index": changed[0], "amount_g": after[changed[0]].amount_g}))
+    elif changed:
+        ops.append(("amounts", {"amounts": [state.amount_g for state in after]}))
+    ops.extend(
+        ("lock", {"index": i, "locked": after[i].locked})
+        for i, j in kept
+        if after[i].locked != before[j].locked
+    )
+    return ops
+
+
+class FormulationHistory:
+    """Undo/redo stacks of FormulationState; consecutive identical states are not stored."""
+
+    def __init__(self, limit: int = HISTORY_LIMIT) -> None:
+        self._undo: deque[FormulationState] = deque(maxlen=limit)
+        self._redo: list[FormulationState] = []
+
+    def push(self, state: FormulationState) -> None:
+        """Remember ``state`` (taken before an edit) and drop the redo branch."""
+        if self._undo and self._undo[-1] is state:
+            return
+        self._undo.append(state)
+        self._redo.clear()
+
+    def undo(self, current: FormulationState) -> FormulationState | None:
+        if not self._undo:
+            return None
+        self._redo.append(current)
+        return self._undo.pop()
+
+    def redo(self, current: FormulationState) -> FormulationState | None:
+        if not self._redo:
+            return None
+        self._undo.append(current)
+        return self._redo.pop()
+
+    def clear(self) -> None:
+        self._undo.clear()
+        self._redo.clear()
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._undo)
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._redo)
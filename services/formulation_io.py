@@ -0,0 +1,385 @@
+from __future__ import annotations
+
+import itertools
+import json
+import math
+import re
+import time
+import unicodedata
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+
+from services.formulation_export import BASE_HEADERS, nutrient_cells, split_header_unit
+from services.nutrient_normalizer import augment_fat_nutrients, normalize_nutrients
+from services.nutrient_registry import NutrientRegistry, assign_nutrient_ids, get_registry
+from services.usda_api import get_food_details, has_cached_food
+from services.xlsx_reader import SheetRows, XlsxReader
+
+FORMULATION_EXTENSIONS = (".json", ".xlsx", ".xls")
+HEADER_SCAN_ROWS = 10
+
+_FDC_CANDIDATES = ["fdc id", "fdc_id", "fdcid", "fdc"]
+_AMOUNT_CANDIDATES = [
+    "cantidad (g)",
+    "cantidad g",
+    "cantidad",
+    "cantidad gramos",
+    "cantidad en gramos",
+    "amount g",
+    "amount_g",
+    "g",
+    "grams",
+]
+
+
+class FormulationFileError(ValueError):
+    """A saved formulation could not be read; ``title`` is a short user-facing caption."""
+
+    def __init__(self, title: str, message: str, critical: bool = False) -> None:
+        super().__init__(message)
+        self.title = title
+        self.critical = critical
+
+
+def normalize_label(label: Any) -> str:
+    """Normalize column labels for loose matching (casefold + strip accents)."""
+    if label is None:
+        return ""
+    text = str(label)
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = text.replace("_", " ").replace("-", " ")
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def load_state_from_json(path: str | Path) -> tuple[list[Dict[str, Any]], Dict[str, Any]]:
+    """Read a JSON state file into (base items, meta); items still need hydration."""
+    try:
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+    except Exception as exc:  # noqa: BLE001
+        raise FormulationFileError(
+            "Error al importar", f"No se pudo leer el archivo:\n{exc}", critical=True
+        ) from exc
+
+    if not isinstance(data, dict):
+        raise FormulationFileError(
+            "Formato inválido", "El archivo no contiene una formulación válida."
+        )
+
+    items = data.get("items") or []
+    if not isinstance(items, list) or not items:
+        raise FormulationFileError(
+            "Formato inválido", "El archivo no contiene ingredientes válidos."
+        )
+
+    base_items: list[Dict[str, Any]] = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            fdc_int = int(item.get("fdc_id") or item.get("fdcId"))
+        except Exception:
+            raise FormulationFileError(
+                "FDC ID inválido",
+                f"FDC ID no numérico: {item.get('fdc_id') or item.get('fdcId')}",
+            )
+        base_items.append(
+            {
+                "fdc_id": fdc_int,
+                "amount_g": float(item.get("amount_g", 0.0) or 0.0),
+                "locked": bool(item.get("locked", False)),
+                "description": item.get("description", ""),
+                "brand": item.get("brand", ""),
+                "data_type": item.get("data_type", ""),
+            }
+        )
+
+    flags = data.get("nutrient_export_flags")
+    nutrient_flags = {k: bool(v) for k, v in flags.items()} if isinstance(flags, dict) else {}
+
+    mode = data.get("quantity_mode", "g")
+    meta = {
+        "nutrient_export_flags": nutrient_flags,
+        "quantity_mode": "g" if mode != "%" else "%",
+        "formula_name": data.get("formula_name", ""),
+        "path": str(path),
+        "respect_existing_formula_name": False,
+    }
+    return base_items, meta
+
+
+def _excel_sheets(path: str | Path) -> Iterator[Iterator[tuple]]:
+    """Row iterators (values only) for the "Ingredientes" sheet first, then the first sheet."""
+    if Path(path).suffix.lower() == ".xls":
+        # openpyxl cannot read legacy .xls; pandas (with xlrd) is only needed for those.
+        import pandas as pd
+
+        frames = pd.read_excel(path, sheet_name=None, header=None)
+        names = [name for name in ("Ingredientes", next(iter(frames), None)) if name in frames]
+        for name in dict.fromkeys(names):
+            frame = frames[name].astype(object).where(frames[name].notna(), None)
+            yield iter(frame.itertuples(index=False, name=None))
+        return
+
+    with XlsxReader(path) as reader:
+        names = reader.sheet_names
+        for name in dict.fromkeys(n for n in ("Ingredientes", names[0] if names else None) if n in names):
+            yield reader.rows(name)
+
+
+def _find_header(rows: List[tuple]) -> tuple[int, int, int] | None:
+    """(row index, FDC column, amount column) of the first row naming both columns."""
+    for row_idx, row in enumerate(rows):
+        # Later duplicates win, as with the former column-label lookup.
+        columns = {normalize_label(value): col for col, value in enumerate(row) if value is not None}
+        fdc_col = next((columns[c] for c in _FDC_CANDIDATES if c in columns), None)
+        amount_col = next((columns[c] for c in _AMOUNT_CANDIDATES if c in columns), None)
+        if fdc_col is not None and amount_col is not None:
+            return row_idx, fdc_col, amount_col
+    return None
+
+
+def _cell(row: tuple, col: int) -> Any:
+    return row[col] if col < len(row) else None
+
+
+def _fdc_value(value: Any) -> int | None:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    try:
+        return int(value)
+    except Exception:
+        return None
+
+
+def _amount_value(value: Any) -> float:
+    if value is None:
+        return 0.0
+    try:
+        amount = float(value)
+    except Exception:
+        return 0.0
+    return 0.0 if math.isnan(amount) else amount
+
+
+def _export_nutrient_columns(head: List[tuple], header_idx: int) -> list[tuple[int, str, str]] | None:
+    """
+    (column, name, unit) of the nutrient columns when the header row is the app's
+    own export layout (base headers, then "Name (unit)" per nutrient); None otherwise.
+    """
+    header = head[header_idx]
+    base_count = len(BASE_HEADERS)
+    labels = [normalize_label(_cell(header, col)) for col in range(base_count)]
+    if labels != [normalize_label(name) for name in BASE_HEADERS]:
+        return None
+    columns: list[tuple[int, str, str]] = []
+    for col in range(base_count, len(header)):
+        value = header[col]
+        if value is None or not str(value).strip():
+            continue
+        name, unit = split_header_unit(str(value).strip())
+        columns.append((col, name, unit))
+    return columns
+
+
+def _sheet_details(row: tuple, fdc_id: int, columns: list[tuple[int, str, str]]) -> Dict[str, Any]:
+    """USDA-like details payload rebuilt from one ingredient row of an exported workbook."""
+    nutrients: list[Dict[str, Any]] = []
+    for col, name, unit in columns:
+        value = _cell(row, col)
+        if value is None or isinstance(value, (bool, str)):
+            continue
+        amount = float(value)
+        if math.isnan(amount):
+            continue
+        nutrients.append({"nutrient": {"name": name, "unitName": unit}, "amount": amount})
+    return {
+        "fdcId": fdc_id,
+        "description": str(_cell(row, 1) or ""),
+        "brandOwner": str(_cell(row, 2) or ""),
+        "dataType": str(_cell(row, 3) or ""),
+        "foodNutrients": nutrients,
+    }
+
+
+def load_state_from_excel(
+    path: str | Path, formula_name: str = ""
+) -> tuple[list[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Read FDC IDs and grams from an Excel sheet; ``formula_name`` defaults to the file stem.
+
+    One read-only pass: the header row is detected within the first rows of the
+    "Ingredientes" sheet (or the first sheet), then only the two columns are read.
+    Workbooks in the app's own export layout also carry each ingredient's nutrients;
+    those rows come back with a ``details`` payload so hydration needs no USDA request.
+    """
+    found_rows = False
+    from_sheet = False
+    base_items: list[Dict[str, Any]] | None = None
+    try:
+        for rows in _excel_sheets(path):
+            head = list(itertools.islice(rows, HEADER_SCAN_ROWS))
+            found_rows = found_rows or any(any(v is not None for v in row) for row in head)
+            header = _find_header(head)
+            if header is None:
+                continue
+            header_idx, fdc_col, amount_col = header
+            nutrient_columns = _export_nutrient_columns(head, header_idx)
+            from_sheet = bool(nutrient_columns)
+            if isinstance(rows, SheetRows) and not from_sheet:
+                rows.max_col = max(fdc_col, amount_col) + 1
+            base_items = []
+            for row in itertools.chain(head[header_idx + 1 :], rows):
+                fdc_int = _fdc_value(_cell(row, fdc_col))
+                if fdc_int is None:
+                    continue
+                base_item = {"fdc_id": fdc_int, "amount_g": _amount_value(_cell(row, amount_col)), "locked": False}
+                if from_sheet:
+                    base_item["details"] = _sheet_details(row, fdc_int, nutrient_columns)
+                base_items.append(base_item)
+            break
+    except Exception as exc:  # noqa: BLE001
+        raise FormulationFileError(
+            "Error al importar", f"No se pudo leer el archivo:\n{exc}", critical=True
+        ) from exc
+
+    if base_items is None:
+        if not found_rows:
+            raise FormulationFileError("Sin datos", "El archivo no tiene filas para importar.")
+        raise FormulationFileError(
+            "Columnas faltantes", "Se requieren columnas FDC ID y Cantidad (g)."
+        )
+
+    if not base_items:
+        raise FormulationFileError(
+            "Sin ingredientes",
+            "No se encontraron filas válidas con FDC ID y Cantidad (g).",
+        )
+
+    meta = {
+        "nutrient_export_flags": {},
+        "quantity_mode": "g",
+        "formula_name": formula_name or Path(path).stem,
+        "path": str(path),
+        "respect_existing_formula_name": True,
+        "nutrients_from_sheet": from_sheet,
+    }
+    return base_items, meta
+
+
+def load_formulation_file(
+    path: str | Path, formula_name: str = ""
+) -> tuple[list[Dict[str, Any]], Dict[str, Any]]:
+    """Dispatch on the file extension (.json state or .xlsx/.xls sheet)."""
+    ext = Path(path).suffix.lower()
+    if ext == ".json":
+        return load_state_from_json(path)
+    if ext in (".xlsx", ".xls"):
+        return load_state_from_excel(path, formula_name)
+    raise FormulationFileError("Formato no soportado", "Selecciona un archivo .json o .xlsx")
+
+
+def find_formulation_files(folder: str | Path, recursive: bool = False) -> list[Path]:
+    """Saved formulations in a folder, sorted by path; Excel lock files are skipped."""
+    root = Path(folder)
+    candidates = root.rglob("*") if recursive else root.glob("*")
+    return sorted(
+        p
+        for p in candidates
+        if p.is_file() and p.suffix.lower() in FORMULATION_EXTENSIONS and not p.name.startswith("~$")
+    )
+
+
+def hydrate_item(
+    base: Dict[str, Any], details: Dict[str, Any], registry: NutrientRegistry | None = None
+) -> Dict[str, Any]:
+    """Build a formulation item from a base item and its USDA details payload."""
+    registry = registry if registry is not None else get_registry()
+    fdc_id = base.get("fdc_id") or details.get("fdcId")
+    try:
+        fdc_id_int = int(fdc_id) if fdc_id is not None else None
+    except Exception:
+        fdc_id_int = fdc_id
+
+    nutrients = augment_fat_nutrients(details.get("foodNutrients", []) or [])
+    registry.update_reference(details)
+    return {
+        "fdc_id": fdc_id_int,
+        "description": details.get("description", "") or base.get("description", ""),
+        "brand": details.get("brandOwner", "") or base.get("brand", ""),
+        "data_type": details.get("dataType", "") or base.get("data_type", ""),
+        "amount_g": float(base.get("amount_g", 0.0) or 0.0),
+        "nutrients": assign_nutrient_ids(
+            normalize_nutrients(nutrients, details.get("dataType")), registry
+        ),
+        "locked": bool(base.get("locked", False)),
+    }
+
+
+def hydrate_items(
+    base_items: List[Dict[str, Any]],
+    max_attempts: int = 4,
+    read_timeout: float = 8.0,
+    fetch: Callable[..., Dict[str, Any]] = get_food_details,
+    registry: NutrientRegistry | None = None,
+) -> list[Dict[str, Any]]:
+    """
+    Fetch USDA details for each base item (with retries) and build formulation items.
+
+    Items that already carry a ``details`` payload (re-imported exports) are not fetched.
+    """
+    hydrated: list[Dict[str, Any]] = []
+    for item in base_items:
+        fdc_id = int(item.get("fdc_id"))
+        details = item.get("details")
+        attempts = 0
+        while details is None:
+            attempts += 1
+            try:
+                details = fetch(fdc_id, timeout=(3.05, read_timeout), detail_format="abridged")
+                break
+            except Exception:
+                if attempts >= max_attempts:
+                    raise
+                time.sleep(min(2.0, 0.25 * attempts))
+        hydrated.append(hydrate_item({**item, "fdc_id": fdc_id}, details, registry))
+    return hydrated
+
+
+def sheet_mismatches(
+    items: List[Dict[str, Any]],
+    fetch: Callable[..., Dict[str, Any]] = get_food_details,
+    registry: NutrientRegistry | None = None,
+    rel_tol: float = 1e-6,
+) -> list[int]:
+    """
+    FDC IDs whose nutrient values (as read from a sheet) differ from the cached USDA details.
+
+    Only foods already in the cache are compared, so this never triggers a request.
+    """
+    registry = registry if registry is not None else get_registry()
+    mismatches: list[int] = []
+    for item in items:
+        fdc_id = item.get("fdc_id")
+        if fdc_id is None or not has_cached_food(int(fdc_id), "abridged"):
+            continue
+        cached = hydrate_item({"fdc_id": fdc_id}, fetch(int(fdc_id), detail_format="abridged"), registry)
+        nids = sorted(
+            {
+                registry.resolve_entry(entry)
+                for entry in item.get("nutrients", [])
+                if entry.get("amount") is not None
+            }
+            - {None}
+        )
+        column_by_nid = {nid: column for column, nid in enumerate(nids)}
+        sheet_values = nutrient_cells(item.get("nutrients", []), column_by_nid, len(nids), registry)
+        cached_values = nutrient_cells(cached["nutrients"], column_by_nid, len(nids), registry)
+        for sheet_value, cached_value in zip(sheet_values, cached_values):
+            if sheet_value is None:
+                continue
+            if cached_value is None or not math.isclose(sheet_value, cached_value, rel_tol=rel_tol, abs_tol=1e-9):
+                mismatches.append(int(fdc_id))
+                break
+    return mismatches
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Sequence
+
+import numpy as np
+from scipy.optimize import linprog
+
+from services.formulation_engine import FormulationEngine
+from services.nutrient_registry import NutrientRegistry, get_registry
+from services.percent_solver import TOLERANCE, InfeasiblePercents
+
+OBJECTIVES = ("closest", "maximize", "minimize")
+
+
+@dataclass(frozen=True)
+class NutrientTarget:
+    """Bound on a nutrient total per 100 g of product; ``key`` is the registry header key ("protein|g")."""
+
+    key: str
+    minimum: float | None = None
+    maximum: float | None = None
+
+
+@dataclass(frozen=True)
+class OptimizationResult:
+    # Percent of each ingredient in the product (sums to 100), in item order.
+    percents: np.ndarray
+    # Totals per 100 g of the targeted and objective nutrients: key -> amount.
+    totals: Dict[str, float]
+    objective: float
+    elapsed: float
+
+
+def optimize_formulation(
+    engine: FormulationEngine,
+    targets: List[NutrientTarget],
+    minimum: Sequence[float] | None = None,
+    maximum: Sequence[float] | None = None,
+    locked: Sequence[bool] | None = None,
+    objective: str = "closest",
+    objective_key: str | None = None,
+    registry: NutrientRegistry | None = None,
+) -> OptimizationResult:
+    """
+    Percentages meeting every nutrient target, solved as one linear program (HiGHS).
+
+    Totals per 100 g are linear in the percentages (the engine matrix divided by 100),
+    so bounds on them are plain inequality rows. ``objective`` is "closest" (least
+    total absolute change from the current recipe) or "maximize"/"minimize" the total
+    of ``objective_key``. Percent bounds default to 0-100; locked items keep their
+    current percentage. Nutrients an ingredient does not report count as 0.
+    Raises InfeasiblePercents naming the targets that cannot be met.
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective: {objective}")
+    if objective != "closest" and not objective_key:
+        raise ValueError("objective_key is required to maximize or minimize a nutrient")
+    started = time.perf_counter()
+    registry = registry if registry is not None else get_registry()
+    amounts = engine.amounts
+    count = len(amounts)
+    if count == 0:
+        raise InfeasiblePercents("Sin ingredientes", "Agrega ingredientes antes de optimizar.")
+    total = float(amounts.sum())
+    current = amounts * 100.0 / total if total > 0 else np.full(count, 100.0 / count)
+
+    lower = np.zeros(count) if minimum is None else np.asarray(minimum, dtype=float).copy()
+    upper = np.full(count, 100.0) if maximum is None else np.asarray(maximum, dtype=float).copy()
+    if locked is not None:
+        fixed = np.asarray(locked, dtype=bool)
+        lower[fixed] = upper[fixed] = current[fixed]
+    if lower.sum() > 100.0 + TOLERANCE or upper.sum() < 100.0 - TOLERANCE:
+        raise InfeasiblePercents(
+            "Límites incompatibles",
+            f"Los límites de los ingredientes permiten entre {lower.sum():.2f} % y "
+            f"{upper.sum():.2f} % en total; deben poder sumar 100 %.",
+        )
+
+    keys = [target.key for target in targets]
+    if objective_key:
+        keys.append(objective_key)
+    # Nutrient value of 1 % of each ingredient, one column per key.
+    values = _per_percent_values(engine, keys, registry)
+
+    rows: list[np.ndarray] = []
+    bounds_ub: list[float] = []
+    for index, target in enumerate(targets):
+        if target.minimum is not None:
+            rows.append(-values[:, index])
+            bounds_ub.append(-target.minimum)
+        if target.maximum is not None:
+            rows.append(values[:, index])
+            bounds_ub.append(target.maximum)
+
+    nutrient_rows = np.array(rows).reshape(-1, count)
+    if objective == "closest":
+        # Variables [x, d] with d_i >= |x_i - current_i|; minimize sum(d).
+        identity = np.eye(count)
+        a_ub = np.block(
+            [
+                [nutrient_rows, np.zeros_like(nutrient_rows)],
+                [identity, -identity],
+                [-identity, -identity],
+            ]
+        )
+        b_ub = np.concatenate([bounds_ub, current, -current])
+        cost = np.concatenate([np.zeros(count), np.ones(count)])
+        a_eq = np.concatenate([np.ones(count), np.zeros(count)])[None, :]
+        bounds = list(zip(lower, upper)) + [(0.0, None)] * count
+    else:
+        sign = -1.0 if objective == "maximize" else 1.0
+        a_ub = nutrient_rows if rows else None
+        b_ub = np.array(bounds_ub) if rows else None
+        cost = sign * values[:, -1]
+        a_eq = np.ones((1, count))
+        bounds = list(zip(lower, upper))
+
+    result = linprog(
+        cost, A_ub=a_ub, b_ub=b_ub, A_eq=a_eq, b_eq=[100.0], bounds=bounds, method="highs"
+    )
+    if result.status == 2:
+        raise InfeasiblePercents(
+            "Sin solución", _explain_infeasible(targets, values, lower, upper, registry)
+        )
+    if not result.success:
+        raise InfeasiblePercents("Sin solución", f"El optimizador no encontró una mezcla: {result.message}")
+
+    percents = np.clip(result.x[:count], lower, upper)
+    totals = {key: float(percents @ values[:, col]) for col, key in enumerate(keys)}
+    objective_value = float(result.fun) if objective != "maximize" else -float(result.fun)
+    return OptimizationResult(percents, totals, objective_value, time.perf_counter() - started)
+
+
+def _per_percent_values(
+    engine: FormulationEngine, keys: List[str], registry: NutrientRegistry
+) -> np.ndarray:
+    """items x keys: contribution of 1 % of each ingredient to the total per 100 g."""
+    column_by_nid = {nid: column for column, nid in enumerate(engine.nutrient_ids)}
+    matrix = engine.matrix
+    values = np.zeros((matrix.shape[0], len(keys)))
+    for index, key in enumerate(keys):
+        column = column_by_nid.get(registry.id_for_key(key))
+        if column is not None:
+            values[:, index] = matrix[:, column] / 100.0
+    return values
+
+
+def _reachable(values: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> tuple[float, float]:
+    """Lowest and highest total of one nutrient with percents in bounds adding up to 100."""
+    room = 100.0 - lower.sum()
+    span = upper - lower
+    extremes = []
+    for order in (np.argsort(values), np.argsort(-values)):
+        # Fill the remaining percent with the lowest (or highest) contributors first.
+        taken = np.clip(room - (np.cumsum(span[order]) - span[order]), 0.0, span[order])
+        extremes.append(float(lower @ values + taken @ values[order]))
+    return extremes[0], extremes[1]
+
+
+def _explain_infeasible(
+    targets: List[NutrientTarget],
+    values: np.ndarray,
+    lower: np.ndarray,
+    upper: np.ndarray,
+    registry: NutrientRegistry,
+) -> str:
+    problems: list[str] = []
+    for index, target in enumerate(targets):
+        low, high = _reachable(values[:, index], lower, upper)
+        nid = registry.id_for_key(target.key)
+        label = target.key
+        if nid is not None:
+            info = registry.info(nid)
+            label = f"{info.name} ({info.unit})"
+        if target.minimum is not None and high < target.minimum - TOLERANCE:
+            problems.append(f"{label}: como máximo {high:.3g} por 100 g, se pidió al menos {target.minimum:g}.")
+        if target.maximum is not None and low > target.maximum + TOLERANCE:
+            problems.append(f"{label}: como mínimo {low:.3g} por 100 g, se pidió como máximo {target.maximum:g}.")
+    if problems:
+        return "\n".join(problems)
+    return (
+        "Cada meta se puede cumplir por separado, pero no todas a la vez con estos "
+        "ingredientes. Relaja alguna meta o amplía los límites de los ingredientes."
+    )
@@ -0,0 +1,423 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from fractions import Fraction
+from typing import Any, Dict, List, Mapping
+
+from services.formulation_engine import FormulationEngine
+from services.nutrient_normalizer import normalize_nutrients
+from services.nutrient_registry import NutrientRegistry, assign_nutrient_ids, get_registry
+from services.nutrition_label import (
+    ADDITIONAL_LABEL_NUTRIENTS,
+    BASE_LABEL_NUTRIENTS,
+    NO_SIGNIFICANT_DISPLAY_MAP,
+    LabelEvaluation,
+    LabelSettings,
+    effective_label_nutrient,
+    evaluate_label,
+    sort_no_significant,
+)
+
+# ---- Static label texts ----
+LABEL_TITLE = "INFORMACIÓN NUTRICIONAL"
+AMOUNT_HEADER = "Cantidad por porción"
+VD_HEADER = "% VD(*)"
+TABLE_FOOTER = (
+    "*% Valores Diarios con base a una dieta de 2000 kcal u 8400 kJ. "
+    "Sus valores diarios pueden ser mayores o menores dependiendo de sus necesidades energéticas."
+)
+LINEAR_FOOTER = (
+    " (*) % Valores Diarios con base a una dieta de 2.000 kcal u 8.400 kJ. "
+    "Sus valores diarios pueden ser mayores o menores dependiendo de sus necesidades energéticas."
+)
+
+# Household measures and their capacity in ml (None: no fixed capacity).
+HOUSEHOLD_MEASURE_OPTIONS: list[tuple[str, int | None]] = [
+    ("Taza de té", 200),
+    ("Vaso", 200),
+    ("Cuchara de sopa", 10),
+    ("Cuchara de té", 5),
+    ("Plato hondo", 250),
+    ("Unidad", None),
+    ("Otro", None),
+]
+
+# Carbohydrate breakdown rows that are left out when they are zero.
+_HIDE_ZERO_CARB = frozenset({"Polialcoholes", "Polidextrosas"})
+_ADDITIONAL_BY_NAME = {nutrient["name"]: nutrient for nutrient in ADDITIONAL_LABEL_NUTRIENTS}
+
+
+@dataclass(frozen=True)
+class LabelRow:
+    """One nutrient row of the label table, already formatted for the portion."""
+
+    name: str
+    amount_text: str
+    vd_text: str
+    indent_level: int = 0
+    manual: bool = False
+    breakdown_child: bool = False
+    additional: bool = False
+
+    @property
+    def display_name(self) -> str:
+        return ("    " * self.indent_level) + self.name
+
+
+@dataclass(frozen=True)
+class NutritionLabel:
+    """Formatted nutrition label: table rows plus the linear (single paragraph) text."""
+
+    evaluation: LabelEvaluation
+    portion_text: str
+    rows: tuple[LabelRow, ...]
+    no_significant_note: str
+    linear_text: str
+    title: str = LABEL_TITLE
+    amount_header: str = AMOUNT_HEADER
+    vd_header: str = VD_HEADER
+    footer: str = TABLE_FOOTER
+
+    @property
+    def settings(self) -> LabelSettings:
+        return self.evaluation.settings
+
+
+# ---- Number formatting ----
+def format_fraction_amount(value: float) -> str:
+    if value <= 0:
+        return ""
+    frac = Fraction(value).limit_denominator(12)
+    whole, remainder = divmod(frac.numerator, frac.denominator)
+    if remainder == 0:
+        return str(whole)
+    if whole == 0:
+        return f"{remainder}/{frac.denominator}"
+    return f"{whole} {remainder}/{frac.denominator}"
+
+
+def fraction_from_ratio(ratio: float) -> str:
+    """Household amount for portion/capacity, rounded to the usual label fractions."""
+    percent = ratio * 100.0
+    if percent <= 30:
+        return "1/4"
+    if percent <= 70:
+        return "1/2"
+    if percent <= 130:
+        return "1"
+    if percent <= 170:
+        return "1 1/2"
+    if percent <= 230:
+        return "2"
+    return format_fraction_amount(ratio)
+
+
+def format_number_for_unit(value: float, unit: str) -> str:
+    if math.isclose(value, 0.0, abs_tol=1e-9):
+        return f"0 {unit}".strip()
+    if unit == "mg":
+        return f"{value:.0f} mg"
+    if unit == "g":
+        if abs(value) < 10:
+            return f"{value:.1f} g"
+        return f"{value:.0f} g"
+    if value >= 10:
+        return f"{value:.0f} {unit}"
+    if value >= 1:
+        return f"{value:.1f} {unit}"
+    return f"{value:.2f} {unit}"
+
+
+def format_additional_amount(value: float, unit: str) -> str:
+    unit = unit.lower()
+    if unit == "mg":
+        if math.isclose(value, 0.0, abs_tol=1e-9):
+            return "0 mg"
+        if value < 10:
+            return f"{value:.1f} mg"
+        return f"{value:.0f} mg"
+    if unit in ("µg", "ug"):
+        if math.isclose(value, 0.0, abs_tol=1e-9):
+            return "0 µg"
+        if value < 10:
+            return f"{value:.1f} µg"
+        return f"{value:.0f} µg"
+    return format_number_for_unit(value, unit)
+
+
+def format_nutrient_amount(nutrient: Mapping[str, Any], factor: float) -> str:
+    if nutrient.get("type") == "energy":
+        kcal_val = nutrient.get("kcal", 0.0) * factor
+        kj_val = nutrient.get("kj", 0.0) * factor
+        return f"{kcal_val:.0f} kcal = {kj_val:.0f} kJ"
+    amount = nutrient.get("amount", 0.0) * factor
+    return format_number_for_unit(amount, nutrient.get("unit", ""))
+
+
+def format_vd_value(
+    nutrient: Mapping[str, Any], factor: float, effective_amount: float | None = None
+) -> str:
+    vd_percent = nutrient.get("vd")
+    base_amount = nutrient.get("vd_reference", nutrient.get("amount", 0.0))
+    eff_amount = effective_amount if effective_amount is not None else nutrient.get("amount", 0.0)
+    if nutrient.get("type") == "energy":
+        base_amount = nutrient.get("vd_reference", nutrient.get("kcal", 0.0))
+        eff_amount = effective_amount if effective_amount is not None else nutrient.get("kcal", 0.0)
+
+    portion_amount = eff_amount * factor
+    if vd_percent is None and base_amount and base_amount > 0:
+        vd_val = portion_amount * 100.0 / base_amount
+    elif vd_percent is not None and base_amount and base_amount > 0:
+        vd_val = vd_percent * (portion_amount / base_amount)
+    else:
+        return "-"
+    return f"{vd_val:.0f}%"
+
+
+def format_manual_amount(nutrient: Mapping[str, Any], manual_amount: float) -> str:
+    if nutrient.get("type") == "energy":
+        kj_val = manual_amount * 4.184
+        return f"{manual_amount:.0f} kcal = {kj_val:.0f} kJ"
+    return format_number_for_unit(manual_amount, nutrient.get("unit", ""))
+
+
+def format_manual_vd(nutrient: Mapping[str, Any], manual_amount: float) -> str:
+    vd_ref = nutrient.get("vd")
+    if vd_ref is None:
+        return "-"
+    base_amount = nutrient.get("kcal") if nutrient.get("type") == "energy" else nutrient.get("amount")
+    if not base_amount:
+        return "-"
+    vd_val = vd_ref * (manual_amount / base_amount)
+    if vd_val >= 10:
+        return f"{vd_val:.0f}%"
+    return f"{vd_val:.1f}%"
+
+
+def human_join(items: List[str]) -> str:
+    if not items:
+        return ""
+    if len(items) == 1:
+        return items[0]
+    return ", ".join(items[:-1]) + " y " + items[-1]
+
+
+def portion_description(settings: LabelSettings) -> str:
+    """'Porción 30 g (1 Cuchara de sopa)' as printed under the label title."""
+    size = float(settings.portion_size or 0)
+    portion_value = int(size) if size.is_integer() else f"{size:g}"
+    measure_display = (
+        settings.household_unit
+        if not settings.household_amount
+        else f"{settings.household_amount} {settings.household_unit}"
+    )
+    return f"Porción {portion_value} {settings.portion_unit} ({measure_display})"
+
+
+def no_significant_note(names: List[str] | tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    display = [NO_SIGNIFICANT_DISPLAY_MAP.get(name, name) for name in sort_no_significant(names)]
+    return f"No aporta cantidades significativas de {human_join(display)}."
+
+
+# ---- Label assembly ----
+def active_label_nutrients(
+    settings: LabelSettings, no_significant: List[str] | tuple[str, ...] = ()
+) -> list[Dict[str, Any]]:
+    """Base nutrients shown for the breakdown settings, with their ``indent_level``."""
+    display: list[Dict[str, Any]] = []
+    for nutrient in BASE_LABEL_NUTRIENTS:
+        if nutrient.get("name", "") in no_significant:
+            continue
+        if nutrient.get("fat_breakdown_only") and not settings.breakdown_fat:
+            continue
+        if nutrient.get("carb_breakdown_only") and not settings.breakdown_carb:
+            continue
+        entry = dict(nutrient)
+        indent = 0
+        if (
+            (settings.breakdown_fat and entry.get("fat_child") and not entry.get("fat_parent"))
+            or (settings.breakdown_carb and entry.get("carb_child") and not entry.get("carb_parent"))
+        ):
+            indent = 1
+        entry["indent_level"] = indent
+        display.append(entry)
+    return display
+
+
+def _effective_for(evaluation: LabelEvaluation, nutrient: Dict[str, Any]) -> Dict[str, Any]:
+    cached = evaluation.effective.get(nutrient.get("name", ""))
+    if cached is not None:
+        return cached
+    return effective_label_nutrient(evaluation.totals, nutrient, evaluation.settings)
+
+
+def _amount_and_vd(
+    effective: Mapping[str, Any], settings: LabelSettings, manual_map: Mapping[str, float]
+) -> tuple[str, str]:
+    if effective.get("manual"):
+        manual_amount = manual_map.get(effective.get("name", ""), 0.0)
+        return format_manual_amount(effective, manual_amount), format_manual_vd(effective, manual_amount)
+    factor = settings.portion_factor
+    eff_amount = (
+        effective.get("kcal", 0.0) if effective.get("type") == "energy" else effective.get("amount", 0.0)
+    )
+    return format_nutrient_amount(effective, factor), format_vd_value(effective, factor, eff_amount)
+
+
+def _linear_part(name: str, amount: str, vd: str) -> str:
+    vd_suffix = "" if vd in ("", "-") else f" ({vd} VD*)"
+    return f"{name} {amount}{vd_suffix}"
+
+
+def build_label_from_evaluation(evaluation: LabelEvaluation) -> NutritionLabel:
+    """Format an evaluated label into table rows and linear text (no Qt involved)."""
+    settings = evaluation.settings
+    manual_map = settings.manual_map
+    factor = settings.portion_factor
+    breakdown_fat = settings.breakdown_fat
+    breakdown_carb = settings.breakdown_carb
+
+    # (base nutrient, effective nutrient, amount text, vd text) for every shown base row.
+    shown: list[tuple[Dict[str, Any], Dict[str, Any], str, str]] = []
+    carb_children_present = False
+    for nutrient in active_label_nutrients(settings, evaluation.no_significant):
+        effective = _effective_for(evaluation, nutrient)
+        name = effective.get("name", nutrient.get("name", ""))
+        if (
+            nutrient.get("carb_child")
+            and name in _HIDE_ZERO_CARB
+            and math.isclose(effective.get("amount", 0.0) or 0.0, 0.0, abs_tol=1e-9)
+        ):
+            continue
+        if nutrient.get("carb_child") and not nutrient.get("carb_parent"):
+            carb_children_present = True
+        amount, vd = _amount_and_vd(effective, settings, manual_map)
+        shown.append((nutrient, effective, amount, vd))
+
+    rows: list[LabelRow] = []
+    parts: list[str] = []
+    fat_children: list[str] = []
+    fat_parent: tuple[int, str] | None = None
+    carb_children: list[str] = []
+    carb_parent: tuple[int, str] | None = None
+    for nutrient, effective, amount, vd in shown:
+        name = effective.get("name", nutrient.get("name", ""))
+        fat_child = bool(breakdown_fat and nutrient.get("fat_child") and not nutrient.get("fat_parent"))
+        carb_child = bool(breakdown_carb and nutrient.get("carb_child") and not nutrient.get("carb_parent"))
+
+        table_amount = amount
+        if breakdown_fat and nutrient.get("fat_parent"):
+            table_amount = f"{table_amount}, de las cuales"
+        if breakdown_carb and nutrient.get("carb_parent") and carb_children_present:
+            table_amount = f"{table_amount}, de los cuales"
+        rows.append(
+            LabelRow(
+                name=name,
+                amount_text=table_amount,
+                vd_text=vd,
+                indent_level=nutrient.get("indent_level", 0),
+                manual=bool(effective.get("manual")),
+                breakdown_child=fat_child or carb_child,
+            )
+        )
+
+        line_text = _linear_part(nutrient.get("name", ""), amount, vd)
+        if fat_child:
+            fat_children.append(line_text)
+        elif breakdown_fat and nutrient.get("fat_parent"):
+            fat_parent = (len(parts), line_text)
+        elif carb_child:
+            carb_children.append(line_text)
+        elif breakdown_carb and nutrient.get("carb_parent"):
+            carb_parent = (len(parts), line_text)
+        else:
+            parts.append(line_text)
+
+    # Breakdown parents become one "parent, de los cuales: child, child" block in place.
+    for parent, children in ((fat_parent, fat_children), (carb_parent, carb_children)):
+        if parent is None:
+            continue
+        insert_idx, block = parent
+        if children:
+            block = f"{block}, de los cuales: " + ", ".join(children)
+        parts.insert(insert_idx, block)
+
+    for add_name in settings.additional_selected:
+        nutrient = _ADDITIONAL_BY_NAME.get(add_name)
+        if not nutrient:
+            continue
+        effective = _effective_for(evaluation, nutrient)
+        eff_amount = effective.get("amount", 0.0) or 0.0
+        amount = format_additional_amount(eff_amount * factor, nutrient.get("unit", ""))
+        vd = format_vd_value(effective, factor, eff_amount)
+        rows.append(
+            LabelRow(
+                name=add_name,
+                amount_text=amount,
+                vd_text=vd,
+                manual=bool(effective.get("manual")),
+                additional=True,
+            )
+        )
+        parts.append(_linear_part(add_name, amount, vd))
+
+    portion_text = portion_description(settings)
+    note = no_significant_note(evaluation.no_significant)
+    linear_text = (
+        "Información Nutricional: "
+        f"{portion_text}. "
+        + "; ".join(parts)
+        + ";"
+        + (f" {note}" if note else "")
+        + LINEAR_FOOTER
+    )
+    return NutritionLabel(
+        evaluation=evaluation,
+        portion_text=portion_text,
+        rows=tuple(rows),
+        no_significant_note=note,
+        linear_text=linear_text,
+    )
+
+
+def build_label(
+    totals: Mapping[str, Dict[str, Any]],
+    settings: LabelSettings,
+    totals_version: int | None = None,
+) -> NutritionLabel:
+    """Evaluate and format the label for a totals mapping (per 100 g of product)."""
+    return build_label_from_evaluation(evaluate_label(totals, settings, totals_version))
+
+
+def formulation_totals(
+    items: List[Dict[str, Any]], registry: NutrientRegistry | None = None
+) -> Dict[str, Dict[str, Any]]:
+    """Totals per 100 g for formulation item dicts (``amount_g`` + USDA ``nutrients``)."""
+    registry = registry if registry is not None else get_registry()
+    # Stamped IDs belong to the process-wide registry; any other registry re-stamps.
+    trust_ids = registry is get_registry()
+    prepared: list[Dict[str, Any]] = []
+    for item in items:
+        nutrients = item.get("nutrients", []) or []
+        # Entries stamped with a registry ID were already normalized; leave the caller's dicts alone.
+        if nutrients and not (trust_ids and all("nid" in entry for entry in nutrients)):
+            normalized = assign_nutrient_ids(
+                normalize_nutrients(nutrients, item.get("data_type")), registry
+            )
+            item = {**item, "nutrients": normalized}
+        prepared.append(item)
+    engine = FormulationEngine(registry)
+    engine.sync(prepared)
+    return engine.totals()
+
+
+def build_label_for_items(
+    items: List[Dict[str, Any]],
+    settings: LabelSettings,
+    registry: NutrientRegistry | None = None,
+) -> NutritionLabel:
+    """Label for a formulation given as item dicts, e.g. one SKU of a batch run."""
+    return build_label(formulation_totals(items, registry), settings)
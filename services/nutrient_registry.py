@@ -0,0 +1,486 @@
+from __future__ import annotations
+
+import csv
+import logging
+import re
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List
+
+from services.nutrient_normalizer import canonical_alias_name, canonical_unit
+
+
+_METADATA_PATH = Path(__file__).resolve().parent / "data" / "nutrient_metadata.csv"
+
+
+@dataclass(frozen=True)
+class NutrientMetadata:
+    """One row of the shipped nutrient table (USDA number, canonical name, unit, category, rank)."""
+
+    number: str
+    name: str
+    unit: str
+    category: str
+    rank: float
+
+
+def _load_metadata(path: Path = _METADATA_PATH) -> list[NutrientMetadata]:
+    """Read the prebuilt nutrient table; an unreadable file leaves only the heuristics."""
+    rows: list[NutrientMetadata] = []
+    try:
+        with path.open(newline="", encoding="utf-8") as fh:
+            for row in csv.DictReader(fh):
+                try:
+                    rank = float(row.get("rank") or "")
+                except ValueError:
+                    continue
+                rows.append(
+                    NutrientMetadata(
+                        number=(row.get("number") or "").strip(),
+                        name=(row.get("name") or "").strip(),
+                        unit=(row.get("unit") or "").strip(),
+                        category=(row.get("category") or "").strip(),
+                        rank=rank,
+                    )
+                )
+    except OSError as exc:
+        logging.warning("No se pudo leer %s: %s", path, exc)
+    return rows
+
+
+def _catalog_from_metadata(rows: list[NutrientMetadata]) -> list[tuple[str, list[str]]]:
+    """Group metadata rows into the ordered (category, names) catalog."""
+    grouped: Dict[str, list[str]] = {}
+    for row in sorted(rows, key=lambda r: r.rank):
+        names = grouped.setdefault(row.category, [])
+        if row.name not in names:
+            names.append(row.name)
+    return list(grouped.items())
+
+
+NUTRIENT_METADATA: list[NutrientMetadata] = _load_metadata()
+METADATA_BY_NUMBER: Dict[str, NutrientMetadata] = {
+    row.number: row for row in NUTRIENT_METADATA if row.number
+}
+METADATA_BY_NAME: Dict[str, NutrientMetadata] = {}
+_AMBIGUOUS_UNIT_NAMES: set[str] = set()
+for _row in NUTRIENT_METADATA:
+    _lower = _row.name.lower()
+    if _lower in METADATA_BY_NAME and METADATA_BY_NAME[_lower].unit != _row.unit:
+        _AMBIGUOUS_UNIT_NAMES.add(_lower)
+    METADATA_BY_NAME.setdefault(_lower, _row)
+NUTRIENT_CATALOG: list[tuple[str, list[str]]] = _catalog_from_metadata(NUTRIENT_METADATA)
+
+_AMINO_ACIDS = {
+    "tryptophan",
+    "threonine",
+    "isoleucine",
+    "leucine",
+    "lysine",
+    "methionine",
+    "phenylalanine",
+    "tyrosine",
+    "valine",
+    "arginine",
+    "histidine",
+    "alanine",
+    "aspartic acid",
+    "glutamic acid",
+    "glycine",
+    "proline",
+    "serine",
+    "hydroxyproline",
+    "cysteine",
+    "cystine",
+}
+_ORGANIC_ACIDS = {"citric acid", "malic acid", "oxalic acid", "quinic acid"}
+_OLIGOSACCHARIDES = {"raffinose", "stachyose", "verbascose"}
+_ISOFLAVONES = {"daidzein", "genistein", "daidzin", "genistin", "glycitin"}
+_VITAMIN_HINTS = (
+    "tocopherol",
+    "tocotrienol",
+    "carotene",
+    "lycopene",
+    "lutein",
+    "zeaxanthin",
+    "retinol",
+    "folate",
+    "folic acid",
+    "betaine",
+    "choline",
+    "caffeine",
+    "theobromine",
+)
+_MACRO_UNIT_HINTS = (
+    "water",
+    "protein",
+    "lipid",
+    "fat",
+    "ash",
+    "carbohydrate",
+    "fiber",
+    "sugar",
+    "starch",
+    "nitrogen",
+    "fatty acids",
+    "sfa",
+    "mufa",
+    "pufa",
+)
+_GRAM_NAMES = _AMINO_ACIDS | {
+    "sucrose",
+    "glucose",
+    "fructose",
+    "lactose",
+    "maltose",
+    "galactose",
+    "alcohol, ethyl",
+}
+_LABEL_UNIT_RE = re.compile(r"(?i)(mg|g|µg|ug|kcal|kj)")
+_TRAILING_PAREN_RE = re.compile(r"\(([^()]*)\)\s*$")
+
+
+@dataclass(frozen=True)
+class NutrientInfo:
+    """Resolved, cached metadata for one interned nutrient."""
+
+    nid: int
+    key: str
+    name: str
+    unit: str
+    header: str
+    category: str
+    order: float | None
+
+
+def nutrient_key(nutrient: Dict[str, Any]) -> str:
+    """
+    Build a consistent key for nutrients, preferring id then number then name.
+    This avoids duplicates when some records lack unitName (Foundation vs SR).
+    """
+    name_lower = (nutrient.get("name") or "").strip().lower()
+    unit_lower = (nutrient.get("unitName") or "").strip().lower()
+    # Special-case Energy to keep kcal/kJ separated when ids/numbers are missing.
+    if name_lower == "energy" and unit_lower:
+        return f"energy:{unit_lower}"
+    # Special-case Water to merge branded-calculated (no id) with USDA water (id present).
+    if name_lower == "water":
+        return f"water|{unit_lower}"
+    if "id" in nutrient and nutrient["id"] is not None:
+        return f"id:{nutrient['id']}"
+    if nutrient.get("number"):
+        return f"num:{nutrient['number']}"
+    return f"name:{name_lower}" if name_lower else ""
+
+
+def infer_unit(nutrient: Dict[str, Any]) -> str:
+    """Try to fill missing unit from the metadata table or heuristic defaults."""
+    unit = nutrient.get("unitName")
+    if unit:
+        return unit
+
+    number = str(nutrient.get("number") or "").strip()
+    meta = METADATA_BY_NUMBER.get(number)
+    if meta is not None and meta.unit:
+        return meta.unit
+
+    name = (nutrient.get("name") or "").strip().lower()
+    meta = METADATA_BY_NAME.get(name)
+    if meta is not None and meta.unit and name not in _AMBIGUOUS_UNIT_NAMES:
+        return meta.unit
+    return _heuristic_unit(name)
+
+
+@lru_cache(maxsize=None)
+def _heuristic_unit(name: str) -> str:
+    """Guess a unit for nutrients missing from the metadata table."""
+    if "energy" in name and "kcal" in name:
+        return "kcal"
+    if "energy" in name and "kj" in name:
+        return "kJ"
+    if any(hint in name for hint in _MACRO_UNIT_HINTS) or ":" in name:
+        return "g"
+    if name in _GRAM_NAMES:
+        return "g"
+    return ""
+
+
+@lru_cache(maxsize=None)
+def _heuristic_category(lower: str) -> str | None:
+    """Guess a category for nutrients missing from the metadata table."""
+    if lower.startswith("vitamin ") or any(hint in lower for hint in _VITAMIN_HINTS):
+        return "Vitamins and Other Components"
+    if lower in _AMINO_ACIDS:
+        return "Amino acids"
+    if (
+        "fatty acids" in lower
+        or lower.startswith(("sfa ", "mufa ", "pufa "))
+        or lower in {"cholesterol", "total lipid (fat)", "total fat (nlea)"}
+    ):
+        return "Lipids"
+    if "sterol" in lower:
+        return "Phytosterols"
+    if lower in _ORGANIC_ACIDS or (lower.endswith("acid") and lower not in _AMINO_ACIDS):
+        return "Organic acids"
+    if lower in _OLIGOSACCHARIDES:
+        return "Oligosaccharides"
+    if lower in _ISOFLAVONES:
+        return "Isoflavones"
+    return None
+
+
+def header_parts(nutrient: Dict[str, Any]) -> tuple[str, str, str]:
+    """Return a stable header key plus canonical name and unit for a raw nutrient."""
+    name = canonical_alias_name(nutrient.get("name", "") or "")
+    unit = canonical_unit(nutrient.get("unitName") or infer_unit(nutrient) or "")
+    unit_part = unit.strip().lower()
+    name_part = name.strip().lower()
+    if name_part:
+        return f"{name_part}|{unit_part}", name, unit
+    base_key = nutrient_key(nutrient)
+    if not base_key:
+        return "", name, unit
+    return f"{base_key}|{unit_part}", name, unit
+
+
+def parse_label_mapping(mapped: str) -> tuple[str, str]:
+    """Split a label mapping like 'Sodium, Na (mg)' into canonical name and unit."""
+    mapped_clean = (mapped or "").strip()
+    if not mapped_clean:
+        return "", ""
+    # Si el paréntesis final es una unidad, úsalo; de lo contrario, ignora paréntesis de aclaración.
+    m = _TRAILING_PAREN_RE.search(mapped_clean)
+    if m:
+        unit_candidate = m.group(1).strip()
+        if _LABEL_UNIT_RE.fullmatch(unit_candidate):
+            base = mapped_clean[: m.start()].strip()
+            return canonical_alias_name(base), canonical_unit(unit_candidate)
+    return canonical_alias_name(mapped_clean), ""
+
+
+class NutrientRegistry:
+    """
+    Intern nutrients to small integer IDs resolved once per raw (name, unit, number, id).
+    Canonical name/unit, header key, category and catalog order are cached
+    per ID so hot loops only touch integers.
+    """
+
+    def __init__(self, catalog: list[tuple[str, list[str]]] | None = None) -> None:
+        self._lock = threading.RLock()
+        self._raw_to_id: Dict[tuple[Any, ...], int | None] = {}
+        self._key_to_id: Dict[str, int] = {}
+        self._infos: List[NutrientInfo] = []
+        self._samples: List[Dict[str, Any]] = []
+        self._reference: Dict[str, Dict[str, Any]] = {}
+        self.version = 0
+        self.catalog: list[tuple[str, list[str]]] = []
+        self.category_order: list[str] = []
+        self.catalog_order: Dict[str, int] = {}
+        self.catalog_category: Dict[str, str] = {}
+        self.set_catalog(catalog or NUTRIENT_CATALOG)
+
+    # ---- Static metadata ----
+    def set_catalog(self, catalog: list[tuple[str, list[str]]]) -> None:
+        with self._lock:
+            self.catalog = catalog
+            self.category_order = [cat for cat, _ in catalog]
+            self.catalog_order = {}
+            self.catalog_category = {}
+            for idx, (category, names) in enumerate(catalog):
+                for offset, name in enumerate(names):
+                    lower = name.strip().lower()
+                    self.catalog_order[lower] = idx * 1000 + offset
+                    self.catalog_category[lower] = category
+            self._refresh_metadata()
+
+    def update_reference(self, details: Dict[str, Any]) -> None:
+        """Update reference rank/category map from a full USDA response."""
+        nutrients = details.get("foodNutrients", []) or []
+        if not nutrients:
+            return
+        changed = False
+        with self._lock:
+            current_category: str | None = None
+            for entry in nutrients:
+                nut = entry.get("nutrient") or {}
+                key = nutrient_key(nut)
+                if not key:
+                    continue
+                info = {
+                    "rank": nut.get("rank"),
+                    "category": current_category,
+                    "unit": nut.get("unitName"),
+                }
+                if entry.get("amount") is None:
+                    # category row
+                    current_category = (nut.get("name") or "").strip() or current_category
+                    info["category"] = current_category
+                    if key not in self._reference:
+                        self._reference[key] = info
+                        changed = True
+                    continue
+                if self._reference.get(key) != info:
+                    self._reference[key] = info
+                    changed = True
+            if changed:
+                self._refresh_metadata()
+
+    def reference_info(self, nutrient: Dict[str, Any]) -> Dict[str, Any]:
+        """Return cached rank/category info for a nutrient key if available."""
+        return self._reference.get(nutrient_key(nutrient), {})
+
+    def category_for(self, name: str, nutrient: Dict[str, Any] | None = None) -> str:
+        """Resolve a nutrient category using the metadata table, then heuristics/reference."""
+        lower = (name or "").strip().lower()
+        if lower in self.catalog_category:
+            return self.catalog_category[lower]
+        if nutrient:
+            meta = METADATA_BY_NUMBER.get(str(nutrient.get("number") or "").strip())
+            if meta is not None:
+                return meta.category
+
+        category = _heuristic_category(lower)
+        if category:
+            return category
+
+        if nutrient:
+            ref = self.reference_info(nutrient)
+            if ref.get("category"):
+                return ref["category"]
+        return "Nutrientes"
+
+    def order_for(self, nutrient: Dict[str, Any]) -> float | None:
+        """Return USDA rank, metadata table rank or reference rank for a raw nutrient."""
+        rank = nutrient.get("rank")
+        if rank is None:
+            name_lower = (nutrient.get("name") or "").strip().lower()
+            rank = self.catalog_order.get(name_lower)
+        if rank is None:
+            meta = METADATA_BY_NUMBER.get(str(nutrient.get("number") or "").strip())
+            if meta is not None:
+                rank = meta.rank
+        if rank is None:
+            rank = self.reference_info(nutrient).get("rank")
+        try:
+            return float(rank)
+        except (TypeError, ValueError):
+            return None
+
+    def category_rank(self, category: str) -> int:
+        if category in self.category_order:
+            return self.category_order.index(category)
+        return len(self.category_order) + 1
+
+    # ---- Interning ----
+    def resolve(self, nutrient: Dict[str, Any]) -> int | None:
+        """Return the interned ID for a raw USDA nutrient dict (None if it has no identity)."""
+        raw = (
+            nutrient.get("name"),
+            nutrient.get("unitName"),
+            nutrient.get("number"),
+            nutrient.get("id"),
+        )
+        try:
+            return self._raw_to_id[raw]
+        except KeyError:
+            pass
+        except TypeError:
+            raw = tuple(str(part) for part in raw)
+        with self._lock:
+            if raw in self._raw_to_id:
+                return self._raw_to_id[raw]
+            key, name, unit = header_parts(nutrient)
+            nid: int | None = None
+            if key:
+                nid = self._key_to_id.get(key)
+                if nid is None:
+                    nid = len(self._infos)
+                    self._key_to_id[key] = nid
+                    self._samples.append(dict(nutrient))
+                    # A new ID changes no existing NutrientInfo: version stays put.
+                    self._infos.append(self._build_info(nid, key, name, unit, nutrient))
+            self._raw_to_id[raw] = nid
+            return nid
+
+    def resolve_entry(self, entry: Dict[str, Any]) -> int | None:
+        """Return the ID stamped on a foodNutrients entry, resolving it if missing."""
+        nid = entry.get("nid")
+        if nid is None:
+            nid = self.resolve(entry.get("nutrient") or {})
+        return nid
+
+    def id_for_key(self, key: str) -> int | None:
+        return self._key_to_id.get(key)
+
+    def info(self, nid: int) -> NutrientInfo:
+        return self._infos[nid]
+
+    def __len__(self) -> int:
+        return len(self._infos)
+
+    def _build_info(
+        self, nid: int, key: str, name: str, unit: str, nutrient: Dict[str, Any]
+    ) -> NutrientInfo:
+        return NutrientInfo(
+            nid=nid,
+            key=key,
+            name=name,
+            unit=unit,
+            header=f"{name} ({unit})" if unit else name,
+            category=self.category_for(name, nutrient),
+            order=self.order_for(nutrient),
+        )
+
+    def _refresh_metadata(self) -> None:
+        """Recompute category/order after catalog or reference changes."""
+        changed = False
+        for nid, info in enumerate(self._infos):
+            rebuilt = self._build_info(nid, info.key, info.name, info.unit, self._samples[nid])
+            if rebuilt != info:
+                self._infos[nid] = rebuilt
+                changed = True
+        # Engines and views rebuild on a version change; skip it when nothing moved.
+        if changed:
+            self.version += 1
+
+
+_registry = NutrientRegistry()
+
+
+def get_registry() -> NutrientRegistry:
+    """Return the process-wide nutrient registry."""
+    return _registry
+
+
+def sort_nutrients_for_display(
+    nutrients: list[Dict[str, Any]], registry: NutrientRegistry | None = None
+) -> list[Dict[str, Any]]:
+    """Return nutrients ordered by USDA rank, falling back to ``registry`` order."""
+    if not nutrients:
+        return []
+    registry = registry if registry is not None else _registry
+    indexed = []
+    for idx, entry in enumerate(nutrients):
+        rank = (entry.get("nutrient") or {}).get("rank")
+        if rank is None:
+            nid = registry.resolve_entry(entry)
+            rank = registry.info(nid).order if nid is not None else None
+        try:
+            order = float(rank)
+        except (TypeError, ValueError):
+            order = float(idx + 10000)
+        indexed.append((order, idx, entry))
+    indexed.sort(key=lambda t: (t[0], t[1]))
+    return [item[2] for item in indexed]
+
+
+def assign_nutrient_ids(
+    nutrients: list[Dict[str, Any]], registry: NutrientRegistry | None = None
+) -> list[Dict[str, Any]]:
+    """Stamp each foodNutrients entry with its interned nutrient ID ('nid') from ``registry``."""
+    registry = registry if registry is not None else _registry
+    for entry in nutrients:
+        entry["nid"] = registry.resolve(entry.get("nutrient") or {})
+    return nutrients
@@ -0,0 +1,718 @@
+from __future__ import annotations
+
+import math
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Mapping
+
+from services.nutrient_normalizer import canonical_alias_name, canonical_unit
+from services.nutrient_registry import parse_label_mapping
+
+# ---- Static label definitions (Argentine/Mercosur nutrition facts) ----
+BASE_LABEL_NUTRIENTS: list[dict[str, Any]] = [
+    {
+        "name": "Energia",
+        "type": "energy",
+        "kcal": 0.0,
+        "kj": 0.0,
+        "vd": 13.0,
+        "vd_reference": 263.0,
+    },
+    {
+        "name": "Carbohidratos",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": 7.0,
+        "vd_reference": 20.0,
+        "carb_parent": True,
+    },
+    {
+        "name": "Azúcares",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": None,
+        "vd_reference": 0.0,
+        "carb_child": True,
+        "carb_breakdown_only": True,
+    },
+    {
+        "name": "Polialcoholes",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": None,
+        "vd_reference": 0.0,
+        "carb_child": True,
+        "carb_breakdown_only": True,
+    },
+    {
+        "name": "Almidón",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": None,
+        "vd_reference": 0.0,
+        "carb_child": True,
+        "carb_breakdown_only": True,
+    },
+    {
+        "name": "Polidextrosas",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": None,
+        "vd_reference": 0.0,
+        "carb_child": True,
+        "carb_breakdown_only": True,
+    },
+    {
+        "name": "Proteinas",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": 16.0,
+        "vd_reference": 12.0,
+    },
+    {
+        "name": "Grasas totales",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": 27.0,
+        "vd_reference": 15.0,
+        "fat_parent": True,
+    },
+    {
+        "name": "Grasas saturadas",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": 23.0,
+        "vd_reference": 5.0,
+        "fat_child": True,
+    },
+    {
+        "name": "Grasas monoinsaturadas",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": None,
+        "vd_reference": 0.0,
+        "fat_child": True,
+        "fat_breakdown_only": True,
+    },
+    {
+        "name": "Grasas poliinsaturadas",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": None,
+        "vd_reference": 0.0,
+        "fat_child": True,
+        "fat_breakdown_only": True,
+    },
+    {
+        "name": "Grasas trans",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": None,
+        "vd_reference": 0.0,
+        "fat_child": True,
+    },
+    {
+        "name": "Colesterol",
+        "unit": "mg",
+        "amount": 0.0,
+        "vd": None,
+        "vd_reference": 0.0,
+        "fat_child": True,
+        "fat_breakdown_only": True,
+    },
+    {
+        "name": "Fibra alimentaria",
+        "unit": "g",
+        "amount": 0.0,
+        "vd": 12.0,
+        "vd_reference": 3.0,
+    },
+    {
+        "name": "Sodio",
+        "unit": "mg",
+        "amount": 0.0,
+        "vd": 5.0,
+        "vd_reference": 120.0,
+    },
+]
+
+ADDITIONAL_LABEL_NUTRIENTS: list[dict[str, Any]] = [
+    {"name": "Vitamina A", "unit": "µg", "vd_reference": 600.0, "ref": "(2)"},
+    {"name": "Vitamina D", "unit": "µg", "vd_reference": 5.0, "ref": "(2)"},
+    {"name": "Vitamina C", "unit": "mg", "vd_reference": 45.0, "ref": "(2)"},
+    {"name": "Vitamina E", "unit": "mg", "vd_reference": 10.0, "ref": "(2)"},
+    {"name": "Tiamina", "unit": "mg", "vd_reference": 1.2, "ref": "(2)"},
+    {"name": "Riboflavina", "unit": "mg", "vd_reference": 1.3, "ref": "(2)"},
+    {"name": "Niacina", "unit": "mg", "vd_reference": 16.0, "ref": "(2)"},
+    {"name": "Vitamina B6", "unit": "mg", "vd_reference": 1.3, "ref": "(2)"},
+    {"name": "Acido fólico", "unit": "µg", "vd_reference": 400.0, "ref": "(2)"},
+    {"name": "Vitaminia B12", "unit": "µg", "vd_reference": 2.4, "ref": "(2)"},
+    {"name": "Biotina", "unit": "µg", "vd_reference": 30.0, "ref": "(2)"},
+    {"name": "Acido pantoténico", "unit": "mg", "vd_reference": 5.0, "ref": "(2)"},
+    {"name": "Calcio", "unit": "mg", "vd_reference": 1000.0, "ref": "(2)"},
+    {"name": "Hierro", "unit": "mg", "vd_reference": 14.0, "ref": "(2) (*)"},
+    {"name": "Magnesio", "unit": "mg", "vd_reference": 260.0, "ref": "(2)"},
+    {"name": "Zinc", "unit": "mg", "vd_reference": 7.0, "ref": "(2) (**)"},
+    {"name": "Yodo", "unit": "µg", "vd_reference": 130.0, "ref": "(2)"},
+    {"name": "Vitamina K", "unit": "µg", "vd_reference": 65.0, "ref": "(2)"},
+    {"name": "Fósforo", "unit": "mg", "vd_reference": 700.0, "ref": "(3)"},
+    {"name": "Flúor", "unit": "mg", "vd_reference": 4.0, "ref": "(3)"},
+    {"name": "Cobre", "unit": "mg", "vd_reference": 0.9, "ref": "(3)"},
+    {"name": "Selenio", "unit": "µg", "vd_reference": 34.0, "ref": "(2)"},
+    {"name": "Molibdeno", "unit": "µg", "vd_reference": 45.0, "ref": "(3)"},
+    {"name": "Cromo", "unit": "µg", "vd_reference": 35.0, "ref": "(3)"},
+    {"name": "Manganeso", "unit": "mg", "vd_reference": 2.3, "ref": "(3)"},
+    {"name": "Colina", "unit": "mg", "vd_reference": 550.0, "ref": "(3)"},
+]
+
+LABEL_NUTRIENT_USDA_MAP: dict[str, str] = {
+    "Energia": "Energy (kcal)",
+    "Carbohidratos": "Carbohydrate, by difference (g)",
+    "Azúcares": "Sugars, Total (g)",
+    "Polialcoholes": "Sugar alcohol (g)",
+    "Almidón": "Starch (g)",
+    "Polidextrosas": "Polydextrose (g)",
+    "Proteinas": "Protein (g)",
+    "Grasas totales": "Total lipid (fat) (g)",
+    "Grasas saturadas": "Fatty acids, total saturated (g)",
+    "Grasas monoinsaturadas": "Fatty acids, total monounsaturated (g)",
+    "Grasas poliinsaturadas": "Fatty acids, total polyunsaturated (g)",
+    "Grasas trans": "Fatty acids, total trans (g)",
+    "Colesterol": "Cholesterol (mg)",
+    "Fibra alimentaria": "Fiber, total dietary (g)",
+    "Sodio": "Sodium, Na (mg)",
+    "Vitamina A": "Vitamin A, RAE (µg)",
+    "Vitamina D": "Vitamin D (D2 + D3)",
+    "Vitamina C": "Vitamin C, total ascorbic acid (mg)",
+    "Vitamina E": "Vitamin E (alpha-tocopherol) (mg)",
+    "Tiamina": "Thiamin (mg)",
+    "Riboflavina": "Riboflavin (mg)",
+    "Niacina": "Niacin (mg)",
+    "Vitamina B6": "Vitamin B-6 (mg)",
+    "Acido fólico": "Folate, DFE (µg)",
+    "Vitaminia B12": "Vitamin B-12 (µg)",
+    "Biotina": "Biotin (µg)",
+    "Acido pantoténico": "Pantothenic acid (mg)",
+    "Calcio": "Calcium, Ca (mg)",
+    "Hierro": "Iron, Fe (mg)",
+    "Magnesio": "Magnesium, Mg (mg)",
+    "Zinc": "Zinc, Zn (mg)",
+    "Yodo": "Iodine, I (µg)",
+    "Vitamina K": "Vitamin K (phylloquinone) (µg)",
+    "Fósforo": "Phosphorus, P (mg)",
+    "Flúor": "Fluoride, F (mg)",
+    "Cobre": "Copper, Cu (mg)",
+    "Selenio": "Selenium, Se (µg)",
+    "Molibdeno": "Molybdenum, Mo (µg)",
+    "Cromo": "Chromium, Cr (µg)",
+    "Manganeso": "Manganese, Mn (mg)",
+    "Colina": "Choline, total (mg)",
+}
+
+NO_SIGNIFICANT_ORDER: list[str] = [
+    "Energia",
+    "Carbohidratos",
+    "Proteinas",
+    "Grasas totales",
+    "Grasas saturadas",
+    "Grasas trans",
+    "Fibra alimentaria",
+    "Sodio",
+]
+
+NO_SIGNIFICANT_THRESHOLDS: dict[str, dict[str, Any]] = {
+    "Energia": {"unit": "kcal", "max": 4.0, "kj_max": 17.0},
+    "Carbohidratos": {"unit": "g", "max": 0.5},
+    "Proteinas": {"unit": "g", "max": 0.5},
+    "Grasas totales": {"unit": "g", "max": 0.5},
+    "Grasas saturadas": {"unit": "g", "max": 0.2},
+    "Grasas trans": {"unit": "g", "max": 0.2},
+    "Fibra alimentaria": {"unit": "g", "max": 0.5},
+    "Sodio": {"unit": "mg", "max": 5.0},
+}
+
+NO_SIGNIFICANT_DISPLAY_MAP: dict[str, str] = {"Energia": "Valor energético"}
+
+FAT_LABEL_NAMES = frozenset(
+    {
+        "Grasas totales",
+        "Grasas saturadas",
+        "Grasas trans",
+        "Grasas monoinsaturadas",
+        "Grasas poliinsaturadas",
+        "Colesterol",
+    }
+)
+CARB_LABEL_NAMES = frozenset(
+    {"Carbohidratos", "Azúcares", "Polialcoholes", "Almidón", "Polidextrosas"}
+)
+
+_ENERGY_FACTORS: list[tuple[str, float]] = [
+    ("alcohol", 7.0),
+    ("ethanol", 7.0),
+    ("protein", 4.0),
+    ("carbohydrate", 4.0),
+    ("carbohydrate, by difference", 4.0),
+    ("polydextrose", 1.0),
+    ("polyol", 2.4),
+    ("sugar alcohol", 2.4),
+    ("organic acid", 3.0),
+    ("total lipid", 9.0),  # Solo lipidos totales, no Fat (NLEA)
+]
+
+
+@dataclass(frozen=True)
+class LabelSettings:
+    """Immutable snapshot of every user input that affects the nutrition label."""
+
+    portion_size: float = 100.0
+    portion_unit: str = "g"
+    household_amount: str = ""
+    household_unit: str = "Unidad"
+    breakdown_fat: bool = False
+    breakdown_carb: bool = False
+    manual_overrides: tuple[tuple[str, float], ...] = ()
+    no_significant: tuple[str, ...] = ()
+    additional_selected: tuple[str, ...] = ()
+
+    @property
+    def portion_factor(self) -> float:
+        return float(self.portion_size or 0) / 100.0
+
+    @property
+    def manual_map(self) -> Dict[str, float]:
+        return dict(self.manual_overrides)
+
+
+@dataclass(frozen=True)
+class LabelEvaluation:
+    """Label math for one totals snapshot and one set of settings."""
+
+    settings: LabelSettings
+    totals: Mapping[str, Dict[str, Any]]
+    effective: Mapping[str, Dict[str, Any]] = field(default_factory=dict)
+    eligible_no_significant: tuple[str, ...] = ()
+    no_significant: tuple[str, ...] = ()
+    totals_version: int | None = None
+
+
+def sort_no_significant(names: List[str] | tuple[str, ...]) -> list[str]:
+    order_index = {name: idx for idx, name in enumerate(NO_SIGNIFICANT_ORDER)}
+    return sorted(
+        names,
+        key=lambda n: (
+            order_index.get(n, len(order_index)),
+            n.lower(),
+        ),
+    )
+
+
+def factor_for_energy(name: str) -> float | None:
+    lower = name.lower()
+    for key, factor in _ENERGY_FACTORS:
+        if key in lower:
+            return factor
+    return None
+
+
+# (totals key, canonical name, canonical unit, alphanumeric name key, raw lower name)
+_NormalizedEntry = tuple[str, str, str, str, str]
+
+
+def _normalize_totals(totals: Mapping[str, Dict[str, Any]]) -> list[_NormalizedEntry]:
+    normalized: list[_NormalizedEntry] = []
+    for key, entry in totals.items():
+        entry_name = canonical_alias_name(entry.get("name", "")).lower()
+        normalized.append(
+            (
+                key,
+                entry_name,
+                canonical_unit(entry.get("unit", "")).lower(),
+                re.sub(r"[^a-z0-9]", "", entry_name),
+                (entry.get("name") or "").lower(),
+            )
+        )
+    return normalized
+
+
+def _match_total_key(
+    normalized: list[_NormalizedEntry], canonical_name: str, unit: str
+) -> str | None:
+    target = canonical_alias_name(canonical_name).lower()
+    target_unit = canonical_unit(unit).lower()
+    target_key = re.sub(r"[^a-z0-9]", "", target)
+
+    for key, entry_name, entry_unit, entry_key, _ in normalized:
+        name_match = (
+            entry_name == target
+            or entry_name.startswith(target)
+            or target in entry_name
+            or entry_key == target_key
+            or entry_key.startswith(target_key)
+            or target_key in entry_key
+        )
+        if name_match and ((not target_unit) or entry_unit == target_unit):
+            return key
+
+    # Fallback: raw substring match (e.g., "total lipid (fat)")
+    raw_target = canonical_name.lower()
+    for key, _, entry_unit, _, raw_name in normalized:
+        if raw_target in raw_name and (not target_unit or entry_unit == target_unit):
+            return key
+    return None
+
+
+def find_total_entry(
+    totals: Mapping[str, Dict[str, Any]], canonical_name: str, unit: str
+) -> Dict[str, Any] | None:
+    """Find the totals entry for a USDA name/unit, tolerating alias and punctuation drift."""
+    key = _match_total_key(_normalize_totals(totals), canonical_name, unit)
+    return None if key is None else totals[key]
+
+
+@dataclass(frozen=True)
+class _LabelResolution:
+    """Label name -> totals key for one set of totals keys (amounts do not matter)."""
+
+    label_keys: Dict[str, str | None]
+    energy_keys: tuple[str | None, str | None]
+    # (totals key, nutrient name, Atwater factor) for entries that contribute energy
+    energy_terms: tuple[tuple[str, str, float], ...]
+
+
+def _resolve_label_keys(
+    totals: Mapping[str, Dict[str, Any]], label_names: list[str]
+) -> Dict[str, str | None]:
+    normalized = _normalize_totals(totals)
+    keys: Dict[str, str | None] = {}
+    for name in label_names:
+        mapped_name, mapped_unit = parse_label_mapping(LABEL_NUTRIENT_USDA_MAP.get(name, ""))
+        if not mapped_name:
+            keys[name] = None
+            continue
+        key = _match_total_key(normalized, mapped_name, mapped_unit)
+        if key is None and name == "Grasas totales":
+            # Fallback: cualquier nutriente que contenga "total lipid"
+            key = next(
+                (entry[0] for entry in normalized if "total lipid" in entry[4]), None
+            )
+        keys[name] = key
+    return keys
+
+
+def _build_resolution(totals: Mapping[str, Dict[str, Any]]) -> _LabelResolution:
+    label_names = [
+        nutrient["name"]
+        for nutrient in BASE_LABEL_NUTRIENTS + ADDITIONAL_LABEL_NUTRIENTS
+        if nutrient.get("type") != "energy"
+    ]
+    normalized = _normalize_totals(totals)
+    energy_name, _ = parse_label_mapping(LABEL_NUTRIENT_USDA_MAP.get("Energia", ""))
+    energy_keys: tuple[str | None, str | None] = (None, None)
+    if energy_name:
+        energy_keys = (
+            _match_total_key(normalized, energy_name, "kcal"),
+            _match_total_key(normalized, energy_name, "kJ"),
+        )
+    energy_terms: list[tuple[str, str, float]] = []
+    for key, entry in totals.items():
+        name = entry.get("name", "") or ""
+        factor = factor_for_energy(name)
+        if factor is not None:
+            energy_terms.append((key, name, factor))
+    return _LabelResolution(
+        label_keys=_resolve_label_keys(totals, label_names),
+        energy_keys=energy_keys,
+        energy_terms=tuple(energy_terms),
+    )
+
+
+_RESOLUTION_CACHE: OrderedDict[tuple[str, ...], _LabelResolution] = OrderedDict()
+_RESOLUTION_CACHE_SIZE = 16
+_RESOLUTION_LOCK = threading.Lock()
+
+
+def _resolution_for(totals: Mapping[str, Dict[str, Any]]) -> _LabelResolution:
+    # Totals keys are registry header keys (name + unit), so the key sequence fully
+    # determines the matches; amount-only refreshes reuse the previous resolution.
+    signature = tuple(totals)
+    with _RESOLUTION_LOCK:
+        cached = _RESOLUTION_CACHE.get(signature)
+        if cached is not None:
+            _RESOLUTION_CACHE.move_to_end(signature)
+            return cached
+    resolution = _build_resolution(totals)
+    with _RESOLUTION_LOCK:
+        _RESOLUTION_CACHE[signature] = resolution
+        while len(_RESOLUTION_CACHE) > _RESOLUTION_CACHE_SIZE:
+            _RESOLUTION_CACHE.popitem(last=False)
+    return resolution
+
+
+class LabelTotalsIndex:
+    """Totals snapshot plus its label resolution; every label row is a dict lookup."""
+
+    def __init__(self, totals: Mapping[str, Dict[str, Any]]) -> None:
+        self.totals = totals
+        self._resolution = _resolution_for(totals)
+
+    def entry_for_label(self, label_name: str) -> Dict[str, Any] | None:
+        keys = self._resolution.label_keys
+        if label_name in keys:
+            key = keys[label_name]
+        else:
+            key = _resolve_label_keys(self.totals, [label_name])[label_name]
+        return None if key is None else self.totals.get(key)
+
+    def energy_entries(self) -> tuple[Dict[str, Any] | None, Dict[str, Any] | None]:
+        kcal_key, kj_key = self._resolution.energy_keys
+        return (
+            None if kcal_key is None else self.totals.get(kcal_key),
+            None if kj_key is None else self.totals.get(kj_key),
+        )
+
+    def energy_terms(self) -> tuple[tuple[str, str, float], ...]:
+        return self._resolution.energy_terms
+
+
+def label_index(totals: Mapping[str, Dict[str, Any]] | LabelTotalsIndex) -> LabelTotalsIndex:
+    """Return ``totals`` as a LabelTotalsIndex (pass one in to share it across calls)."""
+    if isinstance(totals, LabelTotalsIndex):
+        return totals
+    return LabelTotalsIndex(totals)
+
+
+def compute_energy_values(
+    totals: Mapping[str, Dict[str, Any]] | LabelTotalsIndex, settings: LabelSettings
+) -> Dict[str, float] | None:
+    """Energy per 100 g from Atwater factors, honoring manual overrides per portion."""
+    index = label_index(totals)
+    portion_factor = settings.portion_factor
+    factor = portion_factor if portion_factor > 0 else 1.0
+    overrides = settings.manual_map
+
+    # Build a skip set for manual overrides (so we replace totals with manual)
+    manual_names = {name for name in overrides.keys() if name != "Energia"}
+
+    kcal_portion = 0.0
+
+    # First pass: totals contributions (excluding manual overrides).
+    # Totals are already keyed by canonical name|unit, so each entry is unique.
+    for key, name, factor_energy in index.energy_terms():
+        if name in manual_names:
+            continue
+        entry = index.totals[key]
+        unit = (entry.get("unit", "") or "").lower()
+        amount = float(entry.get("amount", 0.0) or 0.0)
+        amount_g = amount / 1000.0 if unit == "mg" else amount
+        # totals are per 100 g producto final; convert to porción
+        kcal_portion += amount_g * portion_factor * factor_energy
+
+    # Second pass: manual overrides from la etiqueta base (por porción)
+    for base in BASE_LABEL_NUTRIENTS:
+        name = base.get("name", "")
+        if name == "Energia" or name not in manual_names:
+            continue
+        manual_amount = float(overrides.get(name, 0.0) or 0.0)
+        factor_energy = factor_for_energy(LABEL_NUTRIENT_USDA_MAP.get(name, name))
+        if factor_energy is None:
+            continue
+        unit = (base.get("unit", "") or "").lower()
+        amount_g = manual_amount / 1000.0 if unit == "mg" else manual_amount
+        kcal_portion += amount_g * factor_energy
+
+    if math.isclose(kcal_portion, 0.0, abs_tol=1e-6):
+        return None
+
+    kcal_per_100 = kcal_portion / factor
+    return {"kcal": kcal_per_100, "kj": kcal_per_100 * 4.184}
+
+
+def label_amount_from_totals(
+    totals: Mapping[str, Dict[str, Any]] | LabelTotalsIndex,
+    nutrient: Dict[str, Any],
+    settings: LabelSettings,
+) -> Dict[str, float] | None:
+    index = label_index(totals)
+    name = nutrient.get("name", "")
+    if nutrient.get("type") == "energy":
+        mapped_name, _ = parse_label_mapping(LABEL_NUTRIENT_USDA_MAP.get(name, ""))
+        if not mapped_name:
+            return None
+        computed = compute_energy_values(index, settings)
+        if computed:
+            return computed
+        kcal_entry, kj_entry = index.energy_entries()
+        if not kcal_entry and not kj_entry:
+            return None
+        kcal_amount = kcal_entry.get("amount") if kcal_entry else None
+        if kcal_amount is None and kj_entry:
+            kcal_amount = kj_entry.get("amount", 0.0) / 4.184
+        kj_amount = kj_entry.get("amount") if kj_entry else None
+        if kj_amount is None and kcal_entry:
+            kj_amount = kcal_entry.get("amount", 0.0) * 4.184
+        return {"kcal": float(kcal_amount or 0.0), "kj": float(kj_amount or 0.0)}
+    entry = index.entry_for_label(name)
+    if not entry:
+        return None
+    return {"amount": float(entry.get("amount", 0.0))}
+
+
+def effective_label_nutrient(
+    totals: Mapping[str, Dict[str, Any]] | LabelTotalsIndex,
+    nutrient: Dict[str, Any],
+    settings: LabelSettings,
+) -> Dict[str, Any]:
+    """Resolve the per-100 g value shown for a label nutrient (manual override or totals)."""
+    name = nutrient.get("name", "")
+    manual_amount = settings.manual_map.get(name)
+    if nutrient.get("type") == "energy":
+        manual_amount = None
+    totals_amount = label_amount_from_totals(totals, nutrient, settings)
+
+    effective = dict(nutrient)
+    effective["vd_reference"] = nutrient.get("vd_reference") or (
+        nutrient.get("kcal", nutrient.get("amount", 0.0))
+        if nutrient.get("type") == "energy"
+        else nutrient.get("amount", 0.0)
+    )
+
+    if manual_amount is not None:
+        effective["amount"] = manual_amount
+        effective["manual"] = True
+        return effective
+
+    if totals_amount:
+        if nutrient.get("type") == "energy":
+            effective["kcal"] = totals_amount.get("kcal", nutrient.get("kcal", 0.0))
+            effective["kj"] = totals_amount.get("kj", nutrient.get("kj", 0.0))
+            effective["amount"] = effective["kcal"]
+        else:
+            effective["amount"] = totals_amount.get("amount", nutrient.get("amount", 0.0))
+        effective["manual"] = False
+        effective["from_totals"] = True
+        return effective
+
+    effective["manual"] = False
+    effective["from_totals"] = False
+    return effective
+
+
+def eligible_no_significant(
+    effective: Mapping[str, Dict[str, Any]], settings: LabelSettings
+) -> list[str]:
+    """Base nutrients whose portion amount is low enough to be declared "no significativo"."""
+    eligible: list[str] = []
+    factor = settings.portion_factor
+
+    def portion_amount(name: str) -> float:
+        eff = effective.get(name)
+        if eff is None:
+            return 0.0
+        if eff.get("type") == "energy":
+            return (eff.get("kcal") or 0.0) * factor
+        return (eff.get("amount") or 0.0) * factor
+
+    for nutrient in BASE_LABEL_NUTRIENTS:
+        eff = effective.get(nutrient.get("name", ""), nutrient)
+        name = eff.get("name", nutrient.get("name", ""))
+        if settings.breakdown_fat and name in FAT_LABEL_NAMES:
+            continue
+        if settings.breakdown_carb and name in CARB_LABEL_NAMES:
+            continue
+        thresh = NO_SIGNIFICANT_THRESHOLDS.get(name)
+        if not thresh:
+            continue
+        if eff.get("type") == "energy":
+            kcal_portion = (eff.get("kcal") or 0.0) * factor
+            kj_portion = (eff.get("kj") or 0.0) * factor
+            if kcal_portion <= thresh.get("max", 0) or kj_portion < thresh.get("kj_max", 0):
+                eligible.append(name)
+            continue
+        amount_portion = (eff.get("amount") or 0.0) * factor
+        max_allowed = thresh.get("max", 0.0)
+        if name == "Grasas totales":
+            sat = portion_amount("Grasas saturadas")
+            trans = portion_amount("Grasas trans")
+            if (
+                amount_portion <= max_allowed + 1e-9
+                and sat <= NO_SIGNIFICANT_THRESHOLDS["Grasas saturadas"]["max"] + 1e-9
+                and trans <= NO_SIGNIFICANT_THRESHOLDS["Grasas trans"]["max"] + 1e-9
+            ):
+                eligible.append(name)
+        elif amount_portion <= max_allowed + 1e-9:
+            eligible.append(name)
+    return eligible
+
+
+def evaluate_label(
+    totals: Mapping[str, Dict[str, Any]],
+    settings: LabelSettings,
+    totals_version: int | None = None,
+) -> LabelEvaluation:
+    """Run all label math for a totals snapshot; safe to call off the GUI thread."""
+    index = label_index(totals)
+    effective: Dict[str, Dict[str, Any]] = {}
+    for nutrient in BASE_LABEL_NUTRIENTS:
+        effective[nutrient["name"]] = effective_label_nutrient(index, nutrient, settings)
+    for nutrient in ADDITIONAL_LABEL_NUTRIENTS:
+        if nutrient["name"] in settings.additional_selected:
+            effective[nutrient["name"]] = effective_label_nutrient(index, nutrient, settings)
+    eligible = eligible_no_significant(effective, settings)
+    no_significant = sort_no_significant(
+        [name for name in settings.no_significant if name in eligible]
+    )
+    return LabelEvaluation(
+        settings=settings,
+        totals=totals,
+        effective=effective,
+        eligible_no_significant=tuple(eligible),
+        no_significant=tuple(no_significant),
+        totals_version=totals_version,
+    )
+
+
+class LabelEvaluationCache:
+    """
+    Memoize label evaluations by (totals version, label settings).
+
+    Shared by the compute thread and the GUI thread: whichever asks first evaluates,
+    later readers of the same snapshot + settings get the same LabelEvaluation.
+    """
+
+    def __init__(self, max_entries: int = 4) -> None:
+        self._entries: OrderedDict[tuple[int, LabelSettings], LabelEvaluation] = OrderedDict()
+        self._max_entries = max(1, int(max_entries))
+        self._lock = threading.Lock()
+
+    def get(self, totals_version: int, settings: LabelSettings) -> LabelEvaluation | None:
+        with self._lock:
+            evaluation = self._entries.get((totals_version, settings))
+            if evaluation is not None:
+                self._entries.move_to_end((totals_version, settings))
+            return evaluation
+
+    def evaluate(
+        self,
+        totals_version: int,
+        settings: LabelSettings,
+        totals: Mapping[str, Dict[str, Any]] | Callable[[], Mapping[str, Dict[str, Any]]],
+    ) -> LabelEvaluation:
+        """Return the cached evaluation or compute it; ``totals`` may be a factory."""
+        cached = self.get(totals_version, settings)
+        if cached is not None:
+            return cached
+        if callable(totals):
+            totals = totals()
+        evaluation = evaluate_label(totals, settings, totals_version)
+        with self._lock:
+            self._entries[(totals_version, settings)] = evaluation
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return evaluation
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, Sequence
+
+import numpy as np
+
+# Percent slack accepted on targets, bounds and the final 100 % sum.
+TOLERANCE = 1e-4
+METHODS = ("proportional", "least_squares")
+
+
+class InfeasiblePercents(ValueError):
+    """No redistribution satisfies the request; ``title`` is a short user-facing caption."""
+
+    def __init__(self, title: str, message: str) -> None:
+        super().__init__(message)
+        self.title = title
+
+
+def redistribute_percents(
+    current: Sequence[float],
+    targets: Dict[int, float],
+    locked: Sequence[bool] | None = None,
+    minimum: Sequence[float] | None = None,
+    maximum: Sequence[float] | None = None,
+    groups: Iterable[Sequence[int]] = (),
+    method: str = "proportional",
+    labels: Sequence[str] | None = None,
+) -> np.ndarray:
+    """
+    New percentages (summing to 100) with every target applied in a single solve.
+
+    Targets and locked ingredients are fixed; the rest absorb the difference within
+    [minimum, maximum] (default 0-100). Free members of a group move together and
+    keep their ratios. "proportional" scales free ingredients like their current
+    share (the classic single-edit behaviour); "least_squares" shifts every free
+    unit by the same amount, the closest redistribution in the Euclidean sense.
+    Raises InfeasiblePercents explaining which constraint cannot be met.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method: {method}")
+    percents = np.asarray(current, dtype=float).copy()
+    count = percents.size
+    names = list(labels) if labels is not None else [f"Ingrediente {i + 1}" for i in range(count)]
+    lower = np.zeros(count) if minimum is None else np.asarray(minimum, dtype=float)
+    upper = np.full(count, 100.0) if maximum is None else np.asarray(maximum, dtype=float)
+    fixed = np.zeros(count, dtype=bool) if locked is None else np.array(locked, dtype=bool)
+
+    problems: list[str] = []
+    for index, value in targets.items():
+        if not 0 <= index < count:
+            raise IndexError(f"Target row out of range: {index}")
+        if value < lower[index] - TOLERANCE or value > upper[index] + TOLERANCE:
+            problems.append(
+                f"{names[index]}: {value:.2f} % está fuera de su rango "
+                f"({lower[index]:.2f} - {upper[index]:.2f} %)."
+            )
+        percents[index] = value
+        fixed[index] = True
+    if problems:
+        raise InfeasiblePercents("Porcentaje inválido", "\n".join(problems))
+
+    remaining = 100.0 - percents[fixed].sum()
+    if remaining < -TOLERANCE:
+        raise InfeasiblePercents(
+            "Sin grado de libertad",
+            f"Los ingredientes fijados y los valores pedidos suman {100.0 - remaining:.2f} %. "
+            "Libera un ingrediente o reduce los valores.",
+        )
+    free = np.flatnonzero(~fixed)
+    if free.size == 0:
+        if abs(remaining) > TOLERANCE:
+            raise InfeasiblePercents(
+                "Sin grado de libertad",
+                f"Falta repartir {remaining:.2f} % y no queda ningún ingrediente sin fijar.",
+            )
+        return percents
+
+    # Units: free ingredients, with grouped members merged into their first free member.
+    unit_of = np.arange(count)
+    for group in groups:
+        members = [i for i in group if 0 <= i < count and not fixed[i]]
+        if members:
+            unit_of[members] = members[0]
+    _, unit = np.unique(unit_of[free], return_inverse=True)
+    units = int(unit.max()) + 1
+    base = np.bincount(unit, weights=percents[free], minlength=units)
+    sizes = np.bincount(unit, minlength=units)
+    # Share of each member inside its unit (even split for units currently at 0 %).
+    unit_base = base[unit]
+    share = np.where(
+        unit_base > 0, percents[free] / np.where(unit_base > 0, unit_base, 1.0), 1.0 / sizes[unit]
+    )
+
+    unit_lower = np.zeros(units)
+    unit_upper = np.full(units, np.inf)  # every unit has a member with share > 0
+    scaled = share > 0
+    np.maximum.at(unit_lower, unit[scaled], lower[free][scaled] / share[scaled])
+    np.minimum.at(unit_upper, unit[scaled], upper[free][scaled] / share[scaled])
+    stuck = free[~scaled & (lower[free] > TOLERANCE)]
+    clash = np.flatnonzero(unit_lower > unit_upper + TOLERANCE)
+    if stuck.size or clash.size:
+        problems = [f"{names[i]}: su grupo está en 0 % y no puede cumplir su mínimo." for i in stuck]
+        problems += [
+            "Mínimos y máximos incompatibles en: "
+            + ", ".join(names[i] for i in free[unit == u])
+            for u in clash
+        ]
+        raise InfeasiblePercents("Límites incompatibles", "\n".join(problems))
+
+    if remaining < unit_lower.sum() - TOLERANCE:
+        raise InfeasiblePercents(
+            "Sin grado de libertad",
+            f"Los mínimos de los ingredientes libres suman {unit_lower.sum():.2f} %, "
+            f"pero solo queda {remaining:.2f} % para repartir.",
+        )
+    if remaining > unit_upper.sum() + TOLERANCE:
+        raise InfeasiblePercents(
+            "Sin grado de libertad",
+            f"Los máximos de los ingredientes libres suman {unit_upper.sum():.2f} %, "
+            f"pero hay que repartir {remaining:.2f} %.",
+        )
+
+    if method == "proportional":
+        offset, slope = np.zeros(units), base if base.sum() > 0 else np.ones(units)
+    else:
+        offset, slope = base, np.ones(units)
+    solved = _water_fill(offset, slope, unit_lower, unit_upper, remaining)
+    if abs(solved.sum() - remaining) > TOLERANCE:
+        # Only units at 0 % can block a proportional fill (they do not scale).
+        raise InfeasiblePercents(
+            "Sin grado de libertad",
+            "Los ingredientes libres con cantidad no alcanzan para repartir "
+            f"{remaining:.2f} %. Asigna un valor a los que están en 0 % o libera otro ingrediente.",
+        )
+    percents[free] = solved[unit] * share
+    return percents
+
+
+def _water_fill(
+    offset: np.ndarray, slope: np.ndarray, lower: np.ndarray, upper: np.ndarray, total: float
+) -> np.ndarray:
+    """
+    Values clip(offset + slope * s, lower, upper) adding up to ``total``.
+
+    The sum is piecewise linear and nondecreasing in s, with kinks where a unit hits
+    a bound, so evaluating it at every kink and interpolating gives the exact s.
+    """
+    moving = slope > 0
+    if not moving.any():
+        return np.clip(offset, lower, upper)
+    kinks = np.unique(
+        np.concatenate(
+            [
+                (lower[moving] - offset[moving]) / slope[moving],
+                (upper[moving] - offset[moving]) / slope[moving],
+            ]
+        )
+    )
+    sums = np.clip(offset + slope * kinks[:, None], lower, upper).sum(axis=1)
+    scale = np.interp(total, sums, kinks)
+    return np.clip(offset + slope * scale, lower, upper)
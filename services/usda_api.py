@@ -1,5 +1,8 @@
+import json
 import os
+import tempfile
 import threading
+from pathlib import Path
 from typing import Any, Dict, List
 
 import requests
@@ -18,6 +21,8 @@ _session: requests.Session | None = None
 _details_cache: Dict[tuple[int, str, tuple[int, ...] | None], Dict[str, Any]] = {}
 _search_cache: Dict[tuple[str, int, tuple[str, ...] | None, int], List[Dict[str, Any]]] = {}
 _cache_lock = threading.Lock()
+# Optional on-disk copy of food details (one JSON file per FDC ID), shared across processes.
+_disk_cache_dir: Path | None = Path(os.environ["USDA_CACHE_DIR"]) if os.getenv("USDA_CACHE_DIR") else None
 
 
 class USDAApiError(Exception):
@@ -155,6 +160,48 @@ def _normalize_food_payload(food: Dict[str, Any]) -> Dict[str, Any]:
     return normalized_food
 
 
+def set_disk_cache_dir(path: str | os.PathLike | None) -> None:
+    """Persist food details under ``path`` (None disables); files are written atomically."""
+    global _disk_cache_dir
+    _disk_cache_dir = Path(path) if path else None
+
+
+def _disk_cache_file(fdc_id: int, nutrient_tuple: tuple[int, ...] | None) -> Path | None:
+    # Only complete (unfiltered) details are persisted.
+    if _disk_cache_dir is None or nutrient_tuple:
+        return None
+    return _disk_cache_dir / f"{int(fdc_id)}.json"
+
+
+def _read_disk_cache(fdc_id: int, nutrient_tuple: tuple[int, ...] | None) -> Dict[str, Any] | None:
+    path = _disk_cache_file(fdc_id, nutrient_tuple)
+    if path is None:
+        return None
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _write_disk_cache(
+    fdc_id: int, nutrient_tuple: tuple[int, ...] | None, data: Dict[str, Any]
+) -> None:
+    path = _disk_cache_file(fdc_id, nutrient_tuple)
+    if path is None:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so concurrent readers never see a partial file.
+        fd, tmp_name = tempfile.mkstemp(prefix=f".{path.stem}-", suffix=".tmp", dir=path.parent)
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            json.dump(data, handle, ensure_ascii=False)
+        os.replace(tmp_name, path)
+    except OSError:
+        # The disk cache is best effort; the in-memory cache already holds the result.
+        return
+
+
 def has_cached_food(
     fdc_id: int, detail_format: str = "full", nutrient_ids: List[int] | None = None
 ) -> bool:
@@ -163,7 +210,10 @@ def has_cached_food(
     nutrient_tuple = tuple(sorted(set(nutrient_ids))) if nutrient_ids else None
     cache_key = (fdc_id, fmt, nutrient_tuple)
     with _cache_lock:
-        return cache_key in _details_cache
+        if cache_key in _details_cache:
+            return True
+    path = _disk_cache_file(fdc_id, nutrient_tuple) if fmt == "abridged" else None
+    return path is not None and path.exists()
 
 
 def search_foods(
@@ -242,6 +292,8 @@ def get_food_details(
 
     with _cache_lock:
         cached = _details_cache.get(cache_key)
+    if cached is None:
+        cached = _read_disk_cache(fdc_id, nutrient_tuple)
     if cached is not None:
         normalized = _normalize_food_payload(cached)
         with _cache_lock:
@@ -270,6 +322,7 @@ def get_food_details(
             normalized = _normalize_food_payload(data)
             with _cache_lock:
                 _details_cache[cache_key] = normalized
+            _write_disk_cache(fdc_id, nutrient_tuple, normalized)
             return normalized
         except USDAHttpError as exc:
             if attempt_fmt == "abridged" and exc.status_code == 404 and not tried_fallback:
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import posixpath
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+try:
+    from lxml.etree import iterparse
+
+    _ROW_TAG: str | None = "{*}row"
+except ImportError:  # pragma: no cover - lxml is optional, the stdlib parser is slower
+    from xml.etree.ElementTree import iterparse
+
+    _ROW_TAG = None
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _column_index(ref: str) -> int:
+    """Zero-based column of an A1-style reference ("E12" -> 4)."""
+    index = 0
+    for ch in ref:
+        if "A" <= ch <= "Z":
+            index = index * 26 + ord(ch) - 64
+        else:
+            break
+    return index - 1
+
+
+def _cast_number(text: str) -> int | float:
+    # Same rule as openpyxl: integers stay int, anything with a fraction/exponent is float.
+    if "." in text or "E" in text or "e" in text:
+        return float(text)
+    return int(text)
+
+
+def _text(element) -> str:
+    return "".join(node.text or "" for node in element.iter() if _local(node.tag) == "t")
+
+
+class SheetRows:
+    """
+    Row tuples of one sheet, streamed from the archive.
+
+    ``max_col`` (1-based, None = all) may be lowered while iterating: cells are
+    stored in column order, so the rest of each row is skipped without decoding.
+    """
+
+    def __init__(self, reader: "XlsxReader", member: str) -> None:
+        self.max_col: int | None = None
+        self._reader = reader
+        self._member = member
+        self._rows = self._parse()
+
+    def __iter__(self) -> "SheetRows":
+        return self
+
+    def __next__(self) -> tuple:
+        return next(self._rows)
+
+    def _cell_value(self, cell) -> Any:
+        kind = cell.get("t")
+        if kind == "inlineStr":
+            return _text(cell)
+        value = None
+        for child in cell:
+            if _local(child.tag) == "v":
+                value = child.text
+                break
+        if value is None:
+            return None
+        if kind == "s":
+            return self._reader.shared_strings[int(value)]
+        if kind == "b":
+            return value == "1"
+        if kind in ("str", "e", "d"):
+            return value
+        return _cast_number(value)
+
+    def _parse(self) -> Iterator[tuple]:
+        expected = 1
+        with self._reader.archive.open(self._member) as source:
+            events = iterparse(source, events=("end",), tag=_ROW_TAG) if _ROW_TAG else iterparse(source)
+            for _event, row in events:
+                if _ROW_TAG is None and _local(row.tag) != "row":
+                    continue
+                number = int(row.get("r") or expected)
+                # Rows without any cell are not stored; report them as empty like openpyxl does.
+                while expected < number:
+                    expected += 1
+                    yield ()
+                expected = number + 1
+
+                limit = self.max_col
+                values: List[Any] = []
+                position = 0
+                for cell in row:
+                    ref = cell.get("r")
+                    column = _column_index(ref) if ref else position
+                    if limit is not None and column >= limit:
+                        break
+                    if column > len(values):
+                        values.extend([None] * (column - len(values)))
+                    values.append(self._cell_value(cell))
+                    position = column + 1
+                row.clear()
+                yield tuple(values)
+
+
+class XlsxReader:
+    """
+    Minimal read-only access to .xlsx cell values (cached values for formulas).
+
+    Far cheaper than openpyxl for scanning a few columns of large sheets: no
+    styles, no cell objects and no pre-pass to size the sheet.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.archive = zipfile.ZipFile(path)
+        self.sheets = self._sheet_members()
+        self._shared_strings: List[str] | None = None
+
+    def __enter__(self) -> "XlsxReader":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.archive.close()
+
+    @property
+    def sheet_names(self) -> List[str]:
+        return list(self.sheets)
+
+    @property
+    def shared_strings(self) -> List[str]:
+        if self._shared_strings is None:
+            strings: List[str] = []
+            if "xl/sharedStrings.xml" in self.archive.namelist():
+                with self.archive.open("xl/sharedStrings.xml") as source:
+                    for _event, element in iterparse(source):
+                        if _local(element.tag) == "si":
+                            strings.append(_text(element))
+                            element.clear()
+            self._shared_strings = strings
+        return self._shared_strings
+
+    def rows(self, name: str) -> SheetRows:
+        return SheetRows(self, self.sheets[name])
+
+    def _sheet_members(self) -> Dict[str, str]:
+        """Sheet name -> archive member, in workbook order."""
+        targets: Dict[str, str] = {}
+        with self.archive.open("xl/_rels/workbook.xml.rels") as source:
+            for _event, element in iterparse(source):
+                if _local(element.tag) == "Relationship":
+                    target = element.get("Target") or ""
+                    if target.startswith("/"):
+                        target = target[1:]
+                    else:
+                        target = posixpath.normpath(posixpath.join("xl", target))
+                    targets[element.get("Id")] = target
+        sheets: Dict[str, str] = {}
+        with self.archive.open("xl/workbook.xml") as source:
+            for _event, element in iterparse(source):
+                if _local(element.tag) == "sheet":
+                    rel_id = next((v for k, v in element.attrib.items() if _local(k) == "id"), "")
+                    member = targets.get(rel_id)
+                    if member:
+                        sheets[element.get("name")] = member
+        return sheets
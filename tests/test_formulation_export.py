@@ -0,0 +1,29 @@
+import os
+import stat
+
+from services.formulation_export import atomic_write
+
+
+def _mode(path):
+    return stat.S_IMODE(path.stat().st_mode)
+
+
+def test_atomic_write_new_file_uses_umask(tmp_path):
+    umask = os.umask(0)
+    os.umask(umask)
+    target = tmp_path / "export.json"
+
+    atomic_write(target, lambda tmp: tmp.write_text("{}", encoding="utf-8"))
+
+    assert _mode(target) == 0o666 & ~umask
+
+
+def test_atomic_write_keeps_existing_permissions(tmp_path):
+    target = tmp_path / "export.csv"
+    target.write_text("old", encoding="utf-8")
+    os.chmod(target, 0o640)
+
+    atomic_write(target, lambda tmp: tmp.write_text("new", encoding="utf-8"))
+
+    assert target.read_text(encoding="utf-8") == "new"
+    assert _mode(target) == 0o640
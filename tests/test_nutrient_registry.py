@@ -0,0 +1,63 @@
+import copy
+
+from services.label_builder import formulation_totals
+from services.nutrient_registry import NutrientRegistry, get_registry
+
+ITEMS = [
+    {
+        "amount_g": 60.0,
+        "data_type": "Foundation",
+        "nutrients": [
+            {"nutrient": {"name": "Protein", "unitName": "g", "number": "203"}, "amount": 10.0},
+            {"nutrient": {"name": "Sodium, Na", "unitName": "mg", "number": "307"}, "amount": 400.0},
+        ],
+    },
+    {
+        "amount_g": 40.0,
+        "data_type": "Foundation",
+        "nutrients": [
+            {"nutrient": {"name": "Protein", "unitName": "g", "number": "203"}, "amount": 2.5},
+            {"nutrient": {"name": "Calcium, Ca", "unitName": "mg", "number": "301"}, "amount": 120.0},
+        ],
+    },
+]
+
+
+def _amounts(totals):
+    return {key: round(total["amount"], 9) for key, total in totals.items()}
+
+
+def test_formulation_totals_with_prepopulated_registry():
+    registry = NutrientRegistry()
+    # Intern unrelated nutrients first so IDs differ from the global registry's.
+    for index in range(50):
+        registry.resolve({"name": f"Padding {index}", "unitName": "g"})
+
+    expected = _amounts(formulation_totals(copy.deepcopy(ITEMS)))
+    global_size = len(get_registry())
+    totals = formulation_totals(copy.deepcopy(ITEMS), registry)
+
+    assert _amounts(totals) == expected
+    assert len(get_registry()) == global_size
+    assert all(registry.info(total["nid"]).key == key for key, total in totals.items())
+
+
+def test_formulation_totals_fills_an_empty_registry():
+    registry = NutrientRegistry()
+    global_size = len(get_registry())
+
+    formulation_totals(copy.deepcopy(ITEMS), registry)
+
+    assert len(registry) > 0
+    assert len(get_registry()) == global_size
+
+
+def test_interning_a_new_nutrient_keeps_the_version():
+    registry = NutrientRegistry()
+    registry.resolve({"name": "Protein", "unitName": "g", "number": "203"})
+    version = registry.version
+
+    nid = registry.resolve({"name": "Selenium, Se", "unitName": "µg", "number": "317"})
+
+    assert nid is not None
+    assert registry.version == version
@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from pathlib import Path
+
+from PySide6.QtCore import QLineF, QMarginsF, QRect, QRectF, QSize, QSizeF, Qt
+from PySide6.QtGui import (
+    QColor,
+    QFont,
+    QFontMetricsF,
+    QImage,
+    QPageLayout,
+    QPageSize,
+    QPainter,
+    QPaintDevice,
+    QPdfWriter,
+    QPen,
+)
+from PySide6.QtSvg import QSvgGenerator
+
+from services.label_builder import LabelRow, NutritionLabel
+from ui.label_table import LABEL_GRID_COLOR, LABEL_TEXT_COLOR
+
+POINTS_PER_INCH = 72.0
+LABEL_FORMATS = (".png", ".svg", ".pdf")
+
+
+@dataclass(frozen=True)
+class LabelStyle:
+    """Label geometry in points (1/72 in), so one layout serves every output resolution."""
+
+    width_pt: float = 315.0  # the 420 px preview table at 96 dpi
+    margin_pt: float = 1.5
+    cell_padding_pt: float = 3.0
+    row_padding_pt: float = 2.25
+    grid_width_pt: float = 0.75
+    font_family: str = ""  # empty: application font
+    font_size_pt: float = 0.0  # 0: application font size
+    highlight_manual: bool = False
+    manual_color: str = "#ccffcc"
+
+
+@dataclass(frozen=True)
+class _Row:
+    kind: str  # "span", "header" or "nutrient"
+    top: float
+    height: float
+    texts: tuple[str, ...]
+    font: QFont
+    align: Qt.AlignmentFlag
+    nutrient: LabelRow | None = None
+
+
+@dataclass(frozen=True)
+class _Layout:
+    rows: list[_Row]
+    scale: float  # device pixels per point
+    width: float
+    height: float
+
+
+class LabelRenderer:
+    """
+    Paint a NutritionLabel straight from label data onto any QPaintDevice.
+
+    Mirrors the preview table (title, portion, header, nutrient grid, note, footer)
+    without touching a widget, so raster output at any DPI, SVG and PDF share one layout.
+    """
+
+    def __init__(self, label: NutritionLabel, style: LabelStyle | None = None) -> None:
+        self.label = label
+        self.style = style or LabelStyle()
+
+    def _fonts(self) -> tuple[QFont, QFont, QFont]:
+        body = QFont(self.style.font_family) if self.style.font_family else QFont()
+        if self.style.font_size_pt > 0:
+            body.setPointSizeF(self.style.font_size_pt)
+        bold = QFont(body)
+        bold.setBold(True)
+        title = QFont(bold)
+        title.setPointSizeF(body.pointSizeF() + 1)
+        return body, bold, title
+
+    def _layout(self, device: QPaintDevice) -> _Layout:
+        """Row geometry in device pixels; fonts are measured on the target device."""
+        style = self.style
+        label = self.label
+        scale = device.logicalDpiY() / POINTS_PER_INCH
+        width = math.ceil(style.width_pt * scale)
+        margin = style.margin_pt * scale
+        text_width = width - 2 * margin - 2 * style.cell_padding_pt * scale
+        body, bold, title = self._fonts()
+        wrap = Qt.AlignLeft | Qt.AlignVCenter | Qt.TextWordWrap
+
+        specs: list[tuple[str, tuple[str, ...], QFont, Qt.AlignmentFlag, LabelRow | None]] = [
+            ("span", (label.title,), title, Qt.AlignCenter, None),
+            ("span", (label.portion_text,), body, Qt.AlignCenter, None),
+            ("header", ("", label.amount_header, label.vd_header), bold, Qt.AlignCenter, None),
+        ]
+        for row in label.rows:
+            specs.append(("nutrient", (row.display_name, row.amount_text, row.vd_text), body, Qt.AlignCenter, row))
+        if label.no_significant_note:
+            specs.append(("span", (label.no_significant_note,), body, wrap, None))
+        specs.append(("span", (label.footer,), body, wrap, None))
+
+        rows: list[_Row] = []
+        top = margin
+        for kind, texts, font, align, nutrient in specs:
+            metrics = QFontMetricsF(font, device)
+            if align & Qt.TextWordWrap:
+                text_height = metrics.boundingRect(QRectF(0, 0, text_width, 1e6), int(align), texts[0]).height()
+            else:
+                text_height = metrics.height()
+            # Whole device pixels keep raster grid lines crisp.
+            height = math.ceil(text_height + 2 * style.row_padding_pt * scale)
+            rows.append(_Row(kind, top, height, texts, font, align, nutrient))
+            top += height
+        return _Layout(rows, scale, width, math.ceil(top + margin))
+
+    def _paint(self, painter: QPainter, layout: _Layout, with_background: bool) -> None:
+        style = self.style
+        scale = layout.scale
+        margin = style.margin_pt * scale
+        padding = style.cell_padding_pt * scale
+        left = margin
+        right = layout.width - margin
+        column = (right - left) / 3
+        bounds = [left, left + column, left + 2 * column, right]
+
+        if with_background:
+            painter.fillRect(QRectF(0, 0, layout.width, layout.height), Qt.white)
+        painter.setRenderHint(QPainter.Antialiasing, False)
+        painter.setRenderHint(QPainter.TextAntialiasing, True)
+        no_clip = int(Qt.TextDontClip)
+
+        for row in layout.rows:
+            if style.highlight_manual and row.nutrient is not None and row.nutrient.manual:
+                painter.fillRect(QRectF(left, row.top, right - left, row.height), QColor(style.manual_color))
+            painter.setPen(LABEL_TEXT_COLOR)
+            painter.setFont(row.font)
+            if row.kind == "span":
+                rect = QRectF(left + padding, row.top, right - left - 2 * padding, row.height)
+                painter.drawText(rect, int(row.align) | no_clip, row.texts[0])
+                continue
+            name, amount, vd = row.texts
+            if name:
+                # Names are not clipped: breakdown rows run into the (line-free) amount column.
+                rect = QRectF(bounds[0] + padding, row.top, bounds[1] - bounds[0] - padding, row.height)
+                painter.drawText(rect, int(Qt.AlignLeft | Qt.AlignVCenter) | no_clip, name)
+            for index, text in ((1, amount), (2, vd)):
+                rect = QRectF(bounds[index], row.top, bounds[index + 1] - bounds[index], row.height)
+                painter.drawText(rect, int(row.align) | no_clip, text)
+
+        pen = QPen(LABEL_GRID_COLOR)
+        pen.setWidthF(max(1.0, round(style.grid_width_pt * scale)))
+        painter.setPen(pen)
+        top = layout.rows[0].top
+        lines = [QLineF(left, top, right, top)]
+        for row in layout.rows:
+            bottom = row.top + row.height
+            lines.append(QLineF(left, bottom, right, bottom))
+            lines.append(QLineF(left, row.top, left, bottom))
+            lines.append(QLineF(right, row.top, right, bottom))
+            if row.kind == "nutrient" and not row.nutrient.breakdown_child:
+                for x in bounds[1:3]:
+                    lines.append(QLineF(x, row.top, x, bottom))
+        painter.drawLines(lines)
+
+    def to_image(self, dpi: float = 96, with_background: bool = True) -> QImage:
+        """Raster label at ``dpi``; transparent backgrounds come straight from the painter."""
+        dots_per_meter = round(dpi / 0.0254)
+        probe = QImage(1, 1, QImage.Format_ARGB32_Premultiplied)
+        probe.setDotsPerMeterX(dots_per_meter)
+        probe.setDotsPerMeterY(dots_per_meter)
+        layout = self._layout(probe)
+
+        # Gray strokes on white need one channel: a quarter of the pixels to paint and encode.
+        grayscale = with_background and not self.style.highlight_manual
+        image_format = QImage.Format_Grayscale8 if grayscale else QImage.Format_ARGB32_Premultiplied
+        image = QImage(int(layout.width), int(layout.height), image_format)
+        image.setDotsPerMeterX(dots_per_meter)
+        image.setDotsPerMeterY(dots_per_meter)
+        image.fill(Qt.white if with_background else Qt.transparent)
+        painter = QPainter(image)
+        try:
+            self._paint(painter, layout, with_background=False)
+        finally:
+            painter.end()
+        return image
+
+    def save_svg(self, path: str | Path, dpi: float = 96, with_background: bool = True) -> bool:
+        generator = QSvgGenerator()
+        generator.setFileName(str(path))
+        generator.setResolution(int(dpi))
+        generator.setTitle(self.label.title)
+        layout = self._layout(generator)
+        size = QSize(int(layout.width), int(layout.height))
+        generator.setSize(size)
+        generator.setViewBox(QRect(0, 0, size.width(), size.height()))
+        painter = QPainter()
+        if not painter.begin(generator):
+            return False
+        try:
+            self._paint(painter, layout, with_background)
+        finally:
+            painter.end()
+        return True
+
+    def save_pdf(self, path: str | Path, dpi: float = 600, with_background: bool = True) -> bool:
+        writer = QPdfWriter(str(path))
+        writer.setResolution(int(dpi))
+        writer.setTitle(self.label.title)
+        layout = self._layout(writer)
+        page_size = QSizeF(layout.width / layout.scale, layout.height / layout.scale)
+        writer.setPageLayout(
+            QPageLayout(
+                QPageSize(page_size, QPageSize.Point, "", QPageSize.ExactMatch),
+                QPageLayout.Portrait,
+                QMarginsF(0, 0, 0, 0),
+            )
+        )
+        painter = QPainter()
+        if not painter.begin(writer):
+            return False
+        try:
+            self._paint(painter, layout, with_background)
+        finally:
+            painter.end()
+        return True
+
+    def save(self, path: str | Path, dpi: float = 300, with_background: bool = True) -> bool:
+        """Write PNG, SVG or PDF depending on the file extension."""
+        suffix = Path(path).suffix.lower()
+        if suffix == ".svg":
+            return self.save_svg(path, dpi, with_background)
+        if suffix == ".pdf":
+            return self.save_pdf(path, dpi, with_background)
+        return self.to_image(dpi, with_background).save(str(path), "PNG")
@@ -0,0 +1,465 @@
+from __future__ import annotations
+
+from PySide6.QtCore import QItemSelectionModel, QPoint, Qt
+from PySide6.QtGui import QBrush, QColor, QFont, QIcon, QImage, QPainter, QPalette, QPen
+from PySide6.QtWidgets import (
+    QApplication,
+    QHeaderView,
+    QStyle,
+    QStyledItemDelegate,
+    QStyleOptionViewItem,
+    QTableWidget,
+    QTableWidgetItem,
+    QWidget,
+)
+
+from services.label_builder import NutritionLabel
+from services.nutrition_label import BASE_LABEL_NUTRIENTS
+
+# Stroke colors of the rendered label (text and grid lines).
+LABEL_TEXT_COLOR = QColor("#272727")
+LABEL_GRID_COLOR = QColor("#c0c0c0")
+
+
+class LabelTableDelegate(QStyledItemDelegate):
+    """Custom grid painter to hide vertical separators for fat breakdown rows."""
+
+    def __init__(
+        self,
+        fat_row_role: int,
+        parent: QWidget | None = None,
+        manual_role: int | None = None,
+        manual_color: QColor | None = None,
+    ) -> None:
+        super().__init__(parent)
+        self.fat_row_role = fat_row_role
+        self.header_span_role = None
+        self.manual_role = manual_role
+        self.manual_color = manual_color or QColor(204, 255, 204)
+        self.manual_overlay = QColor(0, 0, 0, 50)
+        self.selection_fill_active = QColor(0, 0, 0, 22)
+        self.selection_fill_inactive = QColor(0, 0, 0, 12)
+        # Color fijo para la barrita de selección personalizada
+        self.handle_color = QColor("#1f6fbd")
+        self.grid_color = QColor("#c0c0c0")
+
+    def paint(self, painter: QPainter, option, index) -> None:  # type: ignore[override]
+        is_fat_child = bool(index.data(self.fat_row_role))
+        is_header_span = bool(self.header_span_role and index.data(self.header_span_role))
+        is_manual = bool(self.manual_role and index.data(self.manual_role))
+        is_selected = bool(option.state & QStyle.State_Selected)
+        is_active = bool(option.state & QStyle.State_Active)
+
+        # Base fill for manual values (under the text/content).
+        if is_manual:
+            painter.save()
+            painter.fillRect(option.rect, self.manual_color)
+            if is_selected:
+                painter.fillRect(option.rect, self.manual_overlay)
+            painter.restore()
+        elif is_selected:
+            painter.save()
+            painter.fillRect(option.rect, self.selection_fill_active if is_active else self.selection_fill_inactive)
+            painter.restore()
+
+        # For fat-child name column, avoid elide and draw across the adjacent amount column.
+        if (is_fat_child and index.column() == 0) or (is_header_span and index.column() == 1):
+            opt = QStyleOptionViewItem(option)
+            self.initStyleOption(opt, index)
+            opt.state &= ~(QStyle.State_HasFocus | QStyle.State_Selected)
+            opt.palette.setBrush(QPalette.Base, Qt.transparent)
+            opt.palette.setBrush(QPalette.Window, Qt.transparent)
+            opt.palette.setBrush(QPalette.AlternateBase, Qt.transparent)
+            opt.palette.setBrush(QPalette.Highlight, Qt.transparent)
+            opt.palette.setBrush(QPalette.HighlightedText, opt.palette.brush(QPalette.Text))
+            opt.backgroundBrush = QBrush(Qt.transparent)
+            opt.text = ""
+            opt.icon = QIcon()
+            style = opt.widget.style() if opt.widget else QApplication.style()
+            style.drawControl(QStyle.CE_ItemViewItem, opt, painter, opt.widget)
+
+            painter.save()
+            text_rect = opt.rect
+            extra = 0
+            if is_fat_child:
+                try:
+                    extra = opt.widget.columnWidth(1) - 6  # leave small gap before amount text
+                except Exception:
+                    extra = 0
+                if extra > 0:
+                    text_rect.setWidth(text_rect.width() + extra)
+                text_rect.adjust(4, 0, -2, 0)  # small padding, avoid hitting amount text
+                align = Qt.AlignLeft | Qt.AlignVCenter
+            else:
+                # Header span: extend into VD column to avoid elide, keep centered on its own column.
+                try:
+                    extra = opt.widget.columnWidth(2) - 6
+                except Exception:
+                    extra = 0
+                if extra > 0:
+                    shift = extra // 2
+                    text_rect.adjust(-shift, 0, extra - shift, 0)
+                text_rect.adjust(0, 0, -2, 0)
+                align = Qt.AlignCenter
+            painter.setPen(opt.palette.color(QPalette.Text))
+            painter.setFont(opt.font)
+            painter.drawText(text_rect, align, str(index.data() or ""))
+            painter.restore()
+        else:
+            # Camino normal sin super().paint para evitar que Qt re-inserte State_Selected
+            base_opt = QStyleOptionViewItem(option)
+            self.initStyleOption(base_opt, index)
+            # Quitar selección/foco para que Qt no pinte su highlight nativo
+            base_opt.state &= ~(QStyle.State_HasFocus | QStyle.State_Selected)
+            base_opt.palette.setBrush(QPalette.Base, Qt.transparent)
+            base_opt.palette.setBrush(QPalette.Window, Qt.transparent)
+            base_opt.palette.setBrush(QPalette.AlternateBase, Qt.transparent)
+            base_opt.palette.setBrush(QPalette.Highlight, Qt.transparent)
+            base_opt.palette.setBrush(QPalette.HighlightedText, base_opt.palette.brush(QPalette.Text))
+            base_opt.backgroundBrush = QBrush(Qt.transparent)
+            # Dibujar manualmente el item (lo que hace QStyledItemDelegate por dentro)
+            style = base_opt.widget.style() if base_opt.widget else QApplication.style()
+            style.drawControl(QStyle.CE_ItemViewItem, base_opt, painter, base_opt.widget)
+
+        painter.save()
+        pen = QPen(self.grid_color)
+        painter.setPen(pen)
+        rect = option.rect
+        last_col = index.model().columnCount() - 1
+
+        # Horizontal lines
+        painter.drawLine(rect.bottomLeft(), rect.bottomRight())
+        if index.row() == 0:
+            painter.drawLine(rect.topLeft(), rect.topRight())
+
+        # Left border on first column
+        if index.column() == 0:
+            painter.drawLine(rect.topLeft(), rect.bottomLeft())
+
+        # Right border (skip inner separators for fat breakdown rows and header span left edge)
+        skip_right = False
+        if is_fat_child and index.column() < last_col:
+            skip_right = True
+        if is_header_span and index.column() in (0, 1):
+            skip_right = True
+        if not skip_right:
+            painter.drawLine(rect.topRight(), rect.bottomRight())
+
+        painter.restore()
+
+        # Draw selection bar on all selected cells (our custom handle)
+        if is_selected:
+            painter.save()
+            self._draw_selection_handles(painter, option.rect, option.palette, index)
+            painter.restore()
+
+    def _draw_selection_handles(self, painter: QPainter, rect, palette: QPalette, index) -> None:
+        """Draw thin selection marker on the left edge of the cell."""
+        color = self.handle_color
+        width = 2
+        painter.fillRect(rect.left(), rect.top(), width, rect.height(), color)
+
+
+class LabelTableWidget(QTableWidget):
+    """
+    Nutrition label laid out as a three column table.
+
+    Filled from a NutritionLabel, so the same widget backs the GUI preview and
+    offscreen rendering (e.g. batch label export) without a MainWindow.
+    """
+
+    FAT_ROW_ROLE = Qt.UserRole + 501
+    HEADER_SPAN_ROLE = Qt.UserRole + 502
+    MANUAL_ROLE = Qt.UserRole + 503
+    TITLE_ROW = 0
+    PORTION_ROW = 1
+    HEADER_ROW = 2
+    NUTRIENT_START_ROW = 3
+
+    def __init__(self, parent: QWidget | None = None, manual_hint_color: QColor | None = None) -> None:
+        super().__init__(parent)
+        self.manual_hint_color = manual_hint_color or QColor(204, 255, 204)
+        self.label: NutritionLabel | None = None
+        self.footer_row = self.NUTRIENT_START_ROW + len(BASE_LABEL_NUTRIENTS)
+        self._setup_table()
+
+    def _setup_table(self) -> None:
+        table = self
+        table.setColumnCount(3)
+        table.setRowCount(self.footer_row + 2)
+        table.setEditTriggers(QTableWidget.NoEditTriggers)
+        table.setSelectionMode(QTableWidget.ExtendedSelection)
+        table.setSelectionBehavior(QTableWidget.SelectRows)
+        table.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
+        table.horizontalHeader().setVisible(False)
+        table.verticalHeader().setVisible(False)
+        table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        table.setMinimumHeight(360)
+        table.setAutoFillBackground(False)
+        table.viewport().setAutoFillBackground(False)
+        table.setAttribute(Qt.WA_TranslucentBackground, True)
+        table.viewport().setAttribute(Qt.WA_TranslucentBackground, True)
+
+        palette = table.palette()
+        palette.setColor(QPalette.Base, Qt.transparent)
+        palette.setColor(QPalette.Window, Qt.transparent)
+        palette.setColor(QPalette.AlternateBase, Qt.transparent)
+        # Highlight nativo -> transparente, mantiene color de texto
+        text_color = palette.color(QPalette.Text)
+        palette.setColor(QPalette.Highlight, Qt.transparent)
+        palette.setColor(QPalette.HighlightedText, text_color)
+        table.setPalette(palette)
+        table.viewport().setPalette(palette)
+        table.setStyleSheet(
+            """
+            QTableWidget {
+                gridline-color: #c0c0c0;
+                background-color: transparent;
+                alternate-background-color: transparent;
+            }
+            /* Desactiva el highlight nativo (fondo/borde) para que solo se use el delegado */
+            QTableWidget::item:selected,
+            QTableWidget::item:selected:!active {
+                selection-background-color: transparent;
+                selection-color: #000;
+                background-color: transparent;
+                color: #000;
+                border: none;
+                outline: none;
+            }
+            QTableWidget::item:focus {
+                border: none;
+                outline: none;
+            }
+            QHeaderView::section {
+                background-color: transparent;
+            }
+            QTableCornerButton::section {
+                background-color: transparent;
+            }
+            """
+        )
+        table.setShowGrid(False)
+        table.setWordWrap(True)
+        delegate = LabelTableDelegate(
+            self.FAT_ROW_ROLE,
+            table,
+            manual_role=self.MANUAL_ROLE,
+            manual_color=self.manual_hint_color,
+        )
+        delegate.header_span_role = self.HEADER_SPAN_ROLE
+        table.setItemDelegate(delegate)
+
+    def set_label(self, label: NutritionLabel) -> None:
+        """Lay out a built label: title, portion, header, nutrient rows, note and footer."""
+        table = self
+        self.label = label
+        table.clearSpans()
+
+        total_rows = self.NUTRIENT_START_ROW + len(label.rows) + (1 if label.no_significant_note else 0) + 1
+        table.setRowCount(total_rows)
+
+        title_item = QTableWidgetItem(label.title)
+        title_font = title_item.font()
+        title_font.setBold(True)
+        title_font.setPointSize(title_font.pointSize() + 1)
+        title_item.setFont(title_font)
+        title_item.setTextAlignment(Qt.AlignCenter)
+        table.setItem(0, 0, title_item)
+
+        portion_item = QTableWidgetItem(label.portion_text)
+        portion_item.setTextAlignment(Qt.AlignCenter)
+        table.setItem(1, 0, portion_item)
+
+        header_font = QFont()
+        header_font.setBold(True)
+        header_item_amount = QTableWidgetItem(label.amount_header)
+        header_item_amount.setFont(header_font)
+        header_item_amount.setTextAlignment(Qt.AlignCenter)
+        header_item_vd = QTableWidgetItem(label.vd_header)
+        header_item_vd.setFont(header_font)
+        header_item_vd.setTextAlignment(Qt.AlignCenter)
+        header_placeholder = QTableWidgetItem("")
+        header_placeholder.setFlags(header_placeholder.flags() & ~Qt.ItemIsSelectable & ~Qt.ItemIsEditable)
+        header_placeholder.setData(self.HEADER_SPAN_ROLE, True)
+        header_item_amount.setData(self.HEADER_SPAN_ROLE, True)
+        header_item_vd.setData(self.HEADER_SPAN_ROLE, True)
+        table.setItem(2, 1, header_item_amount)
+        table.setItem(2, 2, header_item_vd)
+        table.setItem(2, 0, header_placeholder)
+
+        manual_brush = QBrush(self.manual_hint_color)
+        for idx, label_row in enumerate(label.rows):
+            row = self.NUTRIENT_START_ROW + idx
+            name_item = QTableWidgetItem(label_row.display_name)
+            amount_item = QTableWidgetItem(label_row.amount_text)
+            vd_item = QTableWidgetItem(label_row.vd_text)
+            name_item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+            amount_item.setTextAlignment(Qt.AlignCenter)
+            vd_item.setTextAlignment(Qt.AlignCenter)
+            for itm in (name_item, amount_item, vd_item):
+                itm.setData(self.MANUAL_ROLE, label_row.manual)
+                itm.setData(self.FAT_ROW_ROLE, label_row.breakdown_child)
+                if label_row.manual:
+                    itm.setBackground(manual_brush)
+            table.setItem(row, 0, name_item)
+            table.setItem(row, 1, amount_item)
+            table.setItem(row, 2, vd_item)
+
+        note_row = self.NUTRIENT_START_ROW + len(label.rows)
+        if label.no_significant_note:
+            note_item = QTableWidgetItem(label.no_significant_note)
+            note_item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+            table.setItem(note_row, 0, note_item)
+            table.setSpan(note_row, 0, 1, 3)
+            footer_row = note_row + 1
+        else:
+            footer_row = note_row
+
+        footer_item = QTableWidgetItem(label.footer)
+        footer_item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+        table.setItem(footer_row, 0, footer_item)
+        table.setSpan(0, 0, 1, 3)
+        table.setSpan(1, 0, 1, 3)
+        table.setSpan(footer_row, 0, 1, 3)
+        self.footer_row = footer_row
+        # Fix height for single-line rows (all menos notas/final), allow wrapping only on notes/footer.
+        base_height = table.fontMetrics().height() + 6
+        wrap_rows = {footer_row}
+        if label.no_significant_note:
+            wrap_rows.add(note_row)
+        for r in range(table.rowCount()):
+            if r in wrap_rows:
+                table.resizeRowToContents(r)
+            else:
+                table.setRowHeight(r, base_height)
+
+    def render_image(self, with_background: bool) -> QImage | None:
+        """Render the table as an image, white or transparent background; None if empty."""
+        table = self
+
+        header = table.horizontalHeader()
+        content_width = header.length()
+        if content_width <= 0:
+            content_width = sum(table.columnWidth(c) for c in range(table.columnCount()))
+
+        v_header = table.verticalHeader()
+        content_height = v_header.length()
+        if content_height <= 0:
+            content_height = sum(table.rowHeight(r) for r in range(table.rowCount()))
+
+        padding = 2
+        content_width += table.frameWidth() * 2
+        content_height += table.frameWidth() * 2
+        export_width = content_width + padding * 2
+        export_height = content_height + padding * 2
+
+        if content_width <= 0 or content_height <= 0:
+            return None
+
+        original_size = table.size()
+        original_style = table.styleSheet()
+        original_palette = table.palette()
+        original_autofill = table.autoFillBackground()
+        original_viewport_autofill = table.viewport().autoFillBackground()
+        original_h_policy = table.horizontalScrollBarPolicy()
+        original_v_policy = table.verticalScrollBarPolicy()
+        original_table_attr = table.testAttribute(Qt.WA_TranslucentBackground)
+        original_viewport_attr = table.viewport().testAttribute(Qt.WA_TranslucentBackground)
+
+        sel_model = table.selectionModel()
+        selected_indexes = list(sel_model.selectedIndexes()) if sel_model else []
+        table.clearSelection()
+
+        cleared_backgrounds: list[tuple[int, int, QBrush]] = []
+        for r in range(table.rowCount()):
+            for c in range(table.columnCount()):
+                item = table.item(r, c)
+                if not item:
+                    continue
+                bg = item.background()
+                if bg.style() != Qt.NoBrush:
+                    cleared_backgrounds.append((r, c, bg))
+                    item.setBackground(QBrush(Qt.transparent))
+
+        try:
+            table.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+            table.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+            table.setAttribute(Qt.WA_TranslucentBackground, True)
+            table.viewport().setAttribute(Qt.WA_TranslucentBackground, True)
+            table.viewport().setAutoFillBackground(False)
+            table.setAutoFillBackground(False)
+
+            pal = QPalette(table.palette())
+            pal.setColor(QPalette.Text, QColor("#272727"))
+            pal.setColor(QPalette.WindowText, QColor("#272727"))
+            grid_color = "#c0c0c0"
+            if with_background:
+                pal.setColor(QPalette.Base, Qt.white)
+                pal.setColor(QPalette.Window, Qt.white)
+                pal.setColor(QPalette.AlternateBase, Qt.white)
+                fill_color = Qt.white
+                bg_style = "background-color: white; alternate-background-color: white;"
+            else:
+                pal.setColor(QPalette.Base, Qt.transparent)
+                pal.setColor(QPalette.Window, Qt.transparent)
+                pal.setColor(QPalette.AlternateBase, Qt.transparent)
+                fill_color = Qt.transparent
+                bg_style = (
+                    "background-color: transparent; "
+                    "alternate-background-color: transparent; "
+                    "selection-background-color: transparent;"
+                )
+
+            table.setAutoFillBackground(False)
+            table.setPalette(pal)
+            table.setStyleSheet(
+                f"{original_style} "
+                f"QTableWidget {{ {bg_style} gridline-color: {grid_color}; }} "
+                "QTableWidget::viewport { background: transparent; } "
+                "QHeaderView::section { background-color: transparent; } "
+                "QTableCornerButton::section { background-color: transparent; } "
+            )
+
+            table.resize(content_width, content_height)
+
+            scale = 1.0 if with_background else 2.0
+            scaled_width = int(export_width * scale)
+            scaled_height = int(export_height * scale)
+            image = QImage(scaled_width, scaled_height, QImage.Format_ARGB32_Premultiplied)
+            image.fill(fill_color)
+
+            painter = QPainter(image)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setRenderHint(QPainter.TextAntialiasing)
+            if not with_background:
+                painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.translate(padding * scale, padding * scale)
+            painter.scale(scale, scale)
+            table.render(painter, QPoint(0, 0))
+            painter.end()
+            if scale != 1.0:
+                image = image.scaled(
+                    export_width,
+                    export_height,
+                    Qt.IgnoreAspectRatio,
+                    Qt.SmoothTransformation,
+                )
+            return image
+        finally:
+            table.resize(original_size)
+            table.setStyleSheet(original_style)
+            table.setPalette(original_palette)
+            table.setAutoFillBackground(original_autofill)
+            table.viewport().setAutoFillBackground(original_viewport_autofill)
+            table.setHorizontalScrollBarPolicy(original_h_policy)
+            table.setVerticalScrollBarPolicy(original_v_policy)
+            table.setAttribute(Qt.WA_TranslucentBackground, original_table_attr)
+            table.viewport().setAttribute(Qt.WA_TranslucentBackground, original_viewport_attr)
+            for r, c, bg in cleared_backgrounds:
+                item = table.item(r, c)
+                if item:
+                    item.setBackground(bg)
+            if sel_model:
+                for idx in selected_indexes:
+                    sel_model.select(idx, QItemSelectionModel.Select)
@@ -1,13 +1,10 @@
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List
 from pathlib import Path
 import json
 import re
-import unicodedata
 import os
-from fractions import Fraction
-import math
 
-from PySide6.QtCore import QObject, QThread, Qt, QItemSelectionModel, QCoreApplication, QTimer, QEvent, QPoint
+from PySide6.QtCore import QObject, QThread, Qt, QItemSelectionModel, QCoreApplication, QTimer, QEvent, Signal
 from PySide6.QtGui import (
     QIcon,
     QPixmap,
@@ -16,10 +13,6 @@ from PySide6.QtGui import (
     QFont,
     QKeySequence,
     QShortcut,
-    QBrush,
-    QPalette,
-    QImage,
-    QPen,
 )
 from PySide6.QtWidgets import (
     QComboBox,
@@ -36,11 +29,13 @@ from PySide6.QtWidgets import (
     QMessageBox,
     QDialog,
     QDialogButtonBox,
+    QDoubleSpinBox,
     QListWidget,
     QListWidgetItem,
     QPlainTextEdit,
     QPushButton,
     QSpinBox,
+    QTableView,
     QTableWidget,
     QTableWidgetItem,
     QSizePolicy,
@@ -49,25 +44,66 @@ from PySide6.QtWidgets import (
     QTabWidget,
     QVBoxLayout,
     QWidget,
-    QStyledItemDelegate,
-    QStyleOptionViewItem,
-    QStyle,
 )
-import pandas as pd
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import PatternFill, Alignment
 
 import logging
 
 from services.usda_api import USDAApiError, get_food_details, search_foods, has_cached_food
 from services.nutrient_normalizer import (
     augment_fat_nutrients,
-    canonical_alias_name,
-    canonical_unit,
     normalize_nutrients,
 )
-from ui.workers import ApiWorker, ImportWorker, AddWorker
+from services.autosave import AutosaveJournal, load_autosave, portable_item
+from services.formulation_compare import FormulationComparison, compare_formulations
+from services.formulation_engine import FormulationEngine
+from services.formulation_history import FormulationHistory, FormulationState, journal_operations
+from services.formulation_optimizer import NutrientTarget, optimize_formulation
+from services.percent_solver import InfeasiblePercents, redistribute_percents
+from services.formulation_export import (
+    collect_nutrient_columns,
+    state_payload,
+    write_formulation_workbook,
+    write_state_json,
+)
+from services.formulation_io import (
+    FormulationFileError,
+    hydrate_item,
+    load_formulation_file,
+    sheet_mismatches,
+)
+from services.label_builder import (
+    HOUSEHOLD_MEASURE_OPTIONS,
+    NutritionLabel,
+    build_label_from_evaluation,
+    fraction_from_ratio,
+)
+from services.nutrition_label import (
+    ADDITIONAL_LABEL_NUTRIENTS,
+    BASE_LABEL_NUTRIENTS,
+    LABEL_NUTRIENT_USDA_MAP,
+    NO_SIGNIFICANT_DISPLAY_MAP,
+    NO_SIGNIFICANT_ORDER,
+    NO_SIGNIFICANT_THRESHOLDS,
+    LabelEvaluation,
+    LabelEvaluationCache,
+    LabelSettings,
+    sort_no_significant,
+)
+from services.nutrient_registry import (
+    assign_nutrient_ids,
+    get_registry,
+    sort_nutrients_for_display,
+)
+from ui.label_table import LabelTableWidget
+from ui.label_renderer import LABEL_FORMATS, LabelRenderer
+from ui.models import (
+    FormulationTableModel,
+    SearchResultsModel,
+    SearchResultsProxyModel,
+    TotalsTableModel,
+)
+from ui.refresh_scheduler import RefreshScheduler
+from ui.workers import ApiWorker, ImportWorker, AddWorker, ComputeWorker, ExportWorker
 
 logging.basicConfig(
     filename="app_debug.log",
@@ -75,147 +111,13 @@ logging.basicConfig(
     format="%(asctime)s [%(threadName)s] %(levelname)s %(message)s",
 )
 
-
-class LabelTableDelegate(QStyledItemDelegate):
-    """Custom grid painter to hide vertical separators for fat breakdown rows."""
-
-    def __init__(
-        self,
-        fat_row_role: int,
-        parent: QWidget | None = None,
-        manual_role: int | None = None,
-        manual_color: QColor | None = None,
-    ) -> None:
-        super().__init__(parent)
-        self.fat_row_role = fat_row_role
-        self.header_span_role = None
-        self.manual_role = manual_role
-        self.manual_color = manual_color or QColor(204, 255, 204)
-        self.manual_overlay = QColor(0, 0, 0, 50)
-        self.selection_fill_active = QColor(0, 0, 0, 22)
-        self.selection_fill_inactive = QColor(0, 0, 0, 12)
-        # Color fijo para la barrita de selección personalizada
-        self.handle_color = QColor("#1f6fbd")
-        self.grid_color = QColor("#c0c0c0")
-
-    def paint(self, painter: QPainter, option, index) -> None:  # type: ignore[override]
-        is_fat_child = bool(index.data(self.fat_row_role))
-        is_header_span = bool(self.header_span_role and index.data(self.header_span_role))
-        is_manual = bool(self.manual_role and index.data(self.manual_role))
-        is_selected = bool(option.state & QStyle.State_Selected)
-        is_active = bool(option.state & QStyle.State_Active)
-
-        # Base fill for manual values (under the text/content).
-        if is_manual:
-            painter.save()
-            painter.fillRect(option.rect, self.manual_color)
-            if is_selected:
-                painter.fillRect(option.rect, self.manual_overlay)
-            painter.restore()
-        elif is_selected:
-            painter.save()
-            painter.fillRect(option.rect, self.selection_fill_active if is_active else self.selection_fill_inactive)
-            painter.restore()
-
-        # For fat-child name column, avoid elide and draw across the adjacent amount column.
-        if (is_fat_child and index.column() == 0) or (is_header_span and index.column() == 1):
-            opt = QStyleOptionViewItem(option)
-            self.initStyleOption(opt, index)
-            opt.state &= ~(QStyle.State_HasFocus | QStyle.State_Selected)
-            opt.palette.setBrush(QPalette.Base, Qt.transparent)
-            opt.palette.setBrush(QPalette.Window, Qt.transparent)
-            opt.palette.setBrush(QPalette.AlternateBase, Qt.transparent)
-            opt.palette.setBrush(QPalette.Highlight, Qt.transparent)
-            opt.palette.setBrush(QPalette.HighlightedText, opt.palette.brush(QPalette.Text))
-            opt.backgroundBrush = QBrush(Qt.transparent)
-            opt.text = ""
-            opt.icon = QIcon()
-            style = opt.widget.style() if opt.widget else QApplication.style()
-            style.drawControl(QStyle.CE_ItemViewItem, opt, painter, opt.widget)
-
-            painter.save()
-            text_rect = opt.rect
-            extra = 0
-            if is_fat_child:
-                try:
-                    extra = opt.widget.columnWidth(1) - 6  # leave small gap before amount text
-                except Exception:
-                    extra = 0
-                if extra > 0:
-                    text_rect.setWidth(text_rect.width() + extra)
-                text_rect.adjust(4, 0, -2, 0)  # small padding, avoid hitting amount text
-                align = Qt.AlignLeft | Qt.AlignVCenter
-            else:
-                # Header span: extend into VD column to avoid elide, keep centered on its own column.
-                try:
-                    extra = opt.widget.columnWidth(2) - 6
-                except Exception:
-                    extra = 0
-                if extra > 0:
-                    shift = extra // 2
-                    text_rect.adjust(-shift, 0, extra - shift, 0)
-                text_rect.adjust(0, 0, -2, 0)
-                align = Qt.AlignCenter
-            painter.setPen(opt.palette.color(QPalette.Text))
-            painter.setFont(opt.font)
-            painter.drawText(text_rect, align, str(index.data() or ""))
-            painter.restore()
-        else:
-            # Camino normal sin super().paint para evitar que Qt re-inserte State_Selected
-            base_opt = QStyleOptionViewItem(option)
-            self.initStyleOption(base_opt, index)
-            # Quitar selección/foco para que Qt no pinte su highlight nativo
-            base_opt.state &= ~(QStyle.State_HasFocus | QStyle.State_Selected)
-            base_opt.palette.setBrush(QPalette.Base, Qt.transparent)
-            base_opt.palette.setBrush(QPalette.Window, Qt.transparent)
-            base_opt.palette.setBrush(QPalette.AlternateBase, Qt.transparent)
-            base_opt.palette.setBrush(QPalette.Highlight, Qt.transparent)
-            base_opt.palette.setBrush(QPalette.HighlightedText, base_opt.palette.brush(QPalette.Text))
-            base_opt.backgroundBrush = QBrush(Qt.transparent)
-            # Dibujar manualmente el item (lo que hace QStyledItemDelegate por dentro)
-            style = base_opt.widget.style() if base_opt.widget else QApplication.style()
-            style.drawControl(QStyle.CE_ItemViewItem, base_opt, painter, base_opt.widget)
-
-        painter.save()
-        pen = QPen(self.grid_color)
-        painter.setPen(pen)
-        rect = option.rect
-        last_col = index.model().columnCount() - 1
-
-        # Horizontal lines
-        painter.drawLine(rect.bottomLeft(), rect.bottomRight())
-        if index.row() == 0:
-            painter.drawLine(rect.topLeft(), rect.topRight())
-
-        # Left border on first column
-        if index.column() == 0:
-            painter.drawLine(rect.topLeft(), rect.bottomLeft())
-
-        # Right border (skip inner separators for fat breakdown rows and header span left edge)
-        skip_right = False
-        if is_fat_child and index.column() < last_col:
-            skip_right = True
-        if is_header_span and index.column() in (0, 1):
-            skip_right = True
-        if not skip_right:
-            painter.drawLine(rect.topRight(), rect.bottomRight())
-
-        painter.restore()
-
-        # Draw selection bar on all selected cells (our custom handle)
-        if is_selected:
-            painter.save()
-            self._draw_selection_handles(painter, option.rect, option.palette, index)
-            painter.restore()
-
-    def _draw_selection_handles(self, painter: QPainter, rect, palette: QPalette, index) -> None:
-        """Draw thin selection marker on the left edge of the cell."""
-        color = self.handle_color
-        width = 2
-        painter.fillRect(rect.left(), rect.top(), width, rect.height(), color)
+AUTOSAVE_DIR = Path(
+    os.getenv("FORMULATOR_AUTOSAVE_DIR") or Path.home() / ".cache" / "epic_food_formulator" / "autosave"
+)
 
 
 class MainWindow(QMainWindow):
+    compute_requested = Signal(int, object, object)
     def __init__(self) -> None:
         super().__init__()
 
@@ -226,27 +128,28 @@ class MainWindow(QMainWindow):
         self.resize(900, 600)
         self._threads: list[QThread] = []
         self._workers: list[QObject] = []
+        self._export_threads: list[QThread] = []
         self._current_import_worker: ImportWorker | None = None
         self._current_add_worker: AddWorker | None = None
         self._prefetching_fdc_ids: set[int] = set()
-        self._fat_row_role = Qt.UserRole + 501
-        self._header_span_role = Qt.UserRole + 502
-        self._manual_role = Qt.UserRole + 503
         self.formulation_items: List[Dict] = []
         self.quantity_mode: str = "g"
-        self.amount_g_column_index = 2
-        self.percent_column_index = 3
-        self.lock_column_index = 4
-        self.nutrient_export_flags: Dict[str, bool] = {}
+        # Undo/redo: snapshots share unchanged items and nutrient payloads with each other.
+        self._history = FormulationHistory()
+        self._history_state = FormulationState()
+        self.amount_g_column_index = FormulationTableModel.AMOUNT_G_COLUMN
+        self.percent_column_index = FormulationTableModel.PERCENT_COLUMN
+        self.lock_column_index = FormulationTableModel.LOCK_COLUMN
+        self.formulation_model = FormulationTableModel(self)
+        self.formulation_model.lock_toggle_requested.connect(self.on_lock_toggle_requested)
         self.last_path = self._load_last_path()
-        self.search_page = 1
-        self.search_page_size = 25
         self.search_fetch_page_size = 200
         self.search_max_pages = 5
-        self.search_results: List[Dict[str, Any]] = []
+        self.search_model = SearchResultsModel(self)
+        self.search_proxy = SearchResultsProxyModel(self)
+        self.search_proxy.setSourceModel(self.search_model)
         self.last_query = ""
         self.last_include_brands = False
-        self._last_results_count = 0
         self.data_type_priority = {
             "Foundation": 0,
             "SR Legacy": 1,
@@ -255,14 +158,30 @@ class MainWindow(QMainWindow):
             "Experimental": 3,
             "Branded": 4,
         }
-        self._reference_order_map: Dict[str, Dict[str, Any]] = {}
-        self._nutrient_catalog: list[tuple[str, list[str]]] = self._build_nutrient_catalog()
-        self._nutrient_order_map: dict[str, int] = {}
-        self._nutrient_category_map: dict[str, str] = {}
-        for idx, (_, names) in enumerate(self._nutrient_catalog):
-            for offset, name in enumerate(names):
-                self._nutrient_order_map[name.strip().lower()] = idx * 1000 + offset
-                self._nutrient_category_map[name.strip().lower()] = self._nutrient_catalog[idx][0]
+        self._registry = get_registry()
+        self._nutrient_catalog: list[tuple[str, list[str]]] = self._registry.catalog
+        self.formulation_engine = FormulationEngine(self._registry)
+        self.totals_model = TotalsTableModel(self._registry, self)
+        self.totals_model.export_flags_changed.connect(self._update_toggle_export_button)
+        self.totals_model.export_flags_changed.connect(self._journal_export_flags)
+        # Totals and label views are refreshed lazily, at most once per frame (~16 ms).
+        # The math runs in a compute thread; only the newest generation reaches the widgets.
+        self._refresh_scheduler = RefreshScheduler(self, interval_ms=16)
+        self._refresh_scheduler.register("compute", self._request_compute)
+        self._dirty_views: set[str] = set()
+        self._requested_views: set[str] = set()
+        self._compute_generation = 0
+        self._label_evaluation: LabelEvaluation | None = None
+        # One evaluation per (totals version, label settings), shared with the compute thread.
+        self._label_cache = LabelEvaluationCache()
+        self._compute_thread = QThread(self)
+        self._compute_worker = ComputeWorker(self._label_cache)
+        self._compute_worker.moveToThread(self._compute_thread)
+        self.compute_requested.connect(self._compute_worker.compute)
+        self._compute_worker.finished.connect(self._on_compute_finished)
+        self._compute_worker.error.connect(self._on_compute_error)
+        self._compute_thread.finished.connect(self._compute_worker.deleteLater)
+        self._compute_thread.start()
 
         self.label_base_nutrients = self._build_base_label_nutrients()
         self.household_measure_options = self._build_household_measure_options()
@@ -271,79 +190,210 @@ class MainWindow(QMainWindow):
         }
         self._auto_updating_household_amount = False
         self.label_manual_overrides: dict[str, float] = {}
-        self._last_totals: Dict[str, Dict[str, Any]] = {}
         self.label_no_significant: list[str] = []
         self.label_additional_selected: list[str] = []
         self._label_display_nutrients: list[Dict[str, Any]] = []
         self.label_manual_hint_color = QColor(204, 255, 204)
-        self.label_no_sig_order = [
-            "Energia",
-            "Carbohidratos",
-            "Proteinas",
-            "Grasas totales",
-            "Grasas saturadas",
-            "Grasas trans",
-            "Fibra alimentaria",
-            "Sodio",
-        ]
-        self.label_nutrient_usda_map = {
-            "Energia": "Energy (kcal)",
-            "Carbohidratos": "Carbohydrate, by difference (g)",
-            "Azúcares": "Sugars, Total (g)",
-            "Polialcoholes": "Sugar alcohol (g)",
-            "Almidón": "Starch (g)",
-            "Polidextrosas": "Polydextrose (g)",
-            "Proteinas": "Protein (g)",
-            "Grasas totales": "Total lipid (fat) (g)",
-            "Grasas saturadas": "Fatty acids, total saturated (g)",
-            "Grasas monoinsaturadas": "Fatty acids, total monounsaturated (g)",
-            "Grasas poliinsaturadas": "Fatty acids, total polyunsaturated (g)",
-            "Grasas trans": "Fatty acids, total trans (g)",
-            "Colesterol": "Cholesterol (mg)",
-            "Fibra alimentaria": "Fiber, total dietary (g)",
-            "Sodio": "Sodium, Na (mg)",
-            "Vitamina A": "Vitamin A, RAE (µg)",
-            "Vitamina D": "Vitamin D (D2 + D3)",
-            "Vitamina C": "Vitamin C, total ascorbic acid (mg)",
-            "Vitamina E": "Vitamin E (alpha-tocopherol) (mg)",
-            "Tiamina": "Thiamin (mg)",
-            "Riboflavina": "Riboflavin (mg)",
-            "Niacina": "Niacin (mg)",
-            "Vitamina B6": "Vitamin B-6 (mg)",
-            "Acido fólico": "Folate, DFE (µg)",
-            "Vitaminia B12": "Vitamin B-12 (µg)",
-            "Biotina": "Biotin (µg)",
-            "Acido pantoténico": "Pantothenic acid (mg)",
-            "Calcio": "Calcium, Ca (mg)",
-            "Hierro": "Iron, Fe (mg)",
-            "Magnesio": "Magnesium, Mg (mg)",
-            "Zinc": "Zinc, Zn (mg)",
-            "Yodo": "Iodine, I (µg)",
-            "Vitamina K": "Vitamin K (phylloquinone) (µg)",
-            "Fósforo": "Phosphorus, P (mg)",
-            "Flúor": "Fluoride, F (mg)",
-            "Cobre": "Copper, Cu (mg)",
-            "Selenio": "Selenium, Se (µg)",
-            "Molibdeno": "Molybdenum, Mo (µg)",
-            "Cromo": "Chromium, Cr (µg)",
-            "Manganeso": "Manganese, Mn (mg)",
-            "Colina": "Choline, total (mg)",
-        }
-        self.label_no_significant_thresholds = {
-            "Energia": {"unit": "kcal", "max": 4.0, "kj_max": 17.0},
-            "Carbohidratos": {"unit": "g", "max": 0.5},
-            "Proteinas": {"unit": "g", "max": 0.5},
-            "Grasas totales": {"unit": "g", "max": 0.5},
-            "Grasas saturadas": {"unit": "g", "max": 0.2},
-            "Grasas trans": {"unit": "g", "max": 0.2},
-            "Fibra alimentaria": {"unit": "g", "max": 0.5},
-            "Sodio": {"unit": "mg", "max": 5.0},
-        }
-        self.label_no_significant_display_map = {"Energia": "Valor energético"}
+        self.label_export_dpi = 300
+        self.label_no_sig_order = NO_SIGNIFICANT_ORDER
+        self.label_nutrient_usda_map = LABEL_NUTRIENT_USDA_MAP
+        self.label_no_significant_thresholds = NO_SIGNIFICANT_THRESHOLDS
+        self.label_no_significant_display_map = NO_SIGNIFICANT_DISPLAY_MAP
         self.label_additional_catalog = self._build_additional_nutrients()
         self.label_additional_refs = {item["name"]: item.get("ref", "") for item in self.label_additional_catalog}
 
+        # Crash recovery: every edit is journaled; started once recovery has been offered.
+        self._autosave: AutosaveJournal | None = None
+        self._journaled_label: Dict[str, Any] | None = None
+        self._journaled_flags: Dict[str, bool] = {}
+        self._journaled_name = ""
+
         self._build_ui()
+        QTimer.singleShot(0, self._start_autosave)
+
+    def closeEvent(self, event) -> None:
+        # Let running exports finish their rename instead of leaving temp files behind.
+        for thread in list(self._export_threads):
+            thread.wait()
+        if self._autosave is not None:
+            # Clean shutdown: nothing to recover next time.
+            self._autosave.close(discard=True)
+            self._autosave = None
+        self._compute_thread.quit()
+        self._compute_thread.wait(2000)
+        super().closeEvent(event)
+
+    # ---- Autosave journal ----
+    def _start_autosave(self) -> None:
+        """Offer to recover an unfinished session, then start journaling edits."""
+        state = load_autosave(AUTOSAVE_DIR)
+        if state is not None:
+            name = state.get("formula_name") or "sin nombre"
+            answer = QMessageBox.question(
+                self,
+                "Recuperar formulación",
+                f"Se encontró una formulación no guardada ({name}, "
+                f"{len(state['items'])} ingredientes).\n¿Desea recuperarla?",
+                QMessageBox.Yes | QMessageBox.No,
+                QMessageBox.Yes,
+            )
+            if answer == QMessageBox.Yes:
+                self._restore_autosave(state)
+        try:
+            self._autosave = AutosaveJournal(AUTOSAVE_DIR)
+        except OSError as exc:
+            logging.error(f"autosave disabled: {exc}")
+            return
+        self._compact_autosave()
+
+    def _autosave_state(self) -> Dict[str, Any]:
+        return {
+            "items": [portable_item(item) for item in self.formulation_items],
+            "quantity_mode": self.quantity_mode,
+            "formula_name": self.formula_name_input.text(),
+            "nutrient_export_flags": dict(self._journaled_flags),
+            "label": self._label_settings_state(),
+            "overrides": dict(self.label_manual_overrides),
+        }
+
+    def _label_settings_state(self) -> Dict[str, Any]:
+        """Label inputs as plain JSON values; manual overrides are journaled on their own."""
+        settings = self._label_settings()
+        return {
+            "portion_size": settings.portion_size,
+            "portion_unit": settings.portion_unit,
+            "household_amount": settings.household_amount,
+            "household_unit": settings.household_unit,
+            "breakdown_fat": settings.breakdown_fat,
+            "breakdown_carb": settings.breakdown_carb,
+            "no_significant": list(settings.no_significant),
+            "additional_selected": list(settings.additional_selected),
+        }
+
+    def _compact_autosave(self) -> None:
+        if self._autosave is None:
+            return
+        self._journaled_label = self._label_settings_state()
+        self._journaled_name = self.formula_name_input.text()
+        self._autosave.compact(self._autosave_state())
+
+    def _journal(self, op: str, **data: Any) -> None:
+        """Record one edit; cost is proportional to the change, not the formulation."""
+        if self._autosave is None:
+            return
+        self._autosave.record(op, **data)
+        if self._autosave.needs_compaction:
+            self._compact_autosave()
+
+    def _journal_amounts(self) -> None:
+        self._journal("amounts", amounts=[float(item.get("amount_g", 0.0) or 0.0) for item in self.formulation_items])
+
+    def _journal_label_settings(self) -> None:
+        if self._autosave is None:
+            return
+        state = self._label_settings_state()
+        if state != self._journaled_label:
+            self._journaled_label = state
+            self._journal("label", settings=state)
+
+    def _journal_export_flags(self) -> None:
+        if self._autosave is None:
+            return
+        # Only unchecked nutrients are stored; anything else defaults to exported.
+        flags = {key: False for key, value in self.totals_model.export_flags.items() if not value}
+        if flags != self._journaled_flags:
+            self._journaled_flags = flags
+            self._journal("flags", flags=flags)
+
+    def _journal_formula_name(self) -> None:
+        name = self.formula_name_input.text()
+        if self._autosave is not None and name != self._journaled_name:
+            self._journaled_name = name
+            self._journal("name", name=name)
+
+    def _restore_autosave(self, state: Dict[str, Any]) -> None:
+        items: list[Dict[str, Any]] = []
+        for item in state.get("items", []):
+            restored = dict(item)
+            restored["nutrients"] = assign_nutrient_ids(list(item.get("nutrients") or []))
+            items.append(restored)
+        self.formulation_items = items
+        self._journaled_flags = dict(state.get("nutrient_export_flags") or {})
+        self.totals_model.set_export_flags(self._journaled_flags)
+        self.quantity_mode = "g" if state.get("quantity_mode") != "%" else "%"
+        self.quantity_mode_selector.blockSignals(True)
+        self.quantity_mode_selector.setCurrentIndex(0 if self.quantity_mode == "g" else 1)
+        self.quantity_mode_selector.blockSignals(False)
+        self.formula_name_input.setText(state.get("formula_name", ""))
+        self._apply_label_settings_state(state.get("label") or {})
+        self.label_manual_overrides = dict(state.get("overrides") or {})
+        self._refresh_formulation_views()
+        self._update_label_preview()
+        self.status_label.setText("Formulación recuperada del autoguardado.")
+
+    def _apply_label_settings_state(self, label: Dict[str, Any]) -> None:
+        if not label:
+            return
+        self.portion_unit_combo.setCurrentText(label.get("portion_unit", "g"))
+        household_unit = label.get("household_unit", "")
+        if household_unit and self.household_unit_combo.findText(household_unit) >= 0:
+            self.household_unit_combo.setCurrentText(household_unit)
+        elif household_unit:
+            self.household_unit_combo.setCurrentText("Otro")
+            self.custom_household_unit_input.setText(household_unit)
+        self.portion_size_input.setValue(int(round(float(label.get("portion_size", 100)))))
+        self.household_amount_input.setText(label.get("household_amount", ""))
+        self.breakdown_fat_checkbox.setChecked(bool(label.get("breakdown_fat")))
+        self.breakdown_carb_checkbox.setChecked(bool(label.get("breakdown_carb")))
+        # After the checkboxes: their handlers prune the no-significant list.
+        self.label_no_significant = list(label.get("no_significant") or [])
+        self.label_additional_selected = list(label.get("additional_selected") or [])
+        self._update_additional_controls()
+
+    # ---- Undo/redo ----
+    def _capture_state(self) -> FormulationState:
+        """Current items as an immutable state, reusing unchanged items of the last one."""
+        self._history_state = FormulationState.capture(self.formulation_items, self._history_state)
+        return self._history_state
+
+    def _record_undo(self, before: FormulationState) -> None:
+        """Call after a successful edit with the state captured before it."""
+        self._history.push(before)
+        self._update_history_buttons()
+
+    def _update_history_buttons(self) -> None:
+        self.undo_button.setEnabled(self._history.can_undo)
+        self.redo_button.setEnabled(self._history.can_redo)
+
+    def on_undo_clicked(self) -> None:
+        state = self._history.undo(self._capture_state())
+        if state is None:
+            self.status_label.setText("No hay cambios para deshacer.")
+            return
+        self._restore_history_state(state)
+        self.status_label.setText("Cambio deshecho.")
+
+    def on_redo_clicked(self) -> None:
+        state = self._history.redo(self._capture_state())
+        if state is None:
+            self.status_label.setText("No hay cambios para rehacer.")
+            return
+        self._restore_history_state(state)
+        self.status_label.setText("Cambio rehecho.")
+
+    def _restore_history_state(self, state: FormulationState) -> None:
+        operations = journal_operations(self._history_state, state)
+        self.formulation_items = state.to_items()
+        self._history_state = state
+        if self._autosave is not None:
+            # Journal only the difference; a compaction in between would snapshot
+            # the restored items before all of its operations were recorded.
+            for op, data in operations:
+                self._autosave.record(op, **data)
+            if self._autosave.needs_compaction:
+                self._compact_autosave()
+        self._update_history_buttons()
+        self._refresh_formulation_views()
 
     def _set_window_progress(self, progress: str | None = None) -> None:
         """Update the window title with progress info or reset it."""
@@ -387,12 +437,6 @@ class MainWindow(QMainWindow):
         search_layout.addWidget(self.search_button)
 
         self.include_brands_checkbox = QCheckBox("Incluir Marcas")
-        self.prev_page_button = QPushButton("<")
-        self.prev_page_button.setFixedWidth(32)
-        self.next_page_button = QPushButton(">")
-        self.next_page_button.setFixedWidth(32)
-        self.prev_page_button.setEnabled(False)
-        self.next_page_button.setEnabled(False)
 
         # Controles legacy ocultos (buscar por FDC y botón de agregar)
         self.fdc_id_input = QLineEdit()
@@ -420,18 +464,18 @@ class MainWindow(QMainWindow):
         status_controls_layout.addWidget(self.status_label, 1)
         status_controls_layout.addStretch()
         status_controls_layout.addWidget(self.include_brands_checkbox)
-        status_controls_layout.addWidget(self.prev_page_button)
-        status_controls_layout.addWidget(self.next_page_button)
         layout.addLayout(status_controls_layout)
 
         # Tabla de resultados (arriba)
-        self.table = QTableWidget(0, 4)
-        self.table.setHorizontalHeaderLabels(
-            ["FDC ID", "Descripción", "Marca / Origen", "Tipo de dato"]
-        )
-        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.table.setSelectionBehavior(QTableWidget.SelectRows)
-        self.table.setSelectionMode(QTableWidget.ExtendedSelection)
+        # Results load in batches while scrolling; header clicks sort them client-side.
+        self.table = QTableView()
+        self.table.setModel(self.search_proxy)
+        self.table.setSortingEnabled(True)
+        self.table.horizontalHeader().setSortIndicatorClearable(True)
+        self.table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.table.setEditTriggers(QTableView.NoEditTriggers)
+        self.table.setSelectionBehavior(QTableView.SelectRows)
+        self.table.setSelectionMode(QTableView.ExtendedSelection)
         self.table.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.table.horizontalHeader().setStretchLastSection(True)
 
@@ -449,11 +493,16 @@ class MainWindow(QMainWindow):
 
         left_panel = QVBoxLayout()
         left_panel.addWidget(QLabel("Ingredientes en formulación"))
-        self.formulation_preview = QTableWidget(0, 2)
-        self.formulation_preview.setHorizontalHeaderLabels(["FDC ID", "Ingrediente"])
-        self.formulation_preview.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.formulation_preview.setSelectionBehavior(QTableWidget.SelectRows)
-        self.formulation_preview.setSelectionMode(QTableWidget.ExtendedSelection)
+        # Same model as the formulation tab; the preview only shows ID + Ingrediente.
+        self.formulation_preview = QTableView()
+        self.formulation_preview.setModel(self.formulation_model)
+        for col in range(
+            FormulationTableModel.AMOUNT_G_COLUMN, self.formulation_model.columnCount()
+        ):
+            self.formulation_preview.setColumnHidden(col, True)
+        self.formulation_preview.setEditTriggers(QTableView.NoEditTriggers)
+        self.formulation_preview.setSelectionBehavior(QTableView.SelectRows)
+        self.formulation_preview.setSelectionMode(QTableView.ExtendedSelection)
         self.formulation_preview.horizontalHeader().setStretchLastSection(True)
         left_panel.addWidget(self.formulation_preview)
 
@@ -481,17 +530,21 @@ class MainWindow(QMainWindow):
 
         self.search_button.clicked.connect(self.on_search_clicked)
         self.search_input.returnPressed.connect(self.on_search_clicked)
-        self.table.cellDoubleClicked.connect(self.on_result_double_clicked)
-        self.table.itemSelectionChanged.connect(self.on_search_selection_changed)
+        self.table.doubleClicked.connect(
+            lambda index: self.on_result_double_clicked(index.row(), index.column())
+        )
+        self.table.selectionModel().selectionChanged.connect(
+            lambda *_: self.on_search_selection_changed()
+        )
         self.remove_preview_button.clicked.connect(self.on_remove_preview_clicked)
-        self.formulation_preview.cellDoubleClicked.connect(
-            self.on_formulation_preview_double_clicked
+        self.formulation_preview.doubleClicked.connect(
+            lambda index: self.on_formulation_preview_double_clicked(
+                index.row(), index.column()
+            )
         )
-        self.formulation_preview.itemSelectionChanged.connect(
-            self.on_preview_selection_changed
+        self.formulation_preview.selectionModel().selectionChanged.connect(
+            lambda *_: self.on_preview_selection_changed()
         )
-        self.prev_page_button.clicked.connect(self.on_prev_page_clicked)
-        self.next_page_button.clicked.connect(self.on_next_page_clicked)
         self.include_brands_checkbox.stateChanged.connect(
             self.on_include_brands_toggled
         )
@@ -503,14 +556,27 @@ class MainWindow(QMainWindow):
         header_layout = QHBoxLayout()
         self.export_state_button = QPushButton("Exportar")
         self.import_state_button = QPushButton("Importar")
+        self.compare_states_button = QPushButton("Comparar")
+        self.compare_states_button.setToolTip("Comparar los totales de varias formulaciones guardadas")
+        self.undo_button = QPushButton("Deshacer")
+        self.redo_button = QPushButton("Rehacer")
+        self.undo_button.setToolTip(QKeySequence(QKeySequence.Undo).toString())
+        self.redo_button.setToolTip(QKeySequence(QKeySequence.Redo).toString())
         header_layout.addWidget(self.export_state_button)
         header_layout.addWidget(self.import_state_button)
+        header_layout.addWidget(self.compare_states_button)
+        self.optimize_button = QPushButton("Optimizar")
+        self.optimize_button.setToolTip("Buscar porcentajes que cumplan metas de nutrientes por 100 g")
+        header_layout.addWidget(self.optimize_button)
+        header_layout.addWidget(self.undo_button)
+        header_layout.addWidget(self.redo_button)
         header_layout.addStretch()
         self.formula_name_input = QLineEdit()
         self.formula_name_input.setPlaceholderText(
             "Nombre Fórmula Ej.: Pan dulce con chocolate"
         )
         self.formula_name_input.setAlignment(Qt.AlignCenter)
+        self.formula_name_input.editingFinished.connect(self._journal_formula_name)
         header_layout.addWidget(self.formula_name_input, 1)
         header_layout.addStretch()
         header_layout.addWidget(QLabel("Unidad de formulación:"))
@@ -519,20 +585,11 @@ class MainWindow(QMainWindow):
         header_layout.addWidget(self.quantity_mode_selector)
         layout.addLayout(header_layout)
 
-        self.formulation_table = QTableWidget(0, 6)
-        self.formulation_table.setHorizontalHeaderLabels(
-            [
-                "FDC ID",
-                "Ingrediente",
-                "Cantidad (g)",
-                "Cantidad (%)",
-                "Fijar %",
-                "Marca / Origen",
-            ]
-        )
-        self.formulation_table.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.formulation_table.setSelectionBehavior(QTableWidget.SelectRows)
-        self.formulation_table.setSelectionMode(QTableWidget.ExtendedSelection)
+        self.formulation_table = QTableView()
+        self.formulation_table.setModel(self.formulation_model)
+        self.formulation_table.setEditTriggers(QTableView.NoEditTriggers)
+        self.formulation_table.setSelectionBehavior(QTableView.SelectRows)
+        self.formulation_table.setSelectionMode(QTableView.ExtendedSelection)
         self.formulation_table.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.formulation_table.horizontalHeader().setStretchLastSection(True)
         layout.addWidget(self.formulation_table)
@@ -552,19 +609,15 @@ class MainWindow(QMainWindow):
                 "Totales nutricionales (asumiendo valores por 100 g del alimento origen)"
             )
         )
-        self.totals_table = QTableWidget(0, 4)
-        self.totals_table.setHorizontalHeaderLabels(
-            ["Nutriente", "Total", "Unidad", "Exportar"]
-        )
-        export_header = QTableWidgetItem("Exportar")
-        export_header.setIcon(self._create_question_icon())
-        export_header.setToolTip(
+        self.totals_model.export_header_icon = self._create_question_icon()
+        self.totals_model.export_header_tooltip = (
             "Los nutrientes seleccionados seran exportados al excel"
         )
-        self.totals_table.setHorizontalHeaderItem(3, export_header)
-        self.totals_table.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.totals_table.setSelectionBehavior(QTableWidget.SelectRows)
-        self.totals_table.setSelectionMode(QTableWidget.ExtendedSelection)
+        self.totals_table = QTableView()
+        self.totals_table.setModel(self.totals_model)
+        self.totals_table.setEditTriggers(QTableView.NoEditTriggers)
+        self.totals_table.setSelectionBehavior(QTableView.SelectRows)
+        self.totals_table.setSelectionMode(QTableView.ExtendedSelection)
         self.totals_table.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.totals_table.horizontalHeader().setStretchLastSection(True)
         layout.addWidget(self.totals_table)
@@ -585,15 +638,23 @@ class MainWindow(QMainWindow):
         self.quantity_mode_selector.currentIndexChanged.connect(
             self.on_quantity_mode_changed
         )
-        self.formulation_table.cellDoubleClicked.connect(
-            self.on_formulation_cell_double_clicked
+        self.formulation_table.doubleClicked.connect(
+            lambda index: self.on_formulation_cell_double_clicked(
+                index.row(), index.column()
+            )
         )
         self.edit_quantity_button.clicked.connect(self.on_edit_quantity_clicked)
-        self.formulation_table.itemChanged.connect(self.on_lock_toggled_from_table)
-        self.totals_table.itemChanged.connect(self.on_totals_checkbox_changed)
         self.toggle_export_button.clicked.connect(self.on_toggle_export_clicked)
         self.export_state_button.clicked.connect(self.on_export_state_clicked)
         self.import_state_button.clicked.connect(self.on_import_state_clicked)
+        self.compare_states_button.clicked.connect(self.on_compare_states_clicked)
+        self.optimize_button.clicked.connect(self.on_optimize_clicked)
+        self.undo_button.clicked.connect(self.on_undo_clicked)
+        self.redo_button.clicked.connect(self.on_redo_clicked)
+        for sequence, slot in ((QKeySequence.Undo, self.on_undo_clicked), (QKeySequence.Redo, self.on_redo_clicked)):
+            shortcut = QShortcut(QKeySequence(sequence), self)
+            shortcut.activated.connect(slot)
+        self._update_history_buttons()
 
         # Copy shortcuts (Ctrl+C) for all tables
         for table in (
@@ -704,14 +765,7 @@ class MainWindow(QMainWindow):
         note_row.addWidget(self.manual_note_label)
         right_layout.addLayout(note_row)
 
-        self.label_table_widget = QTableWidget()
-        self._setup_label_table_widget()
-        # Link delegate with header span role
-        delegate = self.label_table_widget.itemDelegate()
-        if isinstance(delegate, LabelTableDelegate):
-            delegate.header_span_role = self._header_span_role
-            delegate.manual_role = self._manual_role
-            delegate.manual_color = self.label_manual_hint_color
+        self.label_table_widget = LabelTableWidget(manual_hint_color=self.label_manual_hint_color)
         right_layout.addWidget(self.label_table_widget)
 
         export_layout = QHBoxLayout()
@@ -814,269 +868,14 @@ class MainWindow(QMainWindow):
         self.totals_table.setColumnWidth(2, 60)   # Unidad
         self.totals_table.setColumnWidth(3, 80)   # Exportar
 
-    def _setup_label_table_widget(self) -> None:
-        table = self.label_table_widget
-        self.label_table_title_row = 0
-        self.label_table_portion_row = 1
-        self.label_table_header_row = 2
-        self.label_table_nutrient_start_row = 3
-        self.label_table_footer_row = (
-            self.label_table_nutrient_start_row + len(self.label_base_nutrients)
-        )
-        table.setColumnCount(3)
-        table.setRowCount(self.label_table_footer_row + 2)
-        table.setEditTriggers(QTableWidget.NoEditTriggers)
-        table.setSelectionMode(QTableWidget.ExtendedSelection)
-        table.setSelectionBehavior(QTableWidget.SelectRows)
-        table.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
-        table.horizontalHeader().setVisible(False)
-        table.verticalHeader().setVisible(False)
-        table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        table.setMinimumHeight(360)
-        table.setAutoFillBackground(False)
-        table.viewport().setAutoFillBackground(False)
-        table.setAttribute(Qt.WA_TranslucentBackground, True)
-        table.viewport().setAttribute(Qt.WA_TranslucentBackground, True)
-
-        palette = table.palette()
-        palette.setColor(QPalette.Base, Qt.transparent)
-        palette.setColor(QPalette.Window, Qt.transparent)
-        palette.setColor(QPalette.AlternateBase, Qt.transparent)
-        # Highlight nativo -> transparente, mantiene color de texto
-        text_color = palette.color(QPalette.Text)
-        palette.setColor(QPalette.Highlight, Qt.transparent)
-        palette.setColor(QPalette.HighlightedText, text_color)
-        table.setPalette(palette)
-        table.viewport().setPalette(palette)
-        table.setStyleSheet(
-            """
-            QTableWidget {
-                gridline-color: #c0c0c0;
-                background-color: transparent;
-                alternate-background-color: transparent;
-            }
-            /* Desactiva el highlight nativo (fondo/borde) para que solo se use el delegado */
-            QTableWidget::item:selected,
-            QTableWidget::item:selected:!active {
-                selection-background-color: transparent;
-                selection-color: #000;
-                background-color: transparent;
-                color: #000;
-                border: none;
-                outline: none;
-            }
-            QTableWidget::item:focus {
-                border: none;
-                outline: none;
-            }
-            QHeaderView::section {
-                background-color: transparent;
-            }
-            QTableCornerButton::section {
-                background-color: transparent;
-            }
-            """
-        )
-        table.setShowGrid(False)
-        table.setWordWrap(True)
-        table.setItemDelegate(LabelTableDelegate(self._fat_row_role, table))
-
     def _build_base_label_nutrients(self) -> list[dict[str, Any]]:
-        return [
-            {
-                "name": "Energia",
-                "type": "energy",
-                "kcal": 0.0,
-                "kj": 0.0,
-                "vd": 13.0,
-                "vd_reference": 263.0,
-            },
-            {
-                "name": "Carbohidratos",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": 7.0,
-                "vd_reference": 20.0,
-                "carb_parent": True,
-            },
-            {
-                "name": "Azúcares",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": None,
-                "vd_reference": 0.0,
-                "carb_child": True,
-                "carb_breakdown_only": True,
-            },
-            {
-                "name": "Polialcoholes",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": None,
-                "vd_reference": 0.0,
-                "carb_child": True,
-                "carb_breakdown_only": True,
-            },
-            {
-                "name": "Almidón",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": None,
-                "vd_reference": 0.0,
-                "carb_child": True,
-                "carb_breakdown_only": True,
-            },
-            {
-                "name": "Polidextrosas",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": None,
-                "vd_reference": 0.0,
-                "carb_child": True,
-                "carb_breakdown_only": True,
-            },
-            {
-                "name": "Proteinas",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": 16.0,
-                "vd_reference": 12.0,
-            },
-            {
-                "name": "Grasas totales",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": 27.0,
-                "vd_reference": 15.0,
-                "fat_parent": True,
-            },
-            {
-                "name": "Grasas saturadas",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": 23.0,
-                "vd_reference": 5.0,
-                "fat_child": True,
-            },
-            {
-                "name": "Grasas monoinsaturadas",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": None,
-                "vd_reference": 0.0,
-                "fat_child": True,
-                "fat_breakdown_only": True,
-            },
-            {
-                "name": "Grasas poliinsaturadas",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": None,
-                "vd_reference": 0.0,
-                "fat_child": True,
-                "fat_breakdown_only": True,
-            },
-            {
-                "name": "Grasas trans",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": None,
-                "vd_reference": 0.0,
-                "fat_child": True,
-            },
-            {
-                "name": "Colesterol",
-                "unit": "mg",
-                "amount": 0.0,
-                "vd": None,
-                "vd_reference": 0.0,
-                "fat_child": True,
-                "fat_breakdown_only": True,
-            },
-            {
-                "name": "Fibra alimentaria",
-                "unit": "g",
-                "amount": 0.0,
-                "vd": 12.0,
-                "vd_reference": 3.0,
-            },
-            {
-                "name": "Sodio",
-                "unit": "mg",
-                "amount": 0.0,
-                "vd": 5.0,
-                "vd_reference": 120.0,
-            },
-        ]
+        return [dict(nutrient) for nutrient in BASE_LABEL_NUTRIENTS]
 
     def _build_additional_nutrients(self) -> list[dict[str, Any]]:
-        return [
-            {"name": "Vitamina A", "unit": "µg", "vd_reference": 600.0, "ref": "(2)"},
-            {"name": "Vitamina D", "unit": "µg", "vd_reference": 5.0, "ref": "(2)"},
-            {"name": "Vitamina C", "unit": "mg", "vd_reference": 45.0, "ref": "(2)"},
-            {"name": "Vitamina E", "unit": "mg", "vd_reference": 10.0, "ref": "(2)"},
-            {"name": "Tiamina", "unit": "mg", "vd_reference": 1.2, "ref": "(2)"},
-            {"name": "Riboflavina", "unit": "mg", "vd_reference": 1.3, "ref": "(2)"},
-            {"name": "Niacina", "unit": "mg", "vd_reference": 16.0, "ref": "(2)"},
-            {"name": "Vitamina B6", "unit": "mg", "vd_reference": 1.3, "ref": "(2)"},
-            {"name": "Acido fólico", "unit": "µg", "vd_reference": 400.0, "ref": "(2)"},
-            {"name": "Vitaminia B12", "unit": "µg", "vd_reference": 2.4, "ref": "(2)"},
-            {"name": "Biotina", "unit": "µg", "vd_reference": 30.0, "ref": "(2)"},
-            {"name": "Acido pantoténico", "unit": "mg", "vd_reference": 5.0, "ref": "(2)"},
-            {"name": "Calcio", "unit": "mg", "vd_reference": 1000.0, "ref": "(2)"},
-            {"name": "Hierro", "unit": "mg", "vd_reference": 14.0, "ref": "(2) (*)"},
-            {"name": "Magnesio", "unit": "mg", "vd_reference": 260.0, "ref": "(2)"},
-            {"name": "Zinc", "unit": "mg", "vd_reference": 7.0, "ref": "(2) (**)"},
-            {"name": "Yodo", "unit": "µg", "vd_reference": 130.0, "ref": "(2)"},
-            {"name": "Vitamina K", "unit": "µg", "vd_reference": 65.0, "ref": "(2)"},
-            {"name": "Fósforo", "unit": "mg", "vd_reference": 700.0, "ref": "(3)"},
-            {"name": "Flúor", "unit": "mg", "vd_reference": 4.0, "ref": "(3)"},
-            {"name": "Cobre", "unit": "mg", "vd_reference": 0.9, "ref": "(3)"},
-            {"name": "Selenio", "unit": "µg", "vd_reference": 34.0, "ref": "(2)"},
-            {"name": "Molibdeno", "unit": "µg", "vd_reference": 45.0, "ref": "(3)"},
-            {"name": "Cromo", "unit": "µg", "vd_reference": 35.0, "ref": "(3)"},
-            {"name": "Manganeso", "unit": "mg", "vd_reference": 2.3, "ref": "(3)"},
-            {"name": "Colina", "unit": "mg", "vd_reference": 550.0, "ref": "(3)"},
-        ]
+        return [dict(nutrient) for nutrient in ADDITIONAL_LABEL_NUTRIENTS]
 
     def _build_household_measure_options(self) -> list[tuple[str, int | None]]:
-        return [
-            ("Taza de té", 200),
-            ("Vaso", 200),
-            ("Cuchara de sopa", 10),
-            ("Cuchara de té", 5),
-            ("Plato hondo", 250),
-            ("Unidad", None),
-            ("Otro", None),
-        ]
-
-    def _current_portion_factor(self) -> float:
-        return float(self.portion_size_input.value() or 0) / 100.0
-
-    def _format_fraction_amount(self, value: float) -> str:
-        if value <= 0:
-            return ""
-        frac = Fraction(value).limit_denominator(12)
-        whole, remainder = divmod(frac.numerator, frac.denominator)
-        if remainder == 0:
-            return str(whole)
-        if whole == 0:
-            return f"{remainder}/{frac.denominator}"
-        return f"{whole} {remainder}/{frac.denominator}"
-
-    def _fraction_from_ratio(self, ratio: float) -> str:
-        percent = ratio * 100.0
-        if percent <= 30:
-            return "1/4"
-        if percent <= 70:
-            return "1/2"
-        if percent <= 130:
-            return "1"
-        if percent <= 170:
-            return "1 1/2"
-        if percent <= 230:
-            return "2"
-        return self._format_fraction_amount(ratio)
+        return list(HOUSEHOLD_MEASURE_OPTIONS)
 
     def _update_capacity_label(self) -> None:
         unit_name = self.household_unit_combo.currentText()
@@ -1100,7 +899,7 @@ class MainWindow(QMainWindow):
         if portion_value <= 0:
             return
         ratio = portion_value / float(capacity)
-        text = self._fraction_from_ratio(ratio)
+        text = fraction_from_ratio(ratio)
         self._auto_updating_household_amount = True
         try:
             self.household_amount_input.setText(text or "")
@@ -1160,97 +959,6 @@ class MainWindow(QMainWindow):
             return custom or "Unidad"
         return self.household_unit_combo.currentText()
 
-    def _portion_description_for_table(self) -> str:
-        measure_amount = self.household_amount_input.text().strip()
-        measure_unit = self._current_household_unit_label()
-        portion_unit = self.portion_unit_combo.currentText()
-        portion_value = self.portion_size_input.value()
-        measure_display = measure_unit if not measure_amount else f"{measure_amount} {measure_unit}"
-        return f"Porción {portion_value} {portion_unit} ({measure_display})"
-
-    def _format_number_for_unit(self, value: float, unit: str) -> str:
-        if math.isclose(value, 0.0, abs_tol=1e-9):
-            return f"0 {unit}".strip()
-        if unit == "mg":
-            return f"{value:.0f} mg"
-        if unit == "g":
-            if abs(value) < 10:
-                return f"{value:.1f} g"
-            return f"{value:.0f} g"
-        if value >= 10:
-            return f"{value:.0f} {unit}"
-        if value >= 1:
-            return f"{value:.1f} {unit}"
-        return f"{value:.2f} {unit}"
-
-    def _format_additional_amount(self, value: float, unit: str) -> str:
-        unit = unit.lower()
-        if unit == "mg":
-            if math.isclose(value, 0.0, abs_tol=1e-9):
-                return "0 mg"
-            if value < 10:
-                return f"{value:.1f} mg"
-            return f"{value:.0f} mg"
-        if unit in ("µg", "ug"):
-            if math.isclose(value, 0.0, abs_tol=1e-9):
-                return "0 µg"
-            if value < 10:
-                return f"{value:.1f} µg"
-            return f"{value:.0f} µg"
-        return self._format_number_for_unit(value, unit)
-
-    def _format_nutrient_amount(self, nutrient: Dict[str, Any], factor: float) -> str:
-        if nutrient.get("type") == "energy":
-            kcal_val = nutrient.get("kcal", 0.0) * factor
-            kj_val = nutrient.get("kj", 0.0) * factor
-            kcal_text = f"{kcal_val:.0f}"
-            kj_text = f"{kj_val:.0f}"
-            return f"{kcal_text} kcal = {kj_text} kJ"
-        amount = nutrient.get("amount", 0.0) * factor
-        unit = nutrient.get("unit", "")
-        return self._format_number_for_unit(amount, unit)
-
-    def _format_vd_value(self, nutrient: Dict[str, Any], factor: float, effective_amount: float | None = None) -> str:  # type: ignore[override]
-        vd_percent = nutrient.get("vd")
-        base_amount = nutrient.get("vd_reference", nutrient.get("amount", 0.0))
-        eff_amount = (
-            effective_amount if effective_amount is not None else nutrient.get("amount", 0.0)
-        )
-        if nutrient.get("type") == "energy":
-            base_amount = nutrient.get("vd_reference", nutrient.get("kcal", 0.0))
-            eff_amount = effective_amount if effective_amount is not None else nutrient.get("kcal", 0.0)
-
-        portion_amount = eff_amount * factor
-        if vd_percent is None and base_amount and base_amount > 0:
-            vd_val = portion_amount * 100.0 / base_amount
-        elif vd_percent is not None and base_amount and base_amount > 0:
-            vd_val = vd_percent * (portion_amount / base_amount)
-        else:
-            return "-"
-        return f"{vd_val:.0f}%"
-
-    def _format_manual_amount(self, nutrient: Dict[str, Any], manual_amount: float) -> str:
-        if nutrient.get("type") == "energy":
-            kcal_val = manual_amount
-            kj_val = manual_amount * 4.184
-            kcal_text = f"{kcal_val:.0f}"
-            kj_text = f"{kj_val:.0f}"
-            return f"{kcal_text} kcal = {kj_text} kJ"
-        unit = nutrient.get("unit", "")
-        return self._format_number_for_unit(manual_amount, unit)
-
-    def _format_manual_vd(self, nutrient: Dict[str, Any], manual_amount: float) -> str:
-        vd_ref = nutrient.get("vd")
-        if vd_ref is None:
-            return "-"
-        base_amount = nutrient.get("kcal") if nutrient.get("type") == "energy" else nutrient.get("amount")
-        if not base_amount:
-            return "-"
-        vd_val = vd_ref * (manual_amount / base_amount)
-        if vd_val >= 10:
-            return f"{vd_val:.0f}%"
-        return f"{vd_val:.1f}%"
-
     def _parse_user_float(self, text: str) -> float | None:
         clean = text.strip().replace(",", ".")
         if not clean:
@@ -1260,36 +968,13 @@ class MainWindow(QMainWindow):
         except ValueError:
             return None
 
-    def _active_label_nutrients(self) -> list[Dict[str, Any]]:
-        breakdown_fat = self.breakdown_fat_checkbox.isChecked()
-        breakdown_carb = self.breakdown_carb_checkbox.isChecked()
-        display: list[Dict[str, Any]] = []
-        for nutrient in self.label_base_nutrients:
-            name = nutrient.get("name", "")
-            if name in self.label_no_significant:
-                continue
-            if nutrient.get("fat_breakdown_only") and not breakdown_fat:
-                continue
-            if nutrient.get("carb_breakdown_only") and not breakdown_carb:
-                continue
-            entry = dict(nutrient)
-            indent = 0
-            if (
-                (breakdown_fat and entry.get("fat_child") and not entry.get("fat_parent"))
-                or (breakdown_carb and entry.get("carb_child") and not entry.get("carb_parent"))
-            ):
-                indent = 1
-            entry["indent_level"] = indent
-            display.append(entry)
-        return display
-
     def _on_label_table_cell_double_clicked(self, row: int, _: int) -> None:
         if (
-            row < self.label_table_nutrient_start_row
-            or row >= self.label_table_nutrient_start_row + len(self._label_display_nutrients)
+            row < LabelTableWidget.NUTRIENT_START_ROW
+            or row >= LabelTableWidget.NUTRIENT_START_ROW + len(self._label_display_nutrients)
         ):
             return
-        idx = row - self.label_table_nutrient_start_row
+        idx = row - LabelTableWidget.NUTRIENT_START_ROW
         nutrient = self._label_display_nutrients[idx]
         self._prompt_manual_value_for_nutrient(nutrient)
 
@@ -1309,6 +994,7 @@ class MainWindow(QMainWindow):
             return
         if text.strip() == "":
             self.label_manual_overrides.pop(name, None)
+            self._journal("override", name=name, value=None)
             self._update_label_preview()
             return
         value = self._parse_user_float(text)
@@ -1316,72 +1002,17 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "Valor inválido", "Ingresa un número válido (ej.: 12.5).")
             return
         self.label_manual_overrides[name] = value
+        self._journal("override", name=name, value=value)
         self._update_label_preview()
 
     def _eligible_no_significant(self) -> list[str]:
-        eligible: list[str] = []
-        factor = self._current_portion_factor()
-        fat_locked = self.breakdown_fat_checkbox.isChecked()
-        fat_names = {
-            "Grasas totales",
-            "Grasas saturadas",
-            "Grasas trans",
-            "Grasas monoinsaturadas",
-            "Grasas poliinsaturadas",
-            "Colesterol",
-        }
-        def portion_amount(name: str) -> float:
-            for nutrient in self.label_base_nutrients:
-                if nutrient.get("name") != name:
-                    continue
-                eff = self._effective_label_nutrient(nutrient)
-                if eff.get("type") == "energy":
-                    return (eff.get("kcal") or 0.0) * factor
-                return (eff.get("amount") or 0.0) * factor
-            return 0.0
-        for nutrient in self.label_base_nutrients:
-            eff = self._effective_label_nutrient(nutrient)
-            name = eff.get("name", nutrient.get("name", ""))
-            if fat_locked and name in fat_names:
-                continue
-            if self.breakdown_carb_checkbox.isChecked() and name in {
-                "Carbohidratos",
-                "Azúcares",
-                "Polialcoholes",
-                "Almidón",
-                "Polidextrosas",
-            }:
-                continue
-            thresh = self.label_no_significant_thresholds.get(name)
-            if not thresh:
-                continue
-            if eff.get("type") == "energy":
-                kcal_portion = (eff.get("kcal") or 0.0) * factor
-                kj_portion = (eff.get("kj") or 0.0) * factor
-                if kcal_portion <= thresh.get("max", 0) or kj_portion < thresh.get("kj_max", 0):
-                    eligible.append(name)
-                continue
-            amount_portion = (eff.get("amount") or 0.0) * factor
-            unit = eff.get("unit", nutrient.get("unit", "")).lower()
-            max_allowed = thresh.get("max", 0.0)
-            if name == "Grasas totales":
-                sat = portion_amount("Grasas saturadas")
-                trans = portion_amount("Grasas trans")
-                if (
-                    amount_portion <= max_allowed + 1e-9
-                    and sat <= self.label_no_significant_thresholds["Grasas saturadas"]["max"] + 1e-9
-                    and trans <= self.label_no_significant_thresholds["Grasas trans"]["max"] + 1e-9
-                ):
-                    eligible.append(name)
-            elif amount_portion <= max_allowed + 1e-9:
-                eligible.append(name)
-        return eligible
-
-    def _update_no_significant_controls(self) -> None:
-        eligible = self._eligible_no_significant()
-        self.label_no_significant = self._sort_no_significant_list(
-            [name for name in self.label_no_significant if name in eligible]
-        )
+        return list(self._current_label_evaluation().eligible_no_significant)
+
+    def _update_no_significant_controls(self, evaluation: LabelEvaluation | None = None) -> None:
+        if evaluation is None:
+            evaluation = self._current_label_evaluation()
+        eligible = evaluation.eligible_no_significant
+        self.label_no_significant = list(evaluation.no_significant)
         display_names = [
             self.label_no_significant_display_map.get(name, name)
             for name in self.label_no_significant
@@ -1528,772 +1159,184 @@ class MainWindow(QMainWindow):
             return True
         return super().eventFilter(obj, event)
 
-    def _human_join(self, items: list[str]) -> str:
-        if not items:
-            return ""
-        if len(items) == 1:
-            return items[0]
-        return ", ".join(items[:-1]) + " y " + items[-1]
-
     def _sort_no_significant_list(self, names: list[str]) -> list[str]:
-        order_index = {name: idx for idx, name in enumerate(self.label_no_sig_order)}
-        return sorted(
-            names,
-            key=lambda n: (
-                order_index.get(n, len(order_index)),
-                n.lower(),
-            ),
+        return sort_no_significant(names)
+
+    def _label_settings(self) -> LabelSettings:
+        """Snapshot the label inputs so label math can run off the GUI thread."""
+        return LabelSettings(
+            portion_size=float(self.portion_size_input.value() or 0),
+            portion_unit=self.portion_unit_combo.currentText(),
+            household_amount=self.household_amount_input.text().strip(),
+            household_unit=self._current_household_unit_label(),
+            breakdown_fat=self.breakdown_fat_checkbox.isChecked(),
+            breakdown_carb=self.breakdown_carb_checkbox.isChecked(),
+            manual_overrides=tuple(self.label_manual_overrides.items()),
+            no_significant=tuple(self.label_no_significant),
+            additional_selected=tuple(self.label_additional_selected),
+        )
+
+    def _current_label_evaluation(self) -> LabelEvaluation:
+        """Label evaluation for the current items + settings (memoized, see LabelEvaluationCache)."""
+        self._ensure_normalized_items()
+        self.formulation_engine.sync(self.formulation_items)
+        return self._label_cache.evaluate(
+            self.formulation_engine.version,
+            self._label_settings(),
+            self.formulation_engine.totals,
         )
 
-    def _parse_label_mapping(self, label_name: str) -> tuple[str, str]:
-        mapped = self.label_nutrient_usda_map.get(label_name, "")
-        mapped_clean = mapped.strip()
-        if not mapped_clean:
-            return "", ""
-        # Si el paréntesis final es una unidad, úsalo; de lo contrario, ignora paréntesis de aclaración.
-        m = re.search(r"\(([^()]*)\)\s*$", mapped_clean)
-        if m:
-            unit_candidate = m.group(1).strip()
-            if re.fullmatch(r"(?i)(mg|g|µg|ug|kcal|kj)", unit_candidate):
-                base = mapped_clean[: m.start()].strip()
-                return canonical_alias_name(base), canonical_unit(unit_candidate)
-        return canonical_alias_name(mapped_clean), ""
-
-    def _find_total_entry(self, canonical_name: str, unit: str) -> Dict[str, Any] | None:
-        if not self._last_totals:
-            self._last_totals = self._calculate_totals()
-        target = canonical_alias_name(canonical_name).lower()
-        target_unit = canonical_unit(unit).lower()
-        target_key = re.sub(r"[^a-z0-9]", "", target)
-        entries = list(self._last_totals.values())
-
-        def _match_entry(entry: Dict[str, Any]) -> bool:
-            entry_name = canonical_alias_name(entry.get("name", "")).lower()
-            entry_unit = canonical_unit(entry.get("unit", "")).lower()
-            entry_key = re.sub(r"[^a-z0-9]", "", entry_name)
-            name_match = (
-                entry_name == target
-                or entry_name.startswith(target)
-                or target in entry_name
-                or entry_key == target_key
-                or entry_key.startswith(target_key)
-                or target_key in entry_key
-            )
-            unit_match = (not target_unit) or entry_unit == target_unit
-            return name_match and unit_match
-
-        for entry in entries:
-            if _match_entry(entry):
-                return entry
-
-        # Fallback: raw substring match (e.g., "total lipid (fat)")
-        raw_target = canonical_name.lower()
-        for entry in entries:
-            raw_name = (entry.get("name") or "").lower()
-            if raw_target in raw_name:
-                if not target_unit or canonical_unit(entry.get("unit", "")).lower() == target_unit:
-                    return entry
-        return None
-
-    def _factor_for_energy(self, name: str) -> float | None:
-        factor_map: list[tuple[str, float]] = [
-            ("alcohol", 7.0),
-            ("ethanol", 7.0),
-            ("protein", 4.0),
-            ("carbohydrate", 4.0),
-            ("carbohydrate, by difference", 4.0),
-            ("polydextrose", 1.0),
-            ("polyol", 2.4),
-            ("sugar alcohol", 2.4),
-            ("organic acid", 3.0),
-            ("total lipid", 9.0),  # Solo lipidos totales, no Fat (NLEA)
+    def _update_label_table_preview(self, label: NutritionLabel) -> None:
+        base_by_name = {n["name"]: n for n in self.label_base_nutrients}
+        self._label_display_nutrients = [
+            base_by_name[row.name] for row in label.rows if not row.additional
         ]
-        lower = name.lower()
-        for key, factor in factor_map:
-            if key in lower:
-                return factor
-        return None
-
-    def _compute_energy_label_values(self) -> Dict[str, float] | None:
-        if not self._last_totals:
-            self._last_totals = self._calculate_totals()
-        totals = self._last_totals or {}
-        factor = self._current_portion_factor()
-        if factor <= 0:
-            factor = 1.0
-
-        # Build a skip set for manual overrides (so we replace totals with manual)
-        manual_names = {
-            name for name in self.label_manual_overrides.keys() if name != "Energia"
-        }
-
-        kcal_portion = 0.0
-        seen_keys: set[str] = set()
-
-        # First pass: totals contributions (excluding manual overrides)
-        for entry in totals.values():
-            name = entry.get("name", "") or ""
-            if name in manual_names:
-                continue
-            key = f"{canonical_alias_name(name).lower()}|{canonical_unit(entry.get('unit', '')).lower()}"
-            if key in seen_keys:
-                continue
-            seen_keys.add(key)
-            factor_energy = self._factor_for_energy(name)
-            if factor_energy is None:
-                continue
-            unit = (entry.get("unit", "") or "").lower()
-            amount = float(entry.get("amount", 0.0) or 0.0)
-            amount_g = amount / 1000.0 if unit == "mg" else amount
-            # totals are per 100 g producto final; convert to porción
-            amount_portion = amount_g * self._current_portion_factor()
-            kcal_portion += amount_portion * factor_energy
-
-        # Second pass: manual overrides from la etiqueta base (por porción)
-        for base in self.label_base_nutrients:
-            name = base.get("name", "")
-            if name == "Energia":
-                continue
-            if name not in manual_names:
-                continue
-            manual_amount = float(self.label_manual_overrides.get(name, 0.0) or 0.0)
-            factor_energy = self._factor_for_energy(
-                self.label_nutrient_usda_map.get(name, name)
-            )
-            if factor_energy is None:
-                continue
-            unit = (base.get("unit", "") or "").lower()
-            amount_g = manual_amount / 1000.0 if unit == "mg" else manual_amount
-            kcal_portion += amount_g * factor_energy
-
-        if math.isclose(kcal_portion, 0.0, abs_tol=1e-6):
-            return None
-
-        kcal_per_100 = kcal_portion / factor
-        return {"kcal": kcal_per_100, "kj": kcal_per_100 * 4.184}
-
-    def _label_amount_from_totals(self, nutrient: Dict[str, Any]) -> Dict[str, float] | None:
-        name = nutrient.get("name", "")
-        mapped_name, mapped_unit = self._parse_label_mapping(name)
-        if not mapped_name:
-            return None
-        if nutrient.get("type") == "energy":
-            computed = self._compute_energy_label_values()
-            if computed:
-                return computed
-            kcal_entry = self._find_total_entry(mapped_name, "kcal")
-            kj_entry = self._find_total_entry(mapped_name, "kJ")
-            if not kcal_entry and not kj_entry:
-                return None
-            kcal_amount = kcal_entry.get("amount") if kcal_entry else None
-            if kcal_amount is None and kj_entry:
-                kcal_amount = kj_entry.get("amount", 0.0) / 4.184
-            kj_amount = kj_entry.get("amount") if kj_entry else None
-            if kj_amount is None and kcal_entry:
-                kj_amount = kcal_entry.get("amount", 0.0) * 4.184
-            return {"kcal": float(kcal_amount or 0.0), "kj": float(kj_amount or 0.0)}
-        entry = self._find_total_entry(mapped_name, mapped_unit)
-        if not entry and name == "Grasas totales":
-            # Fallback: cualquier nutriente que contenga "total fat" o "total lipid"
-            for e in (self._last_totals or {}).values():
-                raw_name = (e.get("name") or "").lower()
-                if "total lipid" in raw_name:
-                    entry = e
-                    break
-        if not entry:
-            return None
-        return {"amount": float(entry.get("amount", 0.0))}
-
-    def _effective_label_nutrient(self, nutrient: Dict[str, Any]) -> Dict[str, Any]:
-        name = nutrient.get("name", "")
-        manual_amount = self.label_manual_overrides.get(name)
-        if nutrient.get("type") == "energy":
-            manual_amount = None
-        totals_amount = self._label_amount_from_totals(nutrient)
-
-        effective = dict(nutrient)
-        effective["vd_reference"] = nutrient.get("vd_reference") or (
-            nutrient.get("kcal", nutrient.get("amount", 0.0))
-            if nutrient.get("type") == "energy"
-            else nutrient.get("amount", 0.0)
-        )
-
-        if manual_amount is not None:
-            if nutrient.get("type") == "energy":
-                effective["kcal"] = manual_amount
-                effective["kj"] = manual_amount * 4.184
-                effective["amount"] = manual_amount
-            else:
-                effective["amount"] = manual_amount
-            effective["manual"] = True
-            return effective
-
-        if totals_amount:
-            if nutrient.get("type") == "energy":
-                effective["kcal"] = totals_amount.get("kcal", nutrient.get("kcal", 0.0))
-                effective["kj"] = totals_amount.get("kj", nutrient.get("kj", 0.0))
-                effective["amount"] = effective["kcal"]
-            else:
-                effective["amount"] = totals_amount.get("amount", nutrient.get("amount", 0.0))
-            effective["manual"] = False
-            effective["from_totals"] = True
-            return effective
-
-        effective["manual"] = False
-        effective["from_totals"] = False
-        return effective
-
-    def _update_label_table_preview(self) -> None:
-        table = self.label_table_widget
-        factor = self._current_portion_factor()
-        table.clearSpans()
-
-        display_nutrients = self._active_label_nutrients()
-        filtered_nutrients: list[tuple[Dict[str, Any], Dict[str, Any]]] = []
-        carb_children_present = False
-        hide_zero_carb = {"Polialcoholes", "Polidextrosas"}
-        for nutrient in display_nutrients:
-            effective = self._effective_label_nutrient(nutrient)
-            name = effective.get("name", nutrient.get("name", ""))
-            if (
-                nutrient.get("carb_child")
-                and name in hide_zero_carb
-                and math.isclose(effective.get("amount", 0.0) or 0.0, 0.0, abs_tol=1e-9)
-            ):
-                continue
-            if nutrient.get("carb_child") and not nutrient.get("carb_parent"):
-                carb_children_present = True
-            filtered_nutrients.append((nutrient, effective))
-        self._label_display_nutrients = [n for n, _ in filtered_nutrients]
-
-        total_rows = (
-            3
-            + len(filtered_nutrients)
-            + len(self.label_additional_selected)
-            + (1 if self.label_no_significant else 0)
-            + 1
-        )
-        table.setRowCount(total_rows)
-
-        title_item = QTableWidgetItem("INFORMACIÓN NUTRICIONAL")
-        title_font = title_item.font()
-        title_font.setBold(True)
-        title_font.setPointSize(title_font.pointSize() + 1)
-        title_item.setFont(title_font)
-        title_item.setTextAlignment(Qt.AlignCenter)
-        table.setItem(0, 0, title_item)
-
-        portion_item = QTableWidgetItem(self._portion_description_for_table())
-        portion_item.setTextAlignment(Qt.AlignCenter)
-        table.setItem(1, 0, portion_item)
-
-        header_font = QFont()
-        header_font.setBold(True)
-        header_item_amount = QTableWidgetItem("Cantidad por porción")
-        header_item_amount.setFont(header_font)
-        header_item_amount.setTextAlignment(Qt.AlignCenter)
-        header_item_vd = QTableWidgetItem("% VD(*)")
-        header_item_vd.setFont(header_font)
-        header_item_vd.setTextAlignment(Qt.AlignCenter)
-        header_placeholder = QTableWidgetItem("")
-        header_placeholder.setFlags(header_placeholder.flags() & ~Qt.ItemIsSelectable & ~Qt.ItemIsEditable)
-        header_placeholder.setData(self._header_span_role, True)
-        header_item_amount.setData(self._header_span_role, True)
-        header_item_vd.setData(self._header_span_role, True)
-        table.setItem(2, 1, header_item_amount)
-        table.setItem(2, 2, header_item_vd)
-        table.setItem(2, 0, header_placeholder)
-
-        for idx, (nutrient, effective) in enumerate(filtered_nutrients):
-            row = 3 + idx
-            name = effective.get("name", nutrient.get("name", ""))
-            indent_level = nutrient.get("indent_level", 0)
-            display_name = ("    " * indent_level) + name
-            name_item = QTableWidgetItem(display_name)
-
-            if effective.get("manual"):
-                manual_amount = self.label_manual_overrides.get(name, 0.0)
-                amount_text = self._format_manual_amount(effective, manual_amount)
-                vd_text = self._format_manual_vd(effective, manual_amount)
-            else:
-                amount_text = self._format_nutrient_amount(effective, factor)
-                eff_amount = (
-                    effective.get("kcal", 0.0)
-                    if effective.get("type") == "energy"
-                    else effective.get("amount", 0.0)
-                )
-                vd_text = self._format_vd_value(effective, factor, eff_amount)
-            if self.breakdown_fat_checkbox.isChecked() and nutrient.get("fat_parent"):
-                amount_text = f"{amount_text}, de las cuales"
-            if (
-                self.breakdown_carb_checkbox.isChecked()
-                and nutrient.get("carb_parent")
-                and carb_children_present
-            ):
-                amount_text = f"{amount_text}, de los cuales"
-
-            amount_item = QTableWidgetItem(amount_text)
-            vd_item = QTableWidgetItem(vd_text)
-            name_item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-            amount_item.setTextAlignment(Qt.AlignCenter)
-            vd_item.setTextAlignment(Qt.AlignCenter)
-            if effective.get("manual"):
-                brush = QBrush(self.label_manual_hint_color)
-                for itm in (name_item, amount_item, vd_item):
-                    itm.setBackground(brush)
-                    itm.setData(self._manual_role, True)
-            is_breakdown_child_row = bool(
-                (self.breakdown_fat_checkbox.isChecked() and nutrient.get("fat_child") and not nutrient.get("fat_parent"))
-                or (self.breakdown_carb_checkbox.isChecked() and nutrient.get("carb_child") and not nutrient.get("carb_parent"))
-            )
-            for itm in (name_item, amount_item, vd_item):
-                itm.setData(self._fat_row_role, is_breakdown_child_row)
-                if not itm.data(self._manual_role):
-                    itm.setData(self._manual_role, False)
-            table.setItem(row, 0, name_item)
-            table.setItem(row, 1, amount_item)
-            table.setItem(row, 2, vd_item)
-
-        additional_rows_start = 3 + len(display_nutrients)
-        for add_idx, add_name in enumerate(self.label_additional_selected):
-            nutrient = next((n for n in self.label_additional_catalog if n["name"] == add_name), None)
-            if not nutrient:
-                continue
-            effective = self._effective_label_nutrient(nutrient)
-            row = additional_rows_start + add_idx
-            name_item = QTableWidgetItem(add_name)
-            amount_portion = (effective.get("amount", 0.0) or 0.0) * factor
-            amount_item = QTableWidgetItem(self._format_additional_amount(amount_portion, nutrient.get("unit", "")))
-            eff_amount = effective.get("amount", 0.0) or 0.0
-            vd_item = QTableWidgetItem(self._format_vd_value(effective, factor, eff_amount))
-            name_item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-            amount_item.setTextAlignment(Qt.AlignCenter)
-            vd_item.setTextAlignment(Qt.AlignCenter)
-            for itm in (name_item, amount_item, vd_item):
-                itm.setData(self._manual_role, bool(effective.get("manual")))
-                if effective.get("manual"):
-                    itm.setBackground(QBrush(self.label_manual_hint_color))
-            table.setItem(row, 0, name_item)
-            table.setItem(row, 1, amount_item)
-            table.setItem(row, 2, vd_item)
-
-        note_row = 3 + len(filtered_nutrients) + len(self.label_additional_selected)
-        if self.label_no_significant:
-            names = [
-                self.label_no_significant_display_map.get(name, name)
-                for name in self._sort_no_significant_list(self.label_no_significant)
-            ]
-            note_text = (
-                f"No aporta cantidades significativas de {self._human_join(names)}."
-            )
-            note_item = QTableWidgetItem(note_text)
-            note_item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-            table.setItem(note_row, 0, note_item)
-            table.setSpan(note_row, 0, 1, 3)
-            footer_row = note_row + 1
-        else:
-            footer_row = note_row
-
-        footer_text = (
-            "*% Valores Diarios con base a una dieta de 2000 kcal u 8400 kJ. "
-            "Sus valores diarios pueden ser mayores o menores dependiendo de sus necesidades energéticas."
-        )
-        footer_item = QTableWidgetItem(footer_text)
-        footer_item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        table.setItem(footer_row, 0, footer_item)
-        table.setSpan(0, 0, 1, 3)
-        table.setSpan(1, 0, 1, 3)
-        table.setSpan(footer_row, 0, 1, 3)
-        self.label_table_footer_row = footer_row
-        # Fix height for single-line rows (all menos notas/final), allow wrapping only on notes/footer.
-        base_height = table.fontMetrics().height() + 6
-        wrap_rows = {footer_row}
-        if self.label_no_significant:
-            wrap_rows.add(note_row)
-        for r in range(table.rowCount()):
-            if r in wrap_rows:
-                table.resizeRowToContents(r)
-            else:
-                table.setRowHeight(r, base_height)
-
-    def _update_linear_preview(self) -> None:
-        factor = self._current_portion_factor()
-        portion_desc = self._portion_description_for_table()
-        display_nutrients = self._active_label_nutrients()
-        parts: list[str] = []
-        fat_children: list[str] = []
-        fat_parent_text = None
-        fat_parent_index = None
-        carb_children: list[str] = []
-        carb_parent_text = None
-        carb_parent_index = None
-        hide_zero_carb = {"Polialcoholes", "Polidextrosas"}
-
-        for nutrient in display_nutrients:
-            effective = self._effective_label_nutrient(nutrient)
-            if effective.get("manual"):
-                manual_amount = self.label_manual_overrides.get(
-                    effective.get("name", ""), 0.0
-                )
-                amount = self._format_manual_amount(effective, manual_amount)
-                vd = self._format_manual_vd(effective, manual_amount)
-            else:
-                amount = self._format_nutrient_amount(effective, factor)
-                eff_amount = (
-                    effective.get("kcal", 0.0)
-                    if effective.get("type") == "energy"
-                    else effective.get("amount", 0.0)
-                )
-                vd = self._format_vd_value(effective, factor, eff_amount)
-            vd_suffix = "" if vd in ("", "-") else f" ({vd} VD*)"
-            line_text = f"{nutrient.get('name', '')} {amount}{vd_suffix}"
-
-            if (
-                self.breakdown_fat_checkbox.isChecked()
-                and nutrient.get("fat_child")
-                and not nutrient.get("fat_parent")
-            ):
-                fat_children.append(line_text)
-                continue
-
-            if self.breakdown_fat_checkbox.isChecked() and nutrient.get("fat_parent"):
-                fat_parent_text = line_text
-                fat_parent_index = len(parts)
-                continue
-
-            if (
-                self.breakdown_carb_checkbox.isChecked()
-                and nutrient.get("carb_child")
-                and not nutrient.get("carb_parent")
-            ):
-                if nutrient.get("name", "") in hide_zero_carb and math.isclose(
-                    effective.get("amount", 0.0) or 0.0, 0.0, abs_tol=1e-9
-                ):
-                    continue
-                carb_children.append(line_text)
-                continue
-
-            if self.breakdown_carb_checkbox.isChecked() and nutrient.get("carb_parent"):
-                carb_parent_text = line_text
-                carb_parent_index = len(parts)
-                continue
-
-            parts.append(line_text)
-
-        if self.breakdown_fat_checkbox.isChecked() and fat_parent_text:
-            fat_block = fat_parent_text
-            if fat_children:
-                fat_block = f"{fat_block}, de los cuales: " + ", ".join(fat_children)
-            insert_idx = fat_parent_index if fat_parent_index is not None else len(parts)
-            parts.insert(insert_idx, fat_block)
-
-        if self.breakdown_carb_checkbox.isChecked() and carb_parent_text:
-            carb_block = carb_parent_text
-            if carb_children:
-                carb_block = f"{carb_block}, de los cuales: " + ", ".join(carb_children)
-            insert_idx = carb_parent_index if carb_parent_index is not None else len(parts)
-            parts.insert(insert_idx, carb_block)
-
-        for add_name in self.label_additional_selected:
-            nutrient = next((n for n in self.label_additional_catalog if n["name"] == add_name), None)
-            if not nutrient:
-                continue
-            effective = self._effective_label_nutrient(nutrient)
-            amount_portion = (effective.get("amount", 0.0) or 0.0) * factor
-            amount = self._format_additional_amount(amount_portion, nutrient.get("unit", ""))
-            eff_amount = effective.get("amount", 0.0) or 0.0
-            vd = self._format_vd_value(effective, factor, eff_amount)
-            vd_suffix = "" if vd in ("", "-") else f" ({vd} VD*)"
-            parts.append(f"{add_name} {amount}{vd_suffix}")
-
-        note_text = ""
-        if self.label_no_significant:
-            names = [
-                self.label_no_significant_display_map.get(name, name)
-                for name in self._sort_no_significant_list(self.label_no_significant)
-            ]
-            note_text = f" No aporta cantidades significativas de {self._human_join(names)}."
-
-        base_text = (
-            "Información Nutricional: "
-            f"{portion_desc}. "
-            + "; ".join(parts)
-            + ";"
-            + note_text
-            + " (*) % Valores Diarios con base a una dieta de 2.000 kcal u 8.400 kJ. "
-            "Sus valores diarios pueden ser mayores o menores dependiendo de sus necesidades energéticas."
-        )
-        self.linear_format_preview.setPlainText(base_text)
-
-    def _render_label_pixmap(self, with_background: bool) -> QPixmap | None:
-        table = self.label_table_widget
-
-        header = table.horizontalHeader()
-        content_width = header.length()
-        if content_width <= 0:
-            content_width = sum(table.columnWidth(c) for c in range(table.columnCount()))
-
-        v_header = table.verticalHeader()
-        content_height = v_header.length()
-        if content_height <= 0:
-            content_height = sum(table.rowHeight(r) for r in range(table.rowCount()))
-
-        padding = 2
-        content_width += table.frameWidth() * 2
-        content_height += table.frameWidth() * 2
-        export_width = content_width + padding * 2
-        export_height = content_height + padding * 2
-
-        if content_width <= 0 or content_height <= 0:
-            return None
-
-        original_size = table.size()
-        original_style = table.styleSheet()
-        original_palette = table.palette()
-        original_autofill = table.autoFillBackground()
-        original_viewport_autofill = table.viewport().autoFillBackground()
-        original_h_policy = table.horizontalScrollBarPolicy()
-        original_v_policy = table.verticalScrollBarPolicy()
-        original_table_attr = table.testAttribute(Qt.WA_TranslucentBackground)
-        original_viewport_attr = table.viewport().testAttribute(Qt.WA_TranslucentBackground)
-
-        sel_model = table.selectionModel()
-        selected_indexes = list(sel_model.selectedIndexes()) if sel_model else []
-        table.clearSelection()
-
-        cleared_backgrounds: list[tuple[int, int, QBrush]] = []
-        for r in range(table.rowCount()):
-            for c in range(table.columnCount()):
-                item = table.item(r, c)
-                if not item:
-                    continue
-                bg = item.background()
-                if bg.style() != Qt.NoBrush:
-                    cleared_backgrounds.append((r, c, bg))
-                    item.setBackground(QBrush(Qt.transparent))
-
-        try:
-            table.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-            table.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-            table.setAttribute(Qt.WA_TranslucentBackground, True)
-            table.viewport().setAttribute(Qt.WA_TranslucentBackground, True)
-            table.viewport().setAutoFillBackground(False)
-            table.setAutoFillBackground(False)
-
-            pal = QPalette(table.palette())
-            pal.setColor(QPalette.Text, QColor("#272727"))
-            pal.setColor(QPalette.WindowText, QColor("#272727"))
-            grid_color = "#c0c0c0"
-            if with_background:
-                pal.setColor(QPalette.Base, Qt.white)
-                pal.setColor(QPalette.Window, Qt.white)
-                pal.setColor(QPalette.AlternateBase, Qt.white)
-                fill_color = Qt.white
-                bg_style = "background-color: white; alternate-background-color: white;"
-            else:
-                pal.setColor(QPalette.Base, Qt.transparent)
-                pal.setColor(QPalette.Window, Qt.transparent)
-                pal.setColor(QPalette.AlternateBase, Qt.transparent)
-                fill_color = Qt.transparent
-                bg_style = (
-                    "background-color: transparent; "
-                    "alternate-background-color: transparent; "
-                    "selection-background-color: transparent;"
-                )
+        self.label_table_widget.set_label(label)
 
-            table.setAutoFillBackground(False)
-            table.setPalette(pal)
-            table.setStyleSheet(
-                f"{original_style} "
-                f"QTableWidget {{ {bg_style} gridline-color: {grid_color}; }} "
-                "QTableWidget::viewport { background: transparent; } "
-                "QHeaderView::section { background-color: transparent; } "
-                "QTableCornerButton::section { background-color: transparent; } "
-            )
+    def _update_linear_preview(self, label: NutritionLabel) -> None:
+        if self.linear_format_preview.toPlainText() != label.linear_text:
+            self.linear_format_preview.setPlainText(label.linear_text)
 
-            table.resize(content_width, content_height)
-
-            scale = 1.0 if with_background else 2.0
-            scaled_width = int(export_width * scale)
-            scaled_height = int(export_height * scale)
-            image = QImage(scaled_width, scaled_height, QImage.Format_ARGB32_Premultiplied)
-            image.fill(fill_color)
-
-            painter = QPainter(image)
-            painter.setRenderHint(QPainter.Antialiasing)
-            painter.setRenderHint(QPainter.TextAntialiasing)
-            if not with_background:
-                painter.setCompositionMode(QPainter.CompositionMode_Source)
-            painter.translate(padding * scale, padding * scale)
-            painter.scale(scale, scale)
-            table.render(painter, QPoint(0, 0))
-            painter.end()
-            if scale != 1.0:
-                image = image.scaled(
-                    export_width,
-                    export_height,
-                    Qt.IgnoreAspectRatio,
-                    Qt.SmoothTransformation,
-                )
-            return QPixmap.fromImage(image)
-        finally:
-            table.resize(original_size)
-            table.setStyleSheet(original_style)
-            table.setPalette(original_palette)
-            table.setAutoFillBackground(original_autofill)
-            table.viewport().setAutoFillBackground(original_viewport_autofill)
-            table.setHorizontalScrollBarPolicy(original_h_policy)
-            table.setVerticalScrollBarPolicy(original_v_policy)
-            table.setAttribute(Qt.WA_TranslucentBackground, original_table_attr)
-            table.viewport().setAttribute(Qt.WA_TranslucentBackground, original_viewport_attr)
-            for r, c, bg in cleared_backgrounds:
-                item = table.item(r, c)
-                if item:
-                    item.setBackground(bg)
-            if sel_model:
-                for idx in selected_indexes:
-                    sel_model.select(idx, QItemSelectionModel.Select)
-
-    def _remove_image_background(self, image: QImage, tolerance: int = 6) -> QImage:
-        """
-        Convierte en transparente los píxeles que coinciden con el color de fondo dentro de una tolerancia.
-        Esto permite exportar la tabla sin fondo (solo texto y líneas).
-        """
-        bg = image.pixelColor(0, 0)
-        result = QImage(image)
-        width = result.width()
-        height = result.height()
-
-        for y in range(height):
-            for x in range(width):
-                c = result.pixelColor(x, y)
-                if (
-                    abs(c.red() - bg.red()) <= tolerance
-                    and abs(c.green() - bg.green()) <= tolerance
-                    and abs(c.blue() - bg.blue()) <= tolerance
-                ):
-                    c.setAlpha(0)
-                    result.setPixelColor(x, y, c)
-        return result
-
-    def _strip_to_strokes(self, image: QImage) -> QImage:
-        """
-        Deja solo trazos (texto y líneas) eliminando fondos claros residuales.
-        Conserva píxeles cercanos al color de texto (#272727) o líneas (#c0c0c0) y elimina el resto.
-        """
-        text_color = QColor("#272727")
-        grid_color = QColor("#c0c0c0")
-        text_r, text_g, text_b = text_color.red(), text_color.green(), text_color.blue()
-        grid_r, grid_g, grid_b = grid_color.red(), grid_color.green(), grid_color.blue()
-        text_tol = 45  # distancia máxima para conservar texto (cubre antialias y #8F8F8F/#9B9B9B)
-        grid_tol = 8   # líneas muy cercanas al gris exacto
-        result = QImage(image.size(), QImage.Format_ARGB32)
-        result.fill(Qt.transparent)
-        width = image.width()
-        height = image.height()
-
-        for y in range(height):
-            for x in range(width):
-                c = image.pixelColor(x, y)
-                if c.alpha() == 0:
-                    continue
-                r, g, b = c.red(), c.green(), c.blue()
-                dist_text = ((r - text_r) ** 2 + (g - text_g) ** 2 + (b - text_b) ** 2) ** 0.5
-                dist_grid = ((r - grid_r) ** 2 + (g - grid_g) ** 2 + (b - grid_b) ** 2) ** 0.5
-                if dist_text <= text_tol:
-                    out = QColor(text_color)
-                    out.setAlpha(c.alpha())
-                    result.setPixelColor(x, y, out)
-                    continue
-                if dist_grid <= grid_tol:
-                    out = QColor(grid_color)
-                    out.setAlpha(c.alpha())
-                    result.setPixelColor(x, y, out)
-                    continue
-                # otherwise leave transparent
-        return result
-
-    def _clear_white_background(self, image: QImage, threshold: int = 245) -> QImage:
-        """
-        Hace transparente cualquier pixel casi blanco (>= threshold en R,G,B), preservando otros colores.
-        """
-        result = QImage(image)
-        width = result.width()
-        height = result.height()
-        for y in range(height):
-            for x in range(width):
-                c = result.pixelColor(x, y)
-                if c.red() >= threshold and c.green() >= threshold and c.blue() >= threshold:
-                    c.setAlpha(0)
-                    result.setPixelColor(x, y, c)
-        return result
+    def _label_renderer(self) -> LabelRenderer | None:
+        self._finish_pending_refresh()
+        label = self.label_table_widget.label
+        return LabelRenderer(label) if label is not None else None
 
     def _update_label_preview(self, force_recalc_totals: bool = False) -> None:
         if QThread.currentThread() is not self.thread():
             QTimer.singleShot(0, lambda: self._update_label_preview(force_recalc_totals))
             return
-        if force_recalc_totals or not self._last_totals:
-            self._last_totals = self._calculate_totals()
-        self._update_no_significant_controls()
-        self._update_label_table_preview()
-        self._update_linear_preview()
+        views = ["label_table", "linear"]
+        if force_recalc_totals:
+            views.append("totals")
+        self._mark_views_dirty(*views)
+
+    def _mark_views_dirty(self, *views: str) -> None:
+        """Queue views for the next compute; totals/label math runs once per flush."""
+        self._dirty_views.update(views)
+        self._refresh_scheduler.mark_dirty("compute")
+
+    def _request_compute(self) -> None:
+        """Snapshot formulation + label settings and hand them to the compute thread."""
+        self._ensure_normalized_items()
+        self.formulation_engine.sync(self.formulation_items)
+        snapshot = self.formulation_engine.snapshot()
+        settings = self._label_settings()
+        # Once per coalesced refresh, so typing in a label field journals a single change.
+        self._journal_label_settings()
+        # Views of superseded requests are carried over, so dropping their results loses nothing.
+        self._requested_views |= self._dirty_views
+        self._dirty_views = set()
+        self._compute_generation += 1
+        self._compute_worker.latest_generation = self._compute_generation
+        self.compute_requested.emit(self._compute_generation, snapshot, settings)
+
+    def _on_compute_finished(self, generation: int, evaluation: LabelEvaluation) -> None:
+        if generation != self._compute_generation:
+            logging.debug(f"_on_compute_finished drop stale generation={generation}")
+            return
+        views = self._requested_views
+        self._requested_views = set()
+        self._apply_label_evaluation(evaluation, views)
+
+    def _on_compute_error(self, generation: int, message: str) -> None:
+        if generation != self._compute_generation:
+            return
+        self._requested_views = set()
+        self.status_label.setText(f"Error al calcular la etiqueta: {message}")
+
+    def _finish_pending_refresh(self) -> None:
+        """Bring totals/label widgets up to date synchronously (e.g. before exporting)."""
+        self._refresh_scheduler.flush()
+        if not self._requested_views:
+            return
+        # Supersede the in-flight request and evaluate on this thread instead.
+        self._compute_generation += 1
+        self._compute_worker.latest_generation = self._compute_generation
+        evaluation = self._current_label_evaluation()
+        views = self._requested_views
+        self._requested_views = set()
+        self._apply_label_evaluation(evaluation, views)
+
+    def _apply_label_evaluation(self, evaluation: LabelEvaluation, views: set[str]) -> None:
+        totals = dict(evaluation.totals)
+        self._label_evaluation = evaluation
+        if "totals" in views:
+            self._refresh_totals_view(totals)
+        if "label_table" in views:
+            self._update_no_significant_controls(evaluation)
+        if views & {"label_table", "linear"}:
+            label = build_label_from_evaluation(evaluation)
+            if "label_table" in views:
+                self._update_label_table_preview(label)
+            if "linear" in views:
+                self._update_linear_preview(label)
 
     def _on_export_label_table_clicked(self, with_background: bool) -> None:
         default_name = "etiqueta_con_fondo.png" if with_background else "etiqueta_sin_fondo.png"
         initial_path = (
             str(Path(self.last_path or "").with_name(default_name)) if self.last_path else default_name
         )
-        path, _ = QFileDialog.getSaveFileName(
+        path, selected_filter = QFileDialog.getSaveFileName(
             self,
-            "Guardar tabla como PNG",
+            "Guardar tabla como imagen",
             initial_path,
-            f"PNG (*.png);;Todos los archivos (*)",
+            "PNG (*.png);;SVG (*.svg);;PDF (*.pdf);;Todos los archivos (*)",
         )
         if not path:
             return
 
-        pixmap = self._render_label_pixmap(with_background)
-        if pixmap is None:
+        renderer = self._label_renderer()
+        if renderer is None:
             QMessageBox.warning(self, "Error", "No se pudo generar la imagen.")
             return
-        if not path.lower().endswith(".png"):
-            path += ".png"
-        if pixmap.save(path, "PNG"):
-            self.last_path = Path(path).parent
-            self._save_last_path(self.last_path)
-            QMessageBox.information(self, "Exportado", f"Tabla guardada en:\n{path}")
-        else:
-            QMessageBox.warning(self, "Error", "No se pudo guardar la imagen.")
+        if Path(path).suffix.lower() not in LABEL_FORMATS:
+            suffix = next((ext for ext in LABEL_FORMATS if ext in selected_filter), ".png")
+            path += suffix
+        dpi = self.label_export_dpi
+
+        def write(target: Path, _report: Callable[[str], None]) -> None:
+            if not renderer.save(target, dpi=dpi, with_background=with_background):
+                raise OSError("No se pudo guardar la imagen.")
 
-    def _attach_copy_shortcut(self, table: QTableWidget) -> None:
+        self.last_path = Path(path).parent
+        self._save_last_path(self.last_path)
+        self._start_export_job(path, write, "Exportando etiqueta")
+
+    def _attach_copy_shortcut(self, table: QTableView) -> None:
         """Attach Ctrl+C to copy the current selection of a table as TSV to clipboard."""
         shortcut = QShortcut(QKeySequence.Copy, table)
         shortcut.setContext(Qt.WidgetWithChildrenShortcut)
         shortcut.activated.connect(lambda t=table: self._copy_table_selection(t))
 
-    def _copy_table_selection(self, table: QTableWidget) -> None:
+    def _copy_table_selection(self, table: QTableView) -> None:
         """Copy selected cells/rows to clipboard (TSV) with headers."""
         sel_model = table.selectionModel()
         if not sel_model or not sel_model.hasSelection():
             return
-        ranges = table.selectedRanges()
-        if not ranges:
+        selection = sel_model.selection()
+        if selection.isEmpty():
             return
-        selected_range = ranges[0]
-        rows = range(selected_range.topRow(), selected_range.bottomRow() + 1)
-        cols = range(selected_range.leftColumn(), selected_range.rightColumn() + 1)
+        selected_range = selection[0]
+        model = table.model()
+        rows = range(selected_range.top(), selected_range.bottom() + 1)
+        cols = [
+            col
+            for col in range(selected_range.left(), selected_range.right() + 1)
+            if not table.isColumnHidden(col)
+        ]
 
         headers: list[str] = []
         for col in cols:
-            header_item = table.horizontalHeaderItem(col)
-            headers.append(header_item.text() if header_item else "")
+            header = model.headerData(col, Qt.Horizontal, Qt.DisplayRole)
+            headers.append("" if header is None else str(header))
         lines = ["\t".join(headers)]
 
         for row in rows:
             row_vals: list[str] = []
             for col in cols:
-                item = table.item(row, col)
-                row_vals.append("" if item is None else item.text())
+                value = model.index(row, col).data(Qt.DisplayRole)
+                row_vals.append("" if value is None else str(value))
             lines.append("\t".join(row_vals))
 
         QApplication.clipboard().setText("\n".join(lines))
@@ -2304,31 +1347,14 @@ class MainWindow(QMainWindow):
             self.status_label.setText("Ingresa un termino de busqueda.")
             return
 
-        self.search_page = 1
         self.last_query = query
         self.last_include_brands = self.include_brands_checkbox.isChecked()
         self._start_search()
 
-    def on_prev_page_clicked(self) -> None:
-        if self.search_page <= 1:
-            return
-        self.search_page -= 1
-        self._show_current_search_page()
-        self._update_paging_buttons(len(self.search_results))
-
-    def on_next_page_clicked(self) -> None:
-        total = len(self.search_results)
-        if self.search_page * self.search_page_size >= total:
-            return
-        self.search_page += 1
-        self._show_current_search_page()
-        self._update_paging_buttons(total)
-
     def on_include_brands_toggled(self) -> None:
         # Re-lanzar búsqueda con el filtro actualizado si ya hay texto
         if not self.search_input.text().strip():
             return
-        self.search_page = 1
         self.last_query = self.search_input.text().strip()
         self.last_include_brands = self.include_brands_checkbox.isChecked()
         self._start_search()
@@ -2339,16 +1365,10 @@ class MainWindow(QMainWindow):
             return
 
         self.search_button.setEnabled(False)
-        self.prev_page_button.setEnabled(False)
-        self.next_page_button.setEnabled(False)
-        self.search_results = []
-        self._last_results_count = 0
-        self._populate_table([])  # clear while loading
+        self.search_model.set_results([])  # clear while loading
 
         data_types = self._data_types_for_search()
-        self.status_label.setText(
-            f"Buscando en FoodData Central... (pagina {self.search_page})"
-        )
+        self.status_label.setText("Buscando en FoodData Central...")
 
         self._run_in_thread(
             fn=self._fetch_all_pages,
@@ -2411,18 +1431,6 @@ class MainWindow(QMainWindow):
             ),
         )
 
-    def _filter_results_by_query(self, foods: List[Dict[str, Any]], query: str) -> List[Dict[str, Any]]:
-        tokens = [t for t in query.lower().split() if t]
-        if not tokens:
-            return foods
-
-        filtered: List[Dict[str, Any]] = []
-        for f in foods:
-            haystack = f"{f.get('description', '')} {f.get('brandOwner', '')} {f.get('fdcId', '')}".lower()
-            if all(tok in haystack for tok in tokens):
-                filtered.append(f)
-        return filtered
-
     def _prefetch_fdc_id(self, fdc_id: Any) -> None:
         """Warm USDA cache for a given FDC ID in background (no UI impact)."""
         try:
@@ -2449,35 +1457,19 @@ class MainWindow(QMainWindow):
             on_error=_on_done,
         )
 
-    def _show_current_search_page(self) -> None:
-        start = (self.search_page - 1) * self.search_page_size
-        end = start + self.search_page_size
-        slice_results = self.search_results[start:end]
-        self._populate_table(slice_results, base_index=start)
-        self._prefetch_visible_results(slice_results)
-        total_pages = max(1, (len(self.search_results) + self.search_page_size - 1) // self.search_page_size)
-        self.status_label.setText(
-            f"Se encontraron {len(self.search_results)} resultados (pagina {self.search_page}/{total_pages})."
-        )
-
-    def _prefetch_visible_results(self, foods, limit: int = 2) -> None:
+    def _prefetch_visible_results(self, limit: int = 2) -> None:
         """Proactively fetch details for the first results on screen to warm the cache."""
-        count = 0
-        for food in foods:
-            fdc_id = food.get("fdcId")
-            if fdc_id is None:
-                continue
-            self._prefetch_fdc_id(fdc_id)
-            count += 1
-            if count >= limit:
-                break
-
-    def _update_paging_buttons(self, count: int) -> None:
-        has_query = bool(self.last_query)
-        self.prev_page_button.setEnabled(has_query and self.search_page > 1)
-        self.next_page_button.setEnabled(
-            has_query and (self.search_page * self.search_page_size < count)
-        )
+        for row in range(min(limit, self.search_proxy.rowCount())):
+            fdc_id = self._search_fdc_id_at(row)
+            if fdc_id:
+                self._prefetch_fdc_id(fdc_id)
+
+    def _search_fdc_id_at(self, row: int) -> str:
+        """FDC ID text of a results row as displayed ("" if out of range)."""
+        if row < 0 or row >= self.search_proxy.rowCount():
+            return ""
+        value = self.search_proxy.index(row, SearchResultsModel.FDC_ID_COLUMN).data()
+        return "" if value is None else str(value).strip()
 
     def on_fdc_search_clicked(self) -> None:
         fdc_id_text = self.fdc_id_input.text().strip()
@@ -2504,11 +1496,9 @@ class MainWindow(QMainWindow):
         indexes = self.table.selectionModel().selectedRows()
         if not indexes:
             return
-        row = indexes[0].row()
-        fdc_item = self.table.item(row, 0)
-        if not fdc_item:
+        fdc_id_text = self._search_fdc_id_at(indexes[0].row())
+        if not fdc_id_text:
             return
-        fdc_id_text = fdc_item.text().strip()
         self._prefetch_fdc_id(fdc_id_text)
 
     def on_add_selected_clicked(self) -> None:
@@ -2536,43 +1526,40 @@ class MainWindow(QMainWindow):
             return
         self._edit_quantity_for_row(row)
 
-    def on_lock_toggled_from_table(self, item: QTableWidgetItem) -> None:
-        """Handle lock/unlock toggles coming from any formulation table."""
-        if item.column() != self.lock_column_index:
-            return
+    def on_lock_toggle_requested(self, row: int, desired_locked: bool) -> None:
+        """Handle lock/unlock toggles coming from the formulation model."""
         if self.quantity_mode == "g":
             return
-        table = item.tableWidget()
-        if table not in (self.formulation_table, self.formulation_preview):
-            return
-        row = item.row()
         if row < 0 or row >= len(self.formulation_items):
             return
 
-        desired_locked = item.checkState() == Qt.Checked
         if desired_locked and self._locked_count(exclude_row=row) >= len(
             self.formulation_items
         ) - 1:
-            # Avoid all items locked: keep one free.
-            table.blockSignals(True)
-            item.setCheckState(Qt.Unchecked)
-            table.blockSignals(False)
+            # Avoid all items locked: keep one free (the model still shows it unchecked).
             self.status_label.setText("Debe quedar al menos un ingrediente sin fijar.")
             return
 
+        before = self._capture_state()
         self.formulation_items[row]["locked"] = desired_locked
-        self._refresh_formulation_views()
+        self._record_undo(before)
+        self._journal("lock", index=row, locked=desired_locked)
+        self._refresh_quantity_views()
 
     def on_edit_quantity_clicked(self) -> None:
         indexes = self.formulation_table.selectionModel().selectedRows()
         if not indexes:
             self.status_label.setText("Selecciona un ingrediente para editar.")
             return
+        if len(indexes) > 1:
+            self._edit_quantities_for_rows(sorted(index.row() for index in indexes))
+            return
         self._edit_quantity_for_row(indexes[0].row())
 
     def on_quantity_mode_changed(self) -> None:
         """Switch between grams and percent modes for quantities."""
         self.quantity_mode = "g" if self.quantity_mode_selector.currentIndex() == 0 else "%"
+        self._journal("mode", mode=self.quantity_mode)
         self._refresh_formulation_views()
         mode_text = "gramos (g)" if self.quantity_mode == "g" else "porcentaje (%)"
         self.status_label.setText(f"Modo de cantidad cambiado a {mode_text}.")
@@ -2606,20 +1593,7 @@ class MainWindow(QMainWindow):
             path += ".xlsx"
 
         self._save_last_path(path)
-        try:
-            self._export_formulation_to_excel(path)
-        except Exception as exc:  # noqa: BLE001 - surface the error to the user
-            QMessageBox.critical(
-                self,
-                "Error al exportar",
-                f"No se pudo exportar el archivo:\n{exc}",
-            )
-        else:
-            QMessageBox.information(
-                self,
-                "Exportado",
-                f"Archivo guardado en:\n{path}",
-            )
+        self._start_export_job(path, self._excel_export_writer(), "Exportando Excel")
 
     def on_export_state_clicked(self) -> None:
         """Export formulation state (ingredientes + cantidades + flags) a JSON."""
@@ -2644,37 +1618,15 @@ class MainWindow(QMainWindow):
             path += ".json"
 
         self._save_last_path(path)
-        payload_items: list[Dict[str, Any]] = []
-        for item in self.formulation_items:
-            payload_items.append(
-                {
-                    "fdc_id": item.get("fdc_id"),
-                    "description": item.get("description", ""),
-                    "brand": item.get("brand", ""),
-                    "data_type": item.get("data_type", ""),
-                    "amount_g": float(item.get("amount_g", 0.0) or 0.0),
-                    "locked": bool(item.get("locked", False)),
-                }
-            )
-
-        payload = {
-            "quantity_mode": self.quantity_mode,
-            "items": payload_items,
-            "nutrient_export_flags": self.nutrient_export_flags,
-            "formula_name": self.formula_name_input.text(),
-            "version": 2,
-        }
-        try:
-            Path(path).write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-        except Exception as exc:  # noqa: BLE001
-            QMessageBox.critical(
-                self,
-                "Error al exportar",
-                f"No se pudo exportar la formulación:\n{exc}",
-            )
-            return
-
-        self.status_label.setText(f"Formulación exportada en {path}")
+        payload = state_payload(
+            self.formulation_items,
+            self.quantity_mode,
+            self.totals_model.export_flags,
+            self.formula_name_input.text(),
+        )
+        self._start_export_job(
+            path, lambda target, _report: write_state_json(target, payload), "Exportando formulación"
+        )
 
     def on_import_state_clicked(self) -> None:
         """Import formulation state from JSON or Excel and refresh UI."""
@@ -2688,202 +1640,26 @@ class MainWindow(QMainWindow):
             return
         self._save_last_path(path)
 
-        ext = Path(path).suffix.lower()
-        if ext == ".json":
-            parsed = self._load_state_from_json(path)
-        elif ext in (".xlsx", ".xls"):
-            parsed = self._load_state_from_excel(path)
-        else:
-            QMessageBox.warning(
-                self,
-                "Formato no soportado",
-                "Selecciona un archivo .json o .xlsx",
-            )
-            return
-
-        if not parsed:
+        try:
+            base_items, meta = load_formulation_file(path, self.formula_name_input.text())
+        except FormulationFileError as exc:
+            show = QMessageBox.critical if exc.critical else QMessageBox.warning
+            show(self, exc.title, str(exc))
             return
 
-        base_items, meta = parsed
         meta.setdefault("path", path)
         self._start_import_hydration(base_items, meta)
 
-    def _load_state_from_json(self, path: str) -> tuple[list[Dict[str, Any]], Dict[str, Any]] | None:
-        try:
-            data = json.loads(Path(path).read_text(encoding="utf-8"))
-        except Exception as exc:  # noqa: BLE001
-            QMessageBox.critical(
-                self,
-                "Error al importar",
-                f"No se pudo leer el archivo:\n{exc}",
-            )
-            return None
-
-        if not isinstance(data, dict):
-            QMessageBox.warning(
-                self,
-                "Formato inválido",
-                "El archivo no contiene una formulación válida.",
-            )
-            return None
-
-        items = data.get("items") or []
-        if not isinstance(items, list) or not items:
+    def _start_import_hydration(
+        self, base_items: list[Dict[str, Any]], meta: Dict[str, Any]
+    ) -> None:
+        if not base_items:
             QMessageBox.warning(
                 self,
-                "Formato inválido",
-                "El archivo no contiene ingredientes válidos.",
+                "Sin ingredientes",
+                "El archivo no contiene ingredientes para importar.",
             )
-            return None
-
-        base_items: list[Dict[str, Any]] = []
-        for item in items:
-            if not isinstance(item, dict):
-                continue
-            try:
-                fdc_int = int(item.get("fdc_id") or item.get("fdcId"))
-            except Exception:
-                QMessageBox.warning(
-                    self,
-                    "FDC ID inválido",
-                    f"FDC ID no numérico: {item.get('fdc_id') or item.get('fdcId')}",
-                )
-                return None
-            base_items.append(
-                {
-                    "fdc_id": fdc_int,
-                    "amount_g": float(item.get("amount_g", 0.0) or 0.0),
-                    "locked": bool(item.get("locked", False)),
-                    "description": item.get("description", ""),
-                    "brand": item.get("brand", ""),
-                    "data_type": item.get("data_type", ""),
-                }
-            )
-
-        flags = data.get("nutrient_export_flags")
-        nutrient_flags = (
-            {k: bool(v) for k, v in flags.items()} if isinstance(flags, dict) else {}
-        )
-
-        mode = data.get("quantity_mode", "g")
-        quantity_mode = "g" if mode != "%" else "%"
-
-        meta = {
-            "nutrient_export_flags": nutrient_flags,
-            "quantity_mode": quantity_mode,
-            "formula_name": data.get("formula_name", ""),
-            "path": path,
-            "respect_existing_formula_name": False,
-        }
-        return base_items, meta
-
-    def _load_state_from_excel(self, path: str) -> tuple[list[Dict[str, Any]], Dict[str, Any]] | None:
-        def _read(sheet: str | int, header_row: int) -> pd.DataFrame:
-            return pd.read_excel(path, sheet_name=sheet, header=header_row)
-
-        df: pd.DataFrame | None = None
-        # Prefer sheet "Ingredientes" with headers on second row (row index 1)
-        for sheet in ("Ingredientes", 0):
-            for header_row in (1, 0):
-                try:
-                    tmp = _read(sheet, header_row)
-                    if not tmp.empty:
-                        df = tmp
-                        break
-                except Exception:
-                    continue
-            if df is not None:
-                break
-
-        if df is None or df.empty:
-            QMessageBox.warning(
-                self,
-                "Sin datos",
-                "El archivo no tiene filas para importar.",
-            )
-            return None
-
-        # Normalize columns for matching
-        cols_norm: Dict[str, str] = {self._normalize_label(c): c for c in df.columns}
-        fdc_candidates = [
-            "fdc id",
-            "fdc_id",
-            "fdcid",
-            "fdc",
-        ]
-        amount_candidates = [
-            "cantidad (g)",
-            "cantidad g",
-            "cantidad",
-            "cantidad gramos",
-            "cantidad en gramos",
-            "amount g",
-            "amount_g",
-            "g",
-            "grams",
-        ]
-
-        fdc_col = next((cols_norm[c] for c in fdc_candidates if c in cols_norm), None)
-        amount_col = next(
-            (cols_norm[c] for c in amount_candidates if c in cols_norm), None
-        )
-        if not fdc_col or not amount_col:
-            QMessageBox.warning(
-                self,
-                "Columnas faltantes",
-                "Se requieren columnas FDC ID y Cantidad (g).",
-            )
-            return None
-
-        base_items: list[Dict[str, Any]] = []
-        for _, row in df.iterrows():
-            fdc_val = row.get(fdc_col)
-            amt_val = row.get(amount_col)
-            if pd.isna(fdc_val):
-                continue
-            try:
-                fdc_int = int(fdc_val)
-            except Exception:
-                continue
-            try:
-                amt = float(amt_val) if not pd.isna(amt_val) else 0.0
-            except Exception:
-                amt = 0.0
-            base_items.append(
-                {
-                    "fdc_id": fdc_int,
-                    "amount_g": amt,
-                    "locked": False,
-                }
-            )
-
-        if not base_items:
-            QMessageBox.warning(
-                self,
-                "Sin ingredientes",
-                "No se encontraron filas válidas con FDC ID y Cantidad (g).",
-            )
-            return None
-
-        meta = {
-            "nutrient_export_flags": {},
-            "quantity_mode": "g",
-            "formula_name": self.formula_name_input.text() or Path(path).stem,
-            "path": path,
-            "respect_existing_formula_name": True,
-        }
-        return base_items, meta
-
-    def _start_import_hydration(
-        self, base_items: list[Dict[str, Any]], meta: Dict[str, Any]
-    ) -> None:
-        if not base_items:
-            QMessageBox.warning(
-                self,
-                "Sin ingredientes",
-                "El archivo no contiene ingredientes para importar.",
-            )
-            return
+            return
 
         self.import_state_button.setEnabled(False)
         self.export_state_button.setEnabled(False)
@@ -2935,34 +1711,14 @@ class MainWindow(QMainWindow):
             QTimer.singleShot(0, lambda p=payload, m=meta: self._on_import_finished(p))
             return
         self._reset_import_ui_state()
-        hydrated: list[Dict[str, Any]] = []
-        for entry in payload:
-            base = entry.get("base") or {}
-            details = entry.get("details") or {}
-            fdc_id = base.get("fdc_id") or details.get("fdcId")
-            try:
-                fdc_id_int = int(fdc_id) if fdc_id is not None else None
-            except Exception:
-                fdc_id_int = fdc_id
-
-            nutrients = augment_fat_nutrients(details.get("foodNutrients", []) or [])
-            self._update_reference_from_details(details)
-            hydrated.append(
-                {
-                    "fdc_id": fdc_id_int,
-                    "description": details.get("description", "") or base.get("description", ""),
-                    "brand": details.get("brandOwner", "") or base.get("brand", ""),
-                    "data_type": details.get("dataType", "") or base.get("data_type", ""),
-                    "amount_g": float(base.get("amount_g", 0.0) or 0.0),
-                    "nutrients": normalize_nutrients(
-                        nutrients, details.get("dataType")
-                    ),
-                    "locked": bool(base.get("locked", False)),
-                }
-            )
+        hydrated = [
+            hydrate_item(entry.get("base") or {}, entry.get("details") or {}, self._registry)
+            for entry in payload
+        ]
 
+        self._record_undo(self._capture_state())
         self.formulation_items = hydrated
-        self.nutrient_export_flags = meta.get("nutrient_export_flags", {})
+        self.totals_model.set_export_flags(meta.get("nutrient_export_flags", {}))
         mode = meta.get("quantity_mode", "g")
         self.quantity_mode = "g" if mode != "%" else "%"
         self.quantity_mode_selector.blockSignals(True)
@@ -2977,8 +1733,18 @@ class MainWindow(QMainWindow):
             self.formula_name_input.setText(formula_name)
 
         self._refresh_formulation_views()
+        # The whole formulation changed: start the journal over from this state.
+        self._journaled_flags = {key: False for key, value in meta.get("nutrient_export_flags", {}).items() if not value}
+        self._compact_autosave()
         source = meta.get("path", "archivo")
-        self.status_label.setText(f"Formulación importada desde {source}")
+        status = f"Formulación importada desde {source}"
+        if meta.get("nutrients_from_sheet"):
+            # Nutrients came from the workbook; compare with USDA data only if already cached.
+            mismatches = sheet_mismatches(hydrated, registry=self._registry)
+            if mismatches:
+                ids = ", ".join(str(fdc_id) for fdc_id in mismatches)
+                status += f" (valores distintos a USDA en FDC {ids})"
+        self.status_label.setText(status)
 
     def _on_import_error(self, message: str) -> None:
         self._reset_import_ui_state()
@@ -2991,24 +1757,247 @@ class MainWindow(QMainWindow):
         self._set_window_progress(None)
         self._current_import_worker = None
 
-    def _populate_table(self, foods, base_index: int = 0) -> None:
-        self.table.setRowCount(0)
+    def on_compare_states_clicked(self) -> None:
+        """Load several saved formulations (one shared hydration) and compare their totals."""
+        paths, _ = QFileDialog.getOpenFileNames(
+            self,
+            "Comparar formulaciones",
+            self.last_path or "",
+            "Formulaciones (*.json *.xlsx *.xls)",
+        )
+        if not paths:
+            return
+        self._save_last_path(paths[0])
+        self.compare_states_button.setEnabled(False)
+        self.status_label.setText(f"Comparando {len(paths)} formulaciones...")
+        self._set_window_progress("Comparando formulaciones")
+        self._run_in_thread(
+            compare_formulations,
+            (
+                paths,
+                dict(self.data_type_priority),
+                self.import_max_attempts,
+                self.import_read_timeout,
+            ),
+            self._on_compare_finished,
+            self._on_compare_error,
+        )
 
-        for row_idx, food in enumerate(foods):
-            self.table.insertRow(row_idx)
+    def _on_compare_finished(self, comparison: FormulationComparison) -> None:
+        self.compare_states_button.setEnabled(True)
+        self._set_window_progress(None)
+        if comparison.errors:
+            QMessageBox.warning(
+                self,
+                "Formulaciones omitidas",
+                "\n".join(f"{Path(path).name}: {message}" for path, message in comparison.errors.items()),
+            )
+        if not comparison.names:
+            self.status_label.setText("No se pudo cargar ninguna formulación para comparar.")
+            return
+        self.status_label.setText(
+            f"Comparadas {len(comparison.names)} formulaciones "
+            f"({comparison.fetched} alimentos consultados a USDA)."
+        )
+        self._build_comparison_dialog(comparison).exec()
 
-            fdc_id = str(food.get("fdcId", ""))
-            description = food.get("description", "") or ""
-            brand = food.get("brandOwner", "") or ""
-            data_type = food.get("dataType", "") or ""
+    def _on_compare_error(self, message: str) -> None:
+        self.compare_states_button.setEnabled(True)
+        self._set_window_progress(None)
+        self.status_label.setText("Error al comparar formulaciones.")
+        QMessageBox.critical(self, "Error al comparar", message)
 
-            self.table.setItem(row_idx, 0, QTableWidgetItem(fdc_id))
-            self.table.setItem(row_idx, 1, QTableWidgetItem(description))
-            self.table.setItem(row_idx, 2, QTableWidgetItem(brand))
-            self.table.setItem(row_idx, 3, QTableWidgetItem(data_type))
-            self.table.setVerticalHeaderItem(
-                row_idx, QTableWidgetItem(str(base_index + row_idx + 1))
-            )
+    def _build_comparison_dialog(self, comparison: FormulationComparison) -> QDialog:
+        """Nutrients as rows, one column per formulation (totals per 100 g)."""
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Comparación de formulaciones")
+        dialog.resize(900, 600)
+        layout = QVBoxLayout(dialog)
+        layout.addWidget(QLabel("Totales por 100 g de producto"))
+
+        table = QTableWidget(dialog)
+        table.setEditTriggers(QTableWidget.NoEditTriggers)
+        table.setColumnCount(len(comparison.names) + 1)
+        table.setHorizontalHeaderLabels(["Categoría", *comparison.names])
+        for column, path in enumerate(comparison.paths, start=1):
+            table.horizontalHeaderItem(column).setToolTip(path)
+
+        summary_rows = [
+            ("Ingredientes", [str(count) for count in comparison.ingredient_counts]),
+            ("Peso total (g)", [f"{weight:.1f}" for weight in comparison.total_weights]),
+        ]
+        table.setRowCount(len(summary_rows) + len(comparison.headers))
+        labels: list[str] = []
+        for row, (label, values) in enumerate(summary_rows):
+            labels.append(label)
+            for column, text in enumerate(values, start=1):
+                table.setItem(row, column, QTableWidgetItem(text))
+        offset = len(summary_rows)
+        for index, (header, category) in enumerate(zip(comparison.headers, comparison.categories)):
+            labels.append(header)
+            table.setItem(offset + index, 0, QTableWidgetItem(category))
+            for column, value in enumerate(comparison.totals[:, index], start=1):
+                text = "" if value != value else f"{value:.2f}"  # NaN: not reported
+                item = QTableWidgetItem(text)
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                table.setItem(offset + index, column, item)
+        table.setVerticalHeaderLabels(labels)
+        table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self._attach_copy_shortcut(table)
+        layout.addWidget(table)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Close, parent=dialog)
+        buttons.rejected.connect(dialog.reject)
+        layout.addWidget(buttons)
+        return dialog
+
+    # ---- Optimizer ----
+    def on_optimize_clicked(self) -> None:
+        """Solve for percentages that meet nutrient targets and apply them as one edit."""
+        if not self.formulation_items:
+            self.status_label.setText("Agrega ingredientes antes de optimizar.")
+            return
+        self.formulation_engine.sync(self.formulation_items)
+        columns = sorted(
+            self.formulation_engine.snapshot().columns,
+            key=lambda column: column[3] if column[3] is not None else float("inf"),
+        )
+        nutrients = [(key, f"{name} ({unit})" if unit else name) for key, name, unit, _ in columns]
+        if not nutrients:
+            self.status_label.setText("Los ingredientes no tienen nutrientes para optimizar.")
+            return
+
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Optimizar formulación")
+        dialog.resize(700, 600)
+        layout = QVBoxLayout(dialog)
+
+        layout.addWidget(QLabel("Metas por 100 g de producto (vacío = sin límite)"))
+        targets_table = QTableWidget(0, 3, dialog)
+        targets_table.setHorizontalHeaderLabels(["Nutriente", "Mínimo", "Máximo"])
+        targets_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        layout.addWidget(targets_table)
+
+        def add_target_row() -> None:
+            row = targets_table.rowCount()
+            targets_table.insertRow(row)
+            combo = QComboBox(targets_table)
+            for key, label in nutrients:
+                combo.addItem(label, key)
+            targets_table.setCellWidget(row, 0, combo)
+            targets_table.setItem(row, 1, QTableWidgetItem(""))
+            targets_table.setItem(row, 2, QTableWidgetItem(""))
+
+        target_buttons = QHBoxLayout()
+        add_target = QPushButton("Agregar meta", dialog)
+        remove_target = QPushButton("Quitar meta", dialog)
+        add_target.clicked.connect(add_target_row)
+        def remove_target_row() -> None:
+            if targets_table.currentRow() >= 0:
+                targets_table.removeRow(targets_table.currentRow())
+
+        remove_target.clicked.connect(remove_target_row)
+        target_buttons.addWidget(add_target)
+        target_buttons.addWidget(remove_target)
+        target_buttons.addStretch()
+        layout.addLayout(target_buttons)
+        add_target_row()
+
+        layout.addWidget(QLabel("Límites de ingredientes (%); los fijados conservan su porcentaje"))
+        bounds_table = QTableWidget(len(self.formulation_items), 3, dialog)
+        bounds_table.setHorizontalHeaderLabels(["Ingrediente", "Mín %", "Máx %"])
+        bounds_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        for row, item in enumerate(self.formulation_items):
+            name_item = QTableWidgetItem(f"{item.get('fdc_id', '')} - {item.get('description', '')}")
+            name_item.setFlags(name_item.flags() & ~Qt.ItemIsEditable)
+            bounds_table.setItem(row, 0, name_item)
+            for column, default in ((1, "0"), (2, "100")):
+                cell = QTableWidgetItem(default)
+                if item.get("locked"):
+                    cell.setText(f"{self._amount_to_percent(item.get('amount_g', 0.0) or 0.0):.2f}")
+                    cell.setFlags(cell.flags() & ~Qt.ItemIsEditable)
+                bounds_table.setItem(row, column, cell)
+        layout.addWidget(bounds_table)
+
+        objective_layout = QHBoxLayout()
+        objective_combo = QComboBox(dialog)
+        objective_combo.addItem("Lo más parecido a la receta actual", "closest")
+        objective_combo.addItem("Maximizar", "maximize")
+        objective_combo.addItem("Minimizar", "minimize")
+        objective_nutrient = QComboBox(dialog)
+        for key, label in nutrients:
+            objective_nutrient.addItem(label, key)
+        objective_nutrient.setEnabled(False)
+        objective_combo.currentIndexChanged.connect(
+            lambda index: objective_nutrient.setEnabled(index > 0)
+        )
+        objective_layout.addWidget(QLabel("Objetivo:"))
+        objective_layout.addWidget(objective_combo)
+        objective_layout.addWidget(objective_nutrient, 1)
+        layout.addLayout(objective_layout)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, parent=dialog)
+        buttons.button(QDialogButtonBox.Ok).setText("Optimizar")
+        buttons.rejected.connect(dialog.reject)
+        layout.addWidget(buttons)
+
+        def cell_value(table: QTableWidget, row: int, column: int) -> float | None:
+            text = (table.item(row, column).text() if table.item(row, column) else "").strip()
+            return float(text.replace(",", ".")) if text else None
+
+        solved: Dict[str, Any] = {}
+
+        def solve() -> None:
+            try:
+                targets = [
+                    NutrientTarget(
+                        targets_table.cellWidget(row, 0).currentData(),
+                        cell_value(targets_table, row, 1),
+                        cell_value(targets_table, row, 2),
+                    )
+                    for row in range(targets_table.rowCount())
+                ]
+                minimum = [cell_value(bounds_table, row, 1) or 0.0 for row in range(bounds_table.rowCount())]
+                maximum = [
+                    100.0 if (value := cell_value(bounds_table, row, 2)) is None else value
+                    for row in range(bounds_table.rowCount())
+                ]
+            except ValueError:
+                QMessageBox.warning(dialog, "Valor inválido", "Los límites deben ser números.")
+                return
+            objective = objective_combo.currentData()
+            try:
+                result = optimize_formulation(
+                    self.formulation_engine,
+                    [target for target in targets if target.minimum is not None or target.maximum is not None],
+                    minimum,
+                    maximum,
+                    locked=[bool(item.get("locked")) for item in self.formulation_items],
+                    objective=objective,
+                    objective_key=objective_nutrient.currentData() if objective != "closest" else None,
+                )
+            except InfeasiblePercents as exc:
+                QMessageBox.warning(dialog, exc.title, str(exc))
+                return
+            solved["result"] = result
+            dialog.accept()
+
+        buttons.accepted.connect(solve)
+        if dialog.exec() != QDialog.Accepted:
+            return
+
+        total_weight = self._total_weight()
+        base_total = total_weight if total_weight > 0 else 100.0
+        before = self._capture_state()
+        result = solved["result"]
+        for item, pct in zip(self.formulation_items, result.percents.tolist()):
+            item["amount_g"] = max(pct, 0.0) * base_total / 100.0
+        self._record_undo(before)
+        self._journal_amounts()
+        self._refresh_quantity_views()
+        self.status_label.setText(
+            f"Formulación optimizada en {result.elapsed * 1000.0:.0f} ms (peso total conservado)."
+        )
 
     def _populate_details_table(self, nutrients) -> None:
         nutrients = self._sort_nutrients_for_display(augment_fat_nutrients(nutrients or []))
@@ -3050,46 +2039,6 @@ class MainWindow(QMainWindow):
             return 0.0
         return (amount_g / total_weight) * 100.0
 
-    def _update_quantity_headers(self) -> None:
-        self.formulation_preview.setHorizontalHeaderLabels(
-            ["FDC ID", "Ingrediente"]
-        )
-        self.formulation_table.setHorizontalHeaderLabels(
-            [
-                "FDC ID",
-                "Ingrediente",
-                "Cantidad (g)",
-                "Cantidad (%)",
-                "Fijar %",
-                "Marca / Origen",
-            ]
-        )
-
-    def _set_item_enabled(self, item: QTableWidgetItem | None, enabled: bool) -> None:
-        if item is None:
-            return
-        flags = item.flags()
-        if enabled:
-            flags |= Qt.ItemIsEnabled
-        else:
-            flags &= ~Qt.ItemIsEnabled
-        item.setFlags(flags)
-        item.setBackground(QColor("#f0f0f0") if not enabled else QColor("white"))
-
-    def _apply_column_state(self, table: QTableWidget, row: int) -> None:
-        grams_enabled = self.quantity_mode == "g"
-        percent_enabled = self.quantity_mode == "%"
-
-        self._set_item_enabled(
-            table.item(row, self.amount_g_column_index), grams_enabled
-        )
-        self._set_item_enabled(
-            table.item(row, self.percent_column_index), percent_enabled
-        )
-        self._set_item_enabled(
-            table.item(row, self.lock_column_index), percent_enabled
-        )
-
     def _can_edit_column(self, column: int | None) -> bool:
         if column is None:
             return True
@@ -3097,211 +2046,6 @@ class MainWindow(QMainWindow):
             return column == self.amount_g_column_index
         return column == self.percent_column_index
 
-    def _nutrients_by_header(
-        self, nutrients: List[Dict[str, Any]], header_by_key: Dict[str, str]
-    ) -> Dict[str, float]:
-        """
-        Build a mapping of template header -> nutrient amount (per 100 g),
-        aligned to a precomputed header key map to avoid duplicate columns.
-        """
-        out: Dict[str, float] = {}
-        best_priority: Dict[str, int] = {}
-        allowed_keys = set(header_by_key.keys())
-        alias_priority = {
-            "carbohydrate, by difference": 2,
-            "carbohydrate, by summation": 1,
-            "carbohydrate by summation": 1,
-            "sugars, total": 2,
-            "total sugars": 1,
-        }
-
-        for entry in nutrients:
-            amount = entry.get("amount")
-            if amount is None:
-                continue
-            nut = entry.get("nutrient") or {}
-            header_key, name, unit = self._header_key(nut)
-            if not header_key or header_key not in allowed_keys:
-                continue
-            header = header_by_key[header_key]
-            priority = alias_priority.get((nut.get("name") or "").strip().lower(), 0)
-            current_best = best_priority.get(header, -1)
-            if priority < current_best:
-                continue
-
-            best_priority[header] = priority
-            out[header] = amount
-
-        return out
-
-    def _category_for_nutrient(self, name: str, nutrient: Dict[str, Any] | None = None) -> str:
-        """Resolve a nutrient category using the static catalog then reference hints."""
-        lower = (name or "").strip().lower()
-        if lower in self._nutrient_category_map:
-            return self._nutrient_category_map[lower]
-
-        amino_acids = {
-            "tryptophan",
-            "threonine",
-            "isoleucine",
-            "leucine",
-            "lysine",
-            "methionine",
-            "phenylalanine",
-            "tyrosine",
-            "valine",
-            "arginine",
-            "histidine",
-            "alanine",
-            "aspartic acid",
-            "glutamic acid",
-            "glycine",
-            "proline",
-            "serine",
-            "hydroxyproline",
-            "cysteine",
-            "cystine",
-        }
-        organic_acids = {
-            "citric acid",
-            "malic acid",
-            "oxalic acid",
-            "quinic acid",
-        }
-        oligosaccharides = {"raffinose", "stachyose", "verbascose"}
-        isoflavones = {"daidzein", "genistein", "daidzin", "genistin", "glycitin"}
-
-        vitamin_like = (
-            lower.startswith("vitamin ")
-            or "tocopherol" in lower
-            or "tocotrienol" in lower
-            or "carotene" in lower
-            or "lycopene" in lower
-            or "lutein" in lower
-            or "zeaxanthin" in lower
-            or "retinol" in lower
-            or "folate" in lower
-            or "folic acid" in lower
-            or "betaine" in lower
-            or "choline" in lower
-            or "caffeine" in lower
-            or "theobromine" in lower
-        )
-        if vitamin_like:
-            return "Vitamins and Other Components"
-
-        if lower in amino_acids:
-            return "Amino acids"
-        if (
-            "fatty acids" in lower
-            or lower.startswith(("sfa ", "mufa ", "pufa "))
-            or lower in {"cholesterol", "total lipid (fat)", "total fat (nlea)"}
-        ):
-            return "Lipids"
-        if "sterol" in lower:
-            return "Phytosterols"
-        if lower in organic_acids or (lower.endswith("acid") and lower not in amino_acids):
-            return "Organic acids"
-        if lower in oligosaccharides:
-            return "Oligosaccharides"
-        if lower in isoflavones:
-            return "Isoflavones"
-
-        if nutrient:
-            ref = self._reference_info(nutrient)
-            if ref.get("category"):
-                return ref["category"]
-        return "Nutrientes"
-
-    def _collect_nutrient_columns(self) -> tuple[list[str], Dict[str, str], Dict[str, str]]:
-        """
-        Collect ordered nutrient headers and their categories.
-        Uses the static catalog to force a default ordering/grouping and only keeps
-        nutrients that appear with a value in any ingredient.
-        """
-        candidates: Dict[str, Dict[str, Any]] = {}
-        categories_seen_order: Dict[str, int] = {}
-        preferred_order = [cat for cat, _ in self._nutrient_catalog]
-        preferred_count = len(preferred_order)
-
-        for item in self.formulation_items:
-            data_priority = self.data_type_priority.get(
-                (item.get("data_type") or "").strip(), len(self.data_type_priority)
-            )
-            for entry in self._sort_nutrients_for_display(item.get("nutrients", [])):
-                nut = entry.get("nutrient") or {}
-                amount = entry.get("amount")
-                if amount is None:
-                    continue
-                header_key, canonical_name, canonical_unit = self._header_key(nut)
-                if header_key and not self.nutrient_export_flags.get(header_key, True):
-                    continue
-
-                if not header_key or not canonical_name:
-                    continue
-
-                category = self._category_for_nutrient(canonical_name, nut)
-                if category not in categories_seen_order:
-                    categories_seen_order[category] = len(categories_seen_order)
-
-                order = self._nutrient_order_map.get(canonical_name.strip().lower())
-                if order is None:
-                    order = self._nutrient_order(nut, len(candidates))
-                # Keep kcal ahead of kJ when both present
-                unit_lower = (canonical_unit or "").strip().lower()
-                if canonical_name.strip().lower() == "energy":
-                    if unit_lower == "kcal":
-                        order = order - 0.1 if isinstance(order, (int, float)) else order
-                    elif unit_lower == "kj":
-                        order = order + 0.1 if isinstance(order, (int, float)) else order
-
-                header = (
-                    f"{canonical_name} ({canonical_unit})"
-                    if canonical_unit
-                    else canonical_name
-                )
-
-                existing = candidates.get(header_key)
-                if existing is None or (
-                    data_priority < existing["data_priority"]
-                    or (
-                        data_priority == existing["data_priority"]
-                        and order < existing["order"]
-                    )
-                    or (
-                        data_priority == existing["data_priority"]
-                        and order == existing["order"]
-                        and header < existing["header"]
-                    )
-                ):
-                    candidates[header_key] = {
-                        "header_key": header_key,
-                        "header": header,
-                        "category": category,
-                        "order": order,
-                        "data_priority": data_priority,
-                    }
-
-        def category_rank(cat: str) -> int:
-            if cat in preferred_order:
-                return preferred_order.index(cat)
-            return preferred_count + categories_seen_order.get(cat, preferred_count)
-
-        sorted_candidates = sorted(
-            candidates.values(),
-            key=lambda c: (
-                category_rank(c["category"]),
-                c["order"],
-                c["header"].lower(),
-            ),
-        )
-
-        ordered_headers: list[str] = [c["header"] for c in sorted_candidates]
-        categories: Dict[str, str] = {c["header"]: c["category"] for c in sorted_candidates}
-        header_key_map: Dict[str, str] = {c["header"]: c["header_key"] for c in sorted_candidates}
-
-        return ordered_headers, categories, header_key_map
-
     def _load_last_path(self) -> str:
         try:
             data = json.loads(Path("last_path.json").read_text(encoding="utf-8"))
@@ -3323,18 +2067,21 @@ class MainWindow(QMainWindow):
 
     def _ensure_normalized_items(self) -> None:
         """Normalize all formulation_items in-place (fat + energy)."""
-        for idx, item in enumerate(self.formulation_items):
+        for item in self.formulation_items:
             original = item.get("nutrients", []) or []
-            normalized = normalize_nutrients(original, item.get("data_type"))
+            # Entries stamped with a registry ID were already normalized on load.
+            if original and all("nid" in entry for entry in original):
+                continue
+            normalized = self._normalize_with_ids(original, item.get("data_type"))
             if normalized != original:
                 # preserve reference to allow downstream updates
                 item["nutrients"] = normalized
 
-    def _split_header_unit(self, header: str) -> tuple[str, str]:
-        if header.endswith(")") and " (" in header:
-            name, unit = header.rsplit(" (", 1)
-            return name, unit[:-1]
-        return header, ""
+    def _normalize_with_ids(
+        self, nutrients: list[Dict[str, Any]], data_type: str | None
+    ) -> list[Dict[str, Any]]:
+        """Normalize USDA nutrients and stamp each entry with its registry ID."""
+        return assign_nutrient_ids(normalize_nutrients(nutrients, data_type))
 
     def _hydrate_items(self, items: list[Dict[str, Any]]) -> list[Dict[str, Any]] | None:
         """Fetch USDA details for items to populate description/nutrients."""
@@ -3382,7 +2129,7 @@ class MainWindow(QMainWindow):
                     "brand": details.get("brandOwner", "") or item.get("brand", ""),
                     "data_type": details.get("dataType", "") or item.get("data_type", ""),
                     "amount_g": float(item.get("amount_g", 0.0) or 0.0),
-                    "nutrients": normalize_nutrients(
+                    "nutrients": self._normalize_with_ids(
                         details.get("foodNutrients", []) or [], details.get("dataType")
                     ),
                     "locked": bool(item.get("locked", False)),
@@ -3391,127 +2138,20 @@ class MainWindow(QMainWindow):
 
         return hydrated
 
-    def _normalize_label(self, label: str) -> str:
-        """Normalize column labels for loose matching (casefold + strip accents)."""
-        if label is None:
-            return ""
-        text = str(label)
-        text = unicodedata.normalize("NFKD", text)
-        text = "".join(ch for ch in text if not unicodedata.combining(ch))
-        text = text.replace("_", " ").replace("-", " ")
-        return re.sub(r"\s+", " ", text).strip().lower()
-
     def _populate_formulation_tables(self) -> None:
-        """Refresh formulation tables with current items."""
+        """Sync the formulation model with current items (only changed rows/cells repaint)."""
         logging.debug(f"_populate_formulation_tables rows={len(self.formulation_items)}")
-        self._update_quantity_headers()
-        total_weight = self._total_weight()
-
-        # Left preview (ID + Ingrediente)
-        self.formulation_preview.blockSignals(True)
-        self.formulation_preview.setRowCount(len(self.formulation_items))
-        for idx, item in enumerate(self.formulation_items):
-            self.formulation_items[idx].setdefault("locked", False)
-            self.formulation_preview.setItem(
-                idx, 0, QTableWidgetItem(str(item.get("fdc_id", "")))
-            )
-            self.formulation_preview.setItem(
-                idx, 1, QTableWidgetItem(item.get("description", ""))
-            )
-        self.formulation_preview.blockSignals(False)
-
-        # Main formulation table
-        self.formulation_table.blockSignals(True)
-        self.formulation_table.setRowCount(len(self.formulation_items))
-        for idx, item in enumerate(self.formulation_items):
-            amount_g = float(item.get("amount_g", 0.0) or 0.0)
-            percent = self._amount_to_percent(amount_g, total_weight)
-
-            cells: list[QTableWidgetItem] = [
-                QTableWidgetItem(str(item.get("fdc_id", ""))),
-                QTableWidgetItem(item.get("description", "")),
-                QTableWidgetItem(f"{amount_g:.1f}"),
-                QTableWidgetItem(f"{percent:.2f}"),
-            ]
-
-            lock_item = QTableWidgetItem("")
-            lock_item.setFlags(
-                Qt.ItemIsSelectable | Qt.ItemIsUserCheckable | Qt.ItemIsEnabled
-            )
-            lock_item.setCheckState(
-                Qt.Checked if item.get("locked") else Qt.Unchecked
-            )
-            cells.append(lock_item)
-
-            cells.append(QTableWidgetItem(item.get("brand", "")))
-
-            for col, cell in enumerate(cells):
-                self.formulation_table.setItem(idx, col, cell)
-
-            self._apply_column_state(self.formulation_table, idx)
-        self.formulation_table.blockSignals(False)
+        for item in self.formulation_items:
+            item.setdefault("locked", False)
+        self.formulation_model.set_quantity_mode(self.quantity_mode)
+        self.formulation_model.sync_items(self.formulation_items)
         logging.debug("_populate_formulation_tables done")
 
-    def _populate_totals_table(self) -> None:
-        logging.debug("_populate_totals_table start")
-        totals = self._calculate_totals()
-        self._last_totals = totals
-
-        category_order = [cat for cat, _ in self._nutrient_catalog]
-
-        def _cat_rank(name: str) -> int:
-            cat = self._category_for_nutrient(name)
-            if cat in category_order:
-                return category_order.index(cat)
-            return len(category_order) + 1
-
-        def _order_val(name: str) -> float:
-            return float(self._nutrient_order_map.get(name.strip().lower(), float("inf")))
-
-        sorted_totals = sorted(
-            totals.items(),
-            key=lambda item: (
-                _cat_rank(item[1].get("name", "")),
-                _order_val(item[1].get("name", "")),
-                item[1].get("name", "").lower(),
-            ),
-        )
-
-        self.totals_table.blockSignals(True)
-        self.totals_table.setRowCount(len(sorted_totals))
-        new_flags: Dict[str, bool] = {}
-
-        for row_idx, (nut_key, entry) in enumerate(sorted_totals):
-            name_item = QTableWidgetItem(entry["name"])
-            name_item.setData(Qt.UserRole, nut_key)
-            self.totals_table.setItem(row_idx, 0, name_item)
-
-            self.totals_table.setItem(
-                row_idx, 1, QTableWidgetItem(f"{entry['amount']:.2f}")
-            )
-            self.totals_table.setItem(row_idx, 2, QTableWidgetItem(entry["unit"]))
-
-            export_item = QTableWidgetItem("")
-            export_item.setFlags(
-                Qt.ItemIsUserCheckable | Qt.ItemIsEnabled | Qt.ItemIsSelectable
-            )
-            current_checked = self.nutrient_export_flags.get(nut_key, True)
-            export_item.setCheckState(Qt.Checked if current_checked else Qt.Unchecked)
-            export_item.setData(Qt.UserRole, nut_key)
-            self.totals_table.setItem(row_idx, 3, export_item)
-            new_flags[nut_key] = current_checked
-
-        self.nutrient_export_flags = new_flags
-        self.totals_table.blockSignals(False)
-        self._update_toggle_export_button()
-        logging.debug("_populate_totals_table done")
-
     def _update_toggle_export_button(self) -> None:
         if not hasattr(self, "toggle_export_button"):
             return
-        all_checked = self.nutrient_export_flags and all(
-            self.nutrient_export_flags.values()
-        )
+        export_flags = self.totals_model.export_flags
+        all_checked = export_flags and all(export_flags.values())
         text = "Deseleccionar todos" if all_checked else "Seleccionar todos"
         self.toggle_export_button.setText(text)
 
@@ -3539,13 +2179,32 @@ class MainWindow(QMainWindow):
             return
         self._ensure_normalized_items()
         self._populate_formulation_tables()
-        self._populate_totals_table()
-        self._update_label_preview(force_recalc_totals=True)
+        self._mark_views_dirty("totals", "label_table", "linear")
         logging.debug("_refresh_formulation_views done")
         self._ensure_preview_selection()
 
+    def _refresh_quantity_views(self) -> None:
+        """
+        Lighter refresh for amount/lock edits: the ingredient list and nutrient columns
+        are unchanged, so only quantity cells, totals values and the label are updated.
+        """
+        if QThread.currentThread() is not self.thread():
+            QTimer.singleShot(0, self._refresh_quantity_views)
+            return
+        if self.formulation_model.rowCount() != len(self.formulation_items):
+            self._refresh_formulation_views()
+            return
+        self.formulation_model.refresh_quantities()
+        self._mark_views_dirty("totals", "label_table", "linear")
+
+    def _refresh_totals_view(self, totals: Dict[str, Dict[str, Any]] | None = None) -> None:
+        """Update totals values in place, rebuilding rows only if the nutrient set changed."""
+        if totals is None:
+            totals = self._calculate_totals()
+        self.totals_model.set_totals(totals)
+
     def _select_preview_row(self, row: int) -> None:
-        if row < 0 or row >= self.formulation_preview.rowCount():
+        if row < 0 or row >= self.formulation_model.rowCount():
             return
         sel_model = self.formulation_preview.selectionModel()
         if sel_model is None:
@@ -3583,163 +2242,79 @@ class MainWindow(QMainWindow):
         row = sel_model.selectedRows()[0].row()
         self._show_nutrients_for_row(row)
 
-    def _export_formulation_to_excel(self, filepath: str) -> None:
-        """Build Excel from scratch with nutrient categories as in USDA view."""
+    def _excel_export_writer(self) -> Callable[[Path, Callable[[str], None]], None]:
+        """Snapshot the formulation for a background Excel export (columns are collected off-thread)."""
         self._ensure_normalized_items()
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Ingredientes"
-        totals_sheet = wb.create_sheet("Totales")
-
-        base_headers = [
-            "FDC ID",
-            "Ingrediente",
-            "Marca / Origen",
-            "Tipo de dato",
-            "Cantidad (g)",
-            "Cantidad (%)",
-        ]
-
-        nutrient_headers, header_categories, header_key_map = self._collect_nutrient_columns()
-        header_by_key = {v: k for k, v in header_key_map.items()}
-
-        header_fill = PatternFill("solid", fgColor="D9D9D9")
-        total_fill = PatternFill("solid", fgColor="FFF2CC")
-        category_fills = {
-            "Proximates": PatternFill("solid", fgColor="DAEEF3"),
-            "Carbohydrates": PatternFill("solid", fgColor="E6B8B7"),
-            "Minerals": PatternFill("solid", fgColor="C4D79B"),
-            "Vitamins and Other Components": PatternFill("solid", fgColor="FFF2CC"),
-            "Lipids": PatternFill("solid", fgColor="D9E1F2"),
-            "Amino acids": PatternFill("solid", fgColor="E4DFEC"),
-        }
-        center = Alignment(horizontal="center", vertical="center")
-
-        # Row 1: group titles (base + nutrient categories)
-        ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(base_headers))
-        ws.cell(row=1, column=1, value="Detalles de formulación").alignment = center
-
-        if nutrient_headers:
-            start_col = len(base_headers) + 1
-            col = start_col
-            while col < start_col + len(nutrient_headers):
-                idx = col - start_col
-                category = header_categories.get(nutrient_headers[idx], "Nutrientes")
-                run_start = col
-                while (
-                    col < start_col + len(nutrient_headers)
-                    and header_categories.get(nutrient_headers[col - start_col], "Nutrientes")
-                    == category
-                ):
-                    col += 1
-                run_end = col - 1
-                ws.merge_cells(start_row=1, start_column=run_start, end_row=1, end_column=run_end)
-                cat_cell = ws.cell(row=1, column=run_start, value=category)
-                cat_cell.alignment = center
-                cat_cell.fill = category_fills.get(category, header_fill)
-
-        # Row 2: headers
-        headers = base_headers + nutrient_headers
-        for col_idx, name in enumerate(headers, start=1):
-            cell = ws.cell(row=2, column=col_idx, value=name)
-            cell.fill = category_fills.get(
-                header_categories.get(name, ""), header_fill
-            ) if col_idx > len(base_headers) else header_fill
-            cell.alignment = center
-
-        start_row = 3
-        grams_col = base_headers.index("Cantidad (g)") + 1
-        percent_col = base_headers.index("Cantidad (%)") + 1
-        data_rows = len(self.formulation_items)
-        end_row = start_row + data_rows - 1
-
-        # Write ingredient rows
-        for idx, item in enumerate(self.formulation_items):
-            row = start_row + idx
-            values = [
-                item.get("fdc_id", ""),
-                item.get("description", ""),
-                item.get("brand", ""),
-                item.get("data_type", ""),
-                float(item.get("amount_g", 0.0) or 0.0),
-                None,  # placeholder for percent formula
-            ]
-            for col_idx, val in enumerate(values, start=1):
-                ws.cell(row=row, column=col_idx, value=val)
-
-            gram_cell = f"{get_column_letter(grams_col)}{row}"
-            total_range = f"${get_column_letter(grams_col)}${start_row}:${get_column_letter(grams_col)}${end_row}"
-            ws.cell(
-                row=row,
-                column=percent_col,
-                value=f"={gram_cell}/SUM({total_range})",
-            ).number_format = "0.00%"
-
-            nut_map = self._nutrients_by_header(item.get("nutrients", []), header_by_key)
-            for offset, header in enumerate(nutrient_headers, start=len(base_headers) + 1):
-                if header in nut_map:
-                    ws.cell(row=row, column=offset, value=nut_map[header])
-
-        total_row = end_row + 1
-        ws.cell(row=total_row, column=1, value="Total")
-        ws.cell(row=total_row, column=2, value="Formulado")
-        ws.cell(row=total_row, column=3, value="Formulado")
-        ws.cell(row=total_row, column=4, value="Formulado")
-
-        gram_total_cell = ws.cell(
-            row=total_row,
-            column=grams_col,
-            value=f"=SUBTOTAL(9,{get_column_letter(grams_col)}{start_row}:{get_column_letter(grams_col)}{end_row})",
-        )
-        gram_total_cell.fill = total_fill
-        percent_total_cell = ws.cell(row=total_row, column=percent_col, value="100%")
-        percent_total_cell.number_format = "0.00%"
-        percent_total_cell.fill = total_fill
-
-        for offset, header in enumerate(nutrient_headers, start=len(base_headers) + 1):
-            col_letter = get_column_letter(offset)
-            formula = (
-                f"=SUMPRODUCT(${get_column_letter(percent_col)}${start_row}:${get_column_letter(percent_col)}${end_row},"
-                f"${col_letter}${start_row}:${col_letter}${end_row})"
+        items = [dict(item) for item in self.formulation_items]
+        export_flags = dict(self.totals_model.export_flags)
+        data_type_priority = dict(self.data_type_priority)
+        registry = self._registry
+
+        def write(target: Path, report: Callable[[str], None]) -> None:
+            headers, categories, key_map = collect_nutrient_columns(
+                items, export_flags, data_type_priority, registry
             )
-            cell = ws.cell(row=total_row, column=offset, value=formula)
-            cell.fill = total_fill
-
-        # Styles for data rows
-        for row in range(start_row, total_row + 1):
-            ws.cell(row=row, column=grams_col).number_format = "0.0"
-
-        # Freeze panes to keep headers/base columns visible
-        freeze_col = len(base_headers) + 1 if nutrient_headers else 1
-        ws.freeze_panes = f"{get_column_letter(freeze_col)}3"
-
-        # Adjust widths
-        widths = {
-            "A": 12,
-            "B": 35,
-            "C": 18,
-            "D": 14,
-            "E": 12,
-            "F": 12,
-        }
-        for col_letter, width in widths.items():
-            ws.column_dimensions[col_letter].width = width
+            write_formulation_workbook(
+                target,
+                items,
+                headers,
+                categories,
+                key_map,
+                registry,
+                progress=lambda done, total: report(f"{done}/{total}"),
+            )
+
+        return write
 
-        # Totales sheet: simple reference to totals row
-        totals_headers = ["Nutriente", "Total", "Unidad"]
-        for col_idx, name in enumerate(totals_headers, start=1):
-            cell = totals_sheet.cell(row=1, column=col_idx, value=name)
-            cell.fill = header_fill
-            cell.alignment = center
+    def _start_export_job(
+        self, path: str, write: Callable[[Path, Callable[[str], None]], None], description: str
+    ) -> None:
+        """Run an export on a worker thread; editing continues while it writes."""
+        logging.debug(f"_start_export_job path={path} description={description}")
+        thread = QThread(self)
+        worker = ExportWorker(path, write, description)
+        worker.moveToThread(thread)
+        self._workers.append(worker)
+        self._threads.append(thread)
+        self._export_threads.append(thread)
+
+        thread.started.connect(worker.run)
+        worker.progress.connect(self._on_export_progress)
+        worker.finished.connect(self._on_export_finished)
+        worker.error.connect(self._on_export_error)
+        worker.finished.connect(thread.quit)
+        worker.error.connect(thread.quit)
+        worker.finished.connect(worker.deleteLater)
+        worker.error.connect(worker.deleteLater)
+        thread.finished.connect(thread.deleteLater)
 
-        for idx, header in enumerate(nutrient_headers, start=1):
-            name_part, unit = self._split_header_unit(header)
-            totals_sheet.cell(row=idx + 1, column=1, value=name_part)
-            totals_sheet.cell(row=idx + 1, column=3, value=unit or "")
-            source_cell = f"Ingredientes!{get_column_letter(len(base_headers) + idx)}{total_row}"
-            totals_sheet.cell(row=idx + 1, column=2, value=f"={source_cell}")
+        def _cleanup() -> None:
+            if thread in self._threads:
+                self._threads.remove(thread)
+            if thread in self._export_threads:
+                self._export_threads.remove(thread)
+            if worker in self._workers:
+                self._workers.remove(worker)
 
-        wb.save(filepath)
+        thread.finished.connect(_cleanup)
+        thread.start()
+
+    def _on_export_progress(self, message: str) -> None:
+        self._set_window_progress(message)
+        self.status_label.setText(f"{message}...")
+
+    def _on_export_finished(self, path: str) -> None:
+        self._set_window_progress(None)
+        self.status_label.setText(f"Archivo guardado en {path}")
+
+    def _on_export_error(self, path: str, message: str) -> None:
+        self._set_window_progress(None)
+        self.status_label.setText(f"Error al exportar {path}")
+        QMessageBox.critical(
+            self,
+            "Error al exportar",
+            f"No se pudo exportar el archivo:\n{message}",
+        )
 
     def _calculate_totals(self) -> Dict[str, Dict[str, Any]]:
         """
@@ -3749,481 +2324,19 @@ class MainWindow(QMainWindow):
         """
         logging.debug(f"_calculate_totals start items={len(self.formulation_items)}")
         self._ensure_normalized_items()
-        totals: Dict[str, Dict[str, Any]] = {}
-        total_weight = self._total_weight()
-        for item in self.formulation_items:
-            qty = item.get("amount_g", 0) or 0
-            for nutrient in self._sort_nutrients_for_display(item.get("nutrients", [])):
-                amount = nutrient.get("amount")
-                if amount is None:
-                    continue
-                nut = nutrient.get("nutrient") or {}
-                header_key, canonical_name, canonical_unit = self._header_key(nut)
-                if not header_key:
-                    continue
-                entry = totals.setdefault(
-                    header_key,
-                    {
-                        "name": canonical_name or nut.get("name", ""),
-                        "unit": canonical_unit or "",
-                        "amount": 0.0,
-                        "order": self._nutrient_order(nut, len(totals)),
-                    },
-                )
-                if canonical_name and not entry["name"]:
-                    entry["name"] = canonical_name
-                if canonical_unit and not entry["unit"]:
-                    entry["unit"] = canonical_unit
-                inferred_unit = self._infer_unit(nut)
-                if inferred_unit and not entry["unit"]:
-                    entry["unit"] = inferred_unit
-                entry["order"] = min(
-                    entry.get("order", float("inf")),
-                    self._nutrient_order(nut, len(totals)),
-                )
-                entry["amount"] += amount * qty / 100.0
-
-        if total_weight > 0:
-            factor = 100.0 / total_weight
-            for entry in totals.values():
-                entry["amount"] *= factor
+        self.formulation_engine.sync(self.formulation_items)
+        totals = self.formulation_engine.totals()
+        total_weight = self.formulation_engine.total_weight()
         logging.debug(f"_calculate_totals done nutrients={len(totals)} total_weight={total_weight}")
         return totals
 
-    def _nutrient_key(self, nutrient: Dict[str, Any]) -> str:
-        """
-        Build a consistent key for nutrients, preferring id then number then name.
-        This avoids duplicates when some records lack unitName (Foundation vs SR).
-        """
-        name_lower = (nutrient.get("name") or "").strip().lower()
-        unit_lower = (nutrient.get("unitName") or "").strip().lower()
-        # Special-case Energy to keep kcal/kJ separated when ids/numbers are missing.
-        if name_lower == "energy" and unit_lower:
-            return f"energy:{unit_lower}"
-        # Special-case Water to merge branded-calculated (no id) with USDA water (id present).
-        if name_lower == "water":
-            return f"water|{unit_lower}"
-        if "id" in nutrient and nutrient["id"] is not None:
-            return f"id:{nutrient['id']}"
-        if nutrient.get("number"):
-            return f"num:{nutrient['number']}"
-        name = name_lower
-        return f"name:{name}" if name else ""
-
-    def _reference_info(self, nutrient: Dict[str, Any]) -> Dict[str, Any]:
-        """Return cached rank/category info for a nutrient key if available."""
-        key = self._nutrient_key(nutrient)
-        return self._reference_order_map.get(key, {})
-
-    def _build_nutrient_catalog(self) -> list[tuple[str, list[str]]]:
-        """Static catalog to enforce ordering/categories when using abridged."""
-        return [
-            (
-                "Proximates",
-                [
-                    "Water",
-                    "Energy",
-                    "Nitrogen",
-                    "Protein",
-                    "Total fat (NLEA)",
-                    "Total lipid (fat)",
-                    "Ash",
-                    "Carbohydrate, by difference",
-                ],
-            ),
-            (
-                "Carbohydrates",
-                [
-                    "Fiber, total dietary",
-                    "Fiber, soluble",
-                    "Fiber, insoluble",
-                    "Total dietary fiber (AOAC 2011.25)",
-                    "High Molecular Weight Dietary Fiber (HMWDF)",
-                    "Low Molecular Weight Dietary Fiber (LMWDF)",
-                    "Sugars, Total",
-                    "Sucrose",
-                    "Glucose",
-                    "Fructose",
-                    "Lactose",
-                    "Maltose",
-                    "Galactose",
-                    "Starch",
-                    "Resistant starch",
-                    "Sugars, added",
-                ],
-            ),
-            (
-                "Minerals",
-                [
-                    "Calcium, Ca",
-                    "Iron, Fe",
-                    "Magnesium, Mg",
-                    "Phosphorus, P",
-                    "Potassium, K",
-                    "Sodium, Na",
-                    "Zinc, Zn",
-                    "Copper, Cu",
-                    "Manganese, Mn",
-                    "Iodine, I",
-                    "Selenium, Se",
-                    "Molybdenum, Mo",
-                    "Fluoride, F",
-                ],
-            ),
-            (
-                "Vitamins and Other Components",
-                [
-                    "Thiamin",
-                    "Riboflavin",
-                    "Niacin",
-                    "Vitamin B-6",
-                    "Folate, total",
-                    "Folic acid",
-                    "Folate, DFE",
-                    "Choline, total",
-                    "Choline, free",
-                    "Choline, from phosphocholine",
-                    "Choline, from phosphatidyl choline",
-                    "Choline, from glycerophosphocholine",
-                    "Choline, from sphingomyelin",
-                    "Betaine",
-                    "Vitamin B-12",
-                    "Vitamin B-12, added",
-                    "Vitamin A, RAE",
-                    "Retinol",
-                    "Carotene, beta",
-                    "cis-beta-Carotene",
-                    "trans-beta-Carotene",
-                    "Carotene, alpha",
-                    "Carotene, gamma",
-                    "Cryptoxanthin, beta",
-                    "Cryptoxanthin, alpha",
-                    "Vitamin A, IU",
-                    "Lycopene",
-                    "cis-Lycopene",
-                    "trans-Lycopene",
-                    "Lutein + zeaxanthin",
-                    "cis-Lutein/Zeaxanthin",
-                    "Lutein",
-                    "Zeaxanthin",
-                    "Phytoene",
-                    "Phytofluene",
-                    "Vitamin D (D2 + D3), International Units",
-                    "Vitamin D (D2 + D3)",
-                    "Vitamin D2 (ergocalciferol)",
-                    "Vitamin D3 (cholecalciferol)",
-                    "25-hydroxycholecalciferol",
-                    "Vitamin K (phylloquinone)",
-                    "Vitamin K (Dihydrophylloquinone)",
-                    "Vitamin K (Menaquinone-4)",
-                    "Vitamin E (alpha-tocopherol)",
-                    "Vitamin E, added",
-                    "Tocopherol, beta",
-                    "Tocopherol, gamma",
-                    "Tocopherol, delta",
-                    "Tocotrienol, alpha",
-                    "Tocotrienol, beta",
-                    "Tocotrienol, gamma",
-                    "Tocotrienol, delta",
-                    "Vitamin C, total ascorbic acid",
-                    "Pantothenic acid",
-                    "Biotin",
-                    "Caffeine",
-                    "Theobromine",
-                ],
-            ),
-            (
-                "Lipids",
-                [
-                    "Fatty acids, total saturated",
-                    "SFA 4:0",
-                    "SFA 5:0",
-                    "SFA 6:0",
-                    "SFA 7:0",
-                    "SFA 8:0",
-                    "SFA 9:0",
-                    "SFA 10:0",
-                    "SFA 11:0",
-                    "SFA 12:0",
-                    "SFA 13:0",
-                    "SFA 14:0",
-                    "SFA 15:0",
-                    "SFA 16:0",
-                    "SFA 17:0",
-                    "SFA 18:0",
-                    "SFA 20:0",
-                    "SFA 21:0",
-                    "SFA 22:0",
-                    "SFA 23:0",
-                    "SFA 24:0",
-                    "Fatty acids, total monounsaturated",
-                    "MUFA 12:1",
-                    "MUFA 14:1",
-                    "MUFA 14:1 c",
-                    "MUFA 15:1",
-                    "MUFA 16:1",
-                    "MUFA 16:1 c",
-                    "MUFA 17:1",
-                    "MUFA 17:1 c",
-                    "MUFA 18:1",
-                    "MUFA 18:1 c",
-                    "MUFA 20:1",
-                    "MUFA 20:1 c",
-                    "MUFA 22:1",
-                    "MUFA 22:1 c",
-                    "MUFA 22:1 n-9",
-                    "MUFA 22:1 n-11",
-                    "MUFA 24:1 c",
-                    "Fatty acids, total polyunsaturated",
-                    "PUFA 18:2",
-                    "PUFA 18:2 c",
-                    "PUFA 18:2 n-6 c,c",
-                    "PUFA 18:2 CLAs",
-                    "PUFA 18:2 i",
-                    "PUFA 18:3",
-                    "PUFA 18:3 c",
-                    "PUFA 18:3 n-3 c,c,c (ALA)",
-                    "PUFA 18:3 n-6 c,c,c",
-                    "PUFA 18:4",
-                    "PUFA 20:2 c",
-                    "PUFA 20:2 n-6 c,c",
-                    "PUFA 20:3",
-                    "PUFA 20:3 c",
-                    "PUFA 20:3 n-3",
-                    "PUFA 20:3 n-6",
-                    "PUFA 20:3 n-9",
-                    "PUFA 20:4",
-                    "PUFA 20:4c",
-                    "PUFA 20:5c",
-                    "PUFA 20:5 n-3 (EPA)",
-                    "PUFA 22:2",
-                    "PUFA 22:3",
-                    "PUFA 22:4",
-                    "PUFA 22:5 c",
-                    "PUFA 22:5 n-3 (DPA)",
-                    "PUFA 22:6 c",
-                    "PUFA 22:6 n-3 (DHA)",
-                    "Fatty acids, total trans",
-                    "Fatty acids, total trans-monoenoic",
-                    "Fatty acids, total trans-dienoic",
-                    "Fatty acids, total trans-polyenoic",
-                    "TFA 14:1 t",
-                    "TFA 16:1 t",
-                    "TFA 18:1 t",
-                    "TFA 18:2 t",
-                    "TFA 18:2 t,t",
-                    "TFA 18:2 t not further defined",
-                    "TFA 18:3 t",
-                    "TFA 20:1 t",
-                    "TFA 22:1 t",
-                    "Cholesterol",
-                ],
-            ),
-            (
-                "Amino acids",
-                [
-                    "Tryptophan",
-                    "Threonine",
-                    "Isoleucine",
-                    "Leucine",
-                    "Lysine",
-                    "Methionine",
-                    "Phenylalanine",
-                    "Tyrosine",
-                    "Valine",
-                    "Arginine",
-                    "Histidine",
-                    "Alanine",
-                    "Aspartic acid",
-                    "Glutamic acid",
-                    "Glycine",
-                    "Proline",
-                    "Serine",
-                    "Hydroxyproline",
-                    "Cysteine",
-                ],
-            ),
-            (
-                "Phytosterols",
-                [
-                    "Phytosterols",
-                    "Beta-sitosterol",
-                    "Brassicasterol",
-                    "Campesterol",
-                    "Campestanol",
-                    "Delta-5-avenasterol",
-                    "Phytosterols, other",
-                    "Stigmasterol",
-                    "Beta-sitostanol",
-                ],
-            ),
-            ("Organic acids", ["Citric acid", "Malic acid", "Oxalic acid", "Quinic acid"]),
-            ("Oligosaccharides", ["Verbascose", "Raffinose", "Stachyose"]),
-            ("Isoflavones", ["Daidzin", "Genistin", "Glycitin", "Daidzein", "Genistein"]),
-        ]
-
     def _update_reference_from_details(self, details: Dict[str, Any]) -> None:
         """Update reference rank/category map from a full USDA response."""
-        nutrients = details.get("foodNutrients", []) or []
-        if not nutrients:
-            return
-        current_category: str | None = None
-        for entry in nutrients:
-            nut = entry.get("nutrient") or {}
-            key = self._nutrient_key(nut)
-            if not key:
-                continue
-            if entry.get("amount") is None:
-                # category row
-                current_category = (nut.get("name") or "").strip() or current_category
-                self._reference_order_map.setdefault(
-                    key,
-                    {
-                        "rank": nut.get("rank"),
-                        "category": current_category,
-                        "unit": nut.get("unitName"),
-                    },
-                )
-                continue
-            self._reference_order_map[key] = {
-                "rank": nut.get("rank"),
-                "category": current_category,
-                "unit": nut.get("unitName"),
-            }
+        self._registry.update_reference(details)
 
     def _sort_nutrients_for_display(self, nutrients: list[Dict[str, Any]]) -> list[Dict[str, Any]]:
         """Return nutrients ordered by USDA rank or reference map."""
-        if not nutrients:
-            return []
-        indexed = []
-        for idx, entry in enumerate(nutrients):
-            nut = entry.get("nutrient") or {}
-            order = self._nutrient_order(nut, idx + 10000)
-            indexed.append((order, idx, entry))
-        indexed.sort(key=lambda t: (t[0], t[1]))
-        return [item[2] for item in indexed]
-
-    def _header_key(self, nutrient: Dict[str, Any]) -> tuple[str, str, str]:
-        """Return a stable header key plus canonical name and unit for a nutrient."""
-        name = canonical_alias_name(nutrient.get("name", "") or "")
-        unit = canonical_unit(nutrient.get("unitName") or self._infer_unit(nutrient) or "")
-        unit_part = unit.strip().lower()
-        name_part = name.strip().lower()
-        if name_part:
-            header_key = f"{name_part}|{unit_part}"
-        else:
-            base_key = self._nutrient_key(nutrient)
-            if not base_key:
-                return "", name, unit
-            header_key = f"{base_key}|{unit_part}"
-        return header_key, name, unit
-
-    def _infer_unit(self, nutrient: Dict[str, Any]) -> str:
-        """Try to fill missing unit from nutrient metadata or heuristic defaults."""
-        unit = nutrient.get("unitName")
-        if unit:
-            return unit
-
-        number = str(nutrient.get("number") or "").strip()
-        name = (nutrient.get("name") or "").lower()
-
-        default_units_by_number = {
-            # Proximates / macros
-            "255": "g",  # Water
-            "203": "g",  # Protein
-            "204": "g",  # Total lipid (fat)
-            "298": "g",  # Total fat (NLEA)
-            "202": "g",  # Nitrogen
-            "207": "g",  # Ash
-            "205": "g",  # Carbohydrate, by difference
-            "291": "g",  # Fiber, total dietary
-            "269": "g",  # Sugars, total
-            "268": "kJ",  # Energy (kJ)
-            "208": "kcal",  # Energy (kcal)
-            "951": "g",  # Proximates
-            "956": "g",  # Carbohydrates
-        }
-        if number in default_units_by_number:
-            return default_units_by_number[number]
-
-        if "energy" in name and "kcal" in name:
-            return "kcal"
-        if "energy" in name and "kj" in name:
-            return "kJ"
-
-        macro_hints = [
-            "water",
-            "protein",
-            "lipid",
-            "fat",
-            "ash",
-            "carbohydrate",
-            "fiber",
-            "sugar",
-            "starch",
-            "nitrogen",
-            "fatty acids",
-            "sfa",
-            "mufa",
-            "pufa",
-        ]
-        if any(hint in name for hint in macro_hints) or ":" in name:
-            return "g"
-
-        amino_acids = [
-            "alanine",
-            "arginine",
-            "aspartic acid",
-            "cystine",
-            "cysteine",
-            "hydroxyproline",
-            "glutamic acid",
-            "glycine",
-            "histidine",
-            "isoleucine",
-            "leucine",
-            "lysine",
-            "methionine",
-            "phenylalanine",
-            "proline",
-            "serine",
-            "threonine",
-            "tryptophan",
-            "tyrosine",
-            "valine",
-        ]
-        if name in amino_acids:
-            return "g"
-
-        simple_sugars = [
-            "sucrose",
-            "glucose",
-            "fructose",
-            "lactose",
-            "maltose",
-            "galactose",
-        ]
-        if name in simple_sugars:
-            return "g"
-
-        if name == "alcohol, ethyl":
-            return "g"
-
-        return ""
-
-    def _nutrient_order(self, nutrient: Dict[str, Any], fallback: int) -> float:
-        """Return USDA rank if available; otherwise keep insertion order fallback."""
-        rank = nutrient.get("rank")
-        if rank is None:
-            ref = self._reference_info(nutrient)
-            rank = ref.get("rank")
-        if rank is None:
-            name_lower = (nutrient.get("name") or "").strip().lower()
-            rank = self._nutrient_order_map.get(name_lower)
-        try:
-            return float(rank)
-        except (TypeError, ValueError):
-            return float(fallback)
+        return sort_nutrients_for_display(nutrients)
 
     def _add_row_to_formulation(self, row: int | None = None) -> None:
         logging.debug(f"_add_row_to_formulation row={row}")
@@ -4234,10 +2347,7 @@ class MainWindow(QMainWindow):
                 return
             row = indexes[0].row()
 
-        fdc_item = self.table.item(row, 0)
-        if not fdc_item:
-            return
-        fdc_id_text = fdc_item.text().strip()
+        fdc_id_text = self._search_fdc_id_at(row)
         if not fdc_id_text or not fdc_id_text.isdigit():
             self.status_label.setText("FDC ID inválido.")
             return
@@ -4374,13 +2484,18 @@ class MainWindow(QMainWindow):
         if mode is None:
             return
 
+        before = self._capture_state()
         if mode == "g":
             item["amount_g"] = value
+            self.formulation_engine.set_amount(row, value)
+            self._journal("amount", index=row, amount_g=value)
         else:
             if not self._apply_percent_edit(row, value):
                 return
+            self._journal_amounts()
+        self._record_undo(before)
 
-        self._refresh_formulation_views()
+        self._refresh_quantity_views()
         if mode == "g":
             msg_value = self._format_amount_for_status(item.get("amount_g", 0.0))
         else:
@@ -4391,106 +2506,103 @@ class MainWindow(QMainWindow):
 
     def _apply_percent_edit(self, target_idx: int, target_percent: float) -> bool:
         """Redistribute quantities so locked percentages stay fixed."""
-        if target_percent < 0 or target_percent > 100:
-            QMessageBox.warning(self, "Porcentaje inválido", "Ingresa un valor entre 0 y 100.")
-            return False
+        return self._apply_percent_targets({target_idx: target_percent})
 
-        if target_idx < 0 or target_idx >= len(self.formulation_items):
+    def _apply_percent_targets(self, targets: Dict[int, float]) -> bool:
+        """
+        Set several percentages in one solve: locked items keep theirs and the free
+        ones absorb the difference proportionally. Amounts are only written on success.
+        """
+        if any(idx < 0 or idx >= len(self.formulation_items) for idx in targets):
             self.status_label.setText("Fila seleccionada inválida.")
             return False
 
         total_weight = self._total_weight()
         base_total = total_weight if total_weight > 0 else 100.0
-        if base_total <= 0:
-            QMessageBox.warning(
-                self,
-                "Porcentaje inválido",
-                "No hay cantidad total para calcular porcentajes.",
-            )
-            return False
-
-        current_percents = [
+        current = [
             (item.get("amount_g", 0.0) or 0.0) * 100.0 / base_total
             for item in self.formulation_items
         ]
-
-        locked_sum = sum(
-            current_percents[idx]
-            for idx, item in enumerate(self.formulation_items)
-            if item.get("locked") and idx != target_idx
-        )
-        if locked_sum > 100.0:
-            QMessageBox.warning(
-                self,
-                "Porcentaje inválido",
-                "Los ingredientes fijados ya superan el 100%. Libera uno para continuar.",
-            )
-            return False
-
-        remaining = 100.0 - locked_sum - target_percent
-        free_indices = [
-            idx
-            for idx, item in enumerate(self.formulation_items)
-            if not item.get("locked") and idx != target_idx
-        ]
-
-        if remaining < -0.0001:
-            QMessageBox.warning(
-                self,
-                "Sin grado de libertad",
-                "No hay porcentaje libre suficiente. Libera un ingrediente o reduce el valor.",
-            )
-            return False
-
-        if not free_indices and abs(remaining) > 0.0001:
-            QMessageBox.warning(
-                self,
-                "Sin grado de libertad",
-                "Debe quedar al menos un ingrediente sin fijar para ajustar porcentajes.",
+        try:
+            percents = redistribute_percents(
+                current,
+                targets,
+                locked=[bool(item.get("locked")) for item in self.formulation_items],
+                labels=[
+                    item.get("description") or str(item.get("fdc_id", ""))
+                    for item in self.formulation_items
+                ],
             )
+        except InfeasiblePercents as exc:
+            QMessageBox.warning(self, exc.title, str(exc))
             return False
 
-        cur_free_sum = sum(current_percents[idx] for idx in free_indices)
-        new_percents = [0.0 for _ in self.formulation_items]
+        for item, pct in zip(self.formulation_items, percents.tolist()):
+            item["amount_g"] = max(pct, 0.0) * base_total / 100.0
+        return True
 
-        for idx, item in enumerate(self.formulation_items):
-            if item.get("locked") and idx != target_idx:
-                new_percents[idx] = current_percents[idx]
-            elif idx == target_idx:
-                new_percents[idx] = target_percent
+    def _edit_quantities_for_rows(self, rows: List[int]) -> None:
+        """Edit several quantities in one dialog; applied as a single edit (one solve in % mode)."""
+        percent_mode = self.quantity_mode != "g"
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Porcentajes" if percent_mode else "Cantidades")
+        layout = QVBoxLayout(dialog)
+        grid = QGridLayout()
+        spins: Dict[int, QDoubleSpinBox] = {}
+        for position, row in enumerate(rows):
+            item = self.formulation_items[row]
+            spin = QDoubleSpinBox(dialog)
+            amount = item.get("amount_g", 0.0) or 0.0
+            if percent_mode:
+                spin.setRange(0.0, 100.0)
+                spin.setDecimals(2)
+                spin.setSuffix(" %")
+                spin.setValue(self._amount_to_percent(amount))
             else:
-                if cur_free_sum > 0:
-                    new_percents[idx] = (
-                        current_percents[idx] * remaining / cur_free_sum
-                    )
-                elif free_indices:
-                    new_percents[idx] = remaining if idx == free_indices[0] else 0.0
-
-        if any(pct < -0.001 for pct in new_percents):
-            QMessageBox.warning(
-                self,
-                "Sin grado de libertad",
-                "No hay porcentaje libre suficiente. Ajusta los valores o libera un ingrediente.",
-            )
-            return False
-
-        for idx, pct in enumerate(new_percents):
-            safe_pct = max(pct, 0.0)
-            self.formulation_items[idx]["amount_g"] = safe_pct * base_total / 100.0
-        return True
+                spin.setRange(0.0, 1_000_000.0)
+                spin.setDecimals(1)
+                spin.setSuffix(" g")
+                spin.setValue(amount)
+            grid.addWidget(QLabel(f"{item.get('fdc_id', '')} - {item.get('description', '')}"), position, 0)
+            grid.addWidget(spin, position, 1)
+            spins[row] = spin
+        layout.addLayout(grid)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, parent=dialog)
+        buttons.accepted.connect(dialog.accept)
+        buttons.rejected.connect(dialog.reject)
+        layout.addWidget(buttons)
+        if dialog.exec() != QDialog.Accepted:
+            return
 
-    def _remove_selected_from_formulation(self, table: QTableWidget) -> None:
+        values = {row: spin.value() for row, spin in spins.items()}
+        before = self._capture_state()
+        if percent_mode:
+            if not self._apply_percent_targets(values):
+                return
+        else:
+            for row, value in values.items():
+                self.formulation_items[row]["amount_g"] = value
+        self._record_undo(before)
+        self._journal_amounts()
+        self._refresh_quantity_views()
+        self.status_label.setText(f"Actualizadas {len(values)} cantidades.")
+
+    def _remove_selected_from_formulation(self, table: QTableView) -> None:
         indexes = table.selectionModel().selectedRows()
         if not indexes:
             self.status_label.setText("Selecciona un ingrediente para eliminar.")
             return
         row = indexes[0].row()
         if 0 <= row < len(self.formulation_items):
+            before = self._capture_state()
             removed = self.formulation_items.pop(row)
+            self._record_undo(before)
+            self._journal("remove", index=row)
             if self.formulation_items and self._locked_count() == len(
                 self.formulation_items
             ):
                 self.formulation_items[0]["locked"] = False
+                self._journal("lock", index=0, locked=False)
             self._refresh_formulation_views()
             self.status_label.setText(
                 f"Eliminado {removed.get('fdc_id', '')} - {removed.get('description', '')}"
@@ -4527,26 +2639,22 @@ class MainWindow(QMainWindow):
 
     # ---- Callbacks for async ops ----
     def _on_search_success(self, foods) -> None:
-        foods_sorted = self._sort_search_results(foods)
-        filtered = self._filter_results_by_query(foods_sorted, self.last_query)
-        self.search_results = filtered
-        self._last_results_count = len(filtered)
-        self.search_page = 1
-        self._show_current_search_page()
-        total_pages = max(1, (len(filtered) + self.search_page_size - 1) // self.search_page_size)
+        # Default order is data type priority + description; header sorting is opt-in.
+        self.table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.search_proxy.set_query(self.last_query)
+        self.search_model.set_results(self._sort_search_results(foods))
+        self._prefetch_visible_results()
         self.status_label.setText(
-            f"Se encontraron {len(filtered)} resultados (pagina {self.search_page}/{total_pages})."
+            f"Se encontraron {self.search_proxy.matching_count()} resultados."
         )
         self.search_button.setEnabled(True)
-        self._update_paging_buttons(len(filtered))
 
     def _on_search_error(self, message: str) -> None:
         self.status_label.setText(f"Error: {message}")
         self.search_button.setEnabled(True)
-        self._update_paging_buttons(self._last_results_count)
 
     def _on_details_success(self, details) -> None:
-        nutrients = normalize_nutrients(
+        nutrients = self._normalize_with_ids(
             details.get("foodNutrients", []) or [], details.get("dataType")
         )
         self._populate_details_table(nutrients)
@@ -4567,7 +2675,9 @@ class MainWindow(QMainWindow):
             f"_on_add_details_loaded fdc_id={details.get('fdcId', '?')} "
             f"mode={mode} value={value}"
         )
-        nutrients = normalize_nutrients(details.get("foodNutrients", []) or [], details.get("dataType"))
+        nutrients = self._normalize_with_ids(
+            details.get("foodNutrients", []) or [], details.get("dataType")
+        )
         self._update_reference_from_details(details)
         desc = details.get("description", "") or ""
         brand = details.get("brandOwner", "") or ""
@@ -4583,6 +2693,7 @@ class MainWindow(QMainWindow):
             "nutrients": nutrients,
             "locked": False,
         }
+        before = self._capture_state()
         self.formulation_items.append(new_item)
 
         if mode == "percent":
@@ -4591,6 +2702,10 @@ class MainWindow(QMainWindow):
                 self.formulation_items.pop()
                 self.add_button.setEnabled(True)
                 return
+        self._record_undo(before)
+        self._journal("add", item=portable_item(new_item))
+        if mode == "percent":
+            self._journal_amounts()
 
         self._populate_details_table(nutrients)
         self._refresh_formulation_views()
@@ -4614,22 +2729,9 @@ class MainWindow(QMainWindow):
     def _upgrade_item_to_full(self, index: int, fdc_id: int) -> None:
         """Upgrade no-op: abridged es la única fuente ahora."""
         return
-    def on_totals_checkbox_changed(self, item: QTableWidgetItem) -> None:
-        """Sync export checkbox state into memory and update toggle label."""
-        if item.column() != 3:
-            return
-        nut_key = item.data(Qt.UserRole)
-        if not nut_key:
-            return
-        self.nutrient_export_flags[nut_key] = item.checkState() == Qt.Checked
-        self._update_toggle_export_button()
-
     def on_toggle_export_clicked(self) -> None:
         """Toggle all nutrient export checkboxes on/off."""
-        if not self.nutrient_export_flags:
+        export_flags = self.totals_model.export_flags
+        if not export_flags:
             return
-        all_checked = all(self.nutrient_export_flags.values())
-        new_state = not all_checked
-        for key in list(self.nutrient_export_flags.keys()):
-            self.nutrient_export_flags[key] = new_state
-        self._populate_totals_table()
+        self.totals_model.set_all_exported(not all(export_flags.values()))
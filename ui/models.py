@@ -0,0 +1,597 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Tuple
+
+from PySide6.QtCore import (
+    QAbstractTableModel,
+    QModelIndex,
+    QPersistentModelIndex,
+    QSortFilterProxyModel,
+    Qt,
+    Signal,
+)
+from PySide6.QtGui import QColor, QIcon
+
+from services.nutrient_registry import NutrientRegistry
+
+
+class _RowDiffTableModel(QAbstractTableModel):
+    """Table model base with helpers to notify only the changed cells."""
+
+    def _emit_rows_changed(
+        self,
+        rows: List[int],
+        first_column: int,
+        last_column: int,
+        roles: List[int] | None = None,
+    ) -> None:
+        """Emit one dataChanged per contiguous run of rows."""
+        if not rows:
+            return
+        roles = [Qt.DisplayRole] if roles is None else roles
+        start = prev = rows[0]
+        for row in rows[1:] + [None]:
+            if row is not None and row == prev + 1:
+                prev = row
+                continue
+            self.dataChanged.emit(
+                self.index(start, first_column), self.index(prev, last_column), roles
+            )
+            if row is not None:
+                start = prev = row
+
+    def _emit_columns_changed(
+        self, first_column: int, last_column: int, roles: List[int] | None = None
+    ) -> None:
+        rows = self.rowCount()
+        if not rows:
+            return
+        self.dataChanged.emit(
+            self.index(0, first_column),
+            self.index(rows - 1, last_column),
+            [Qt.DisplayRole] if roles is None else roles,
+        )
+
+
+class FormulationTableModel(_RowDiffTableModel):
+    """
+    Table model over the formulation items (shared by the preview and the main table).
+
+    Grams, locks and the total weight are cached per row so ``refresh_quantities`` can
+    diff them and emit ``dataChanged`` only for the cells that moved; percentages and
+    enabled/disabled column state are derived in ``data()``.
+    """
+
+    FDC_ID_COLUMN = 0
+    DESCRIPTION_COLUMN = 1
+    AMOUNT_G_COLUMN = 2
+    PERCENT_COLUMN = 3
+    LOCK_COLUMN = 4
+    BRAND_COLUMN = 5
+    HEADERS = [
+        "FDC ID",
+        "Ingrediente",
+        "Cantidad (g)",
+        "Cantidad (%)",
+        "Fijar %",
+        "Marca / Origen",
+    ]
+
+    # Emitted when the user clicks a lock checkbox; the window validates and applies it.
+    lock_toggle_requested = Signal(int, bool)
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self._items: List[Dict[str, Any]] = []
+        self._row_ids: List[int] = []
+        self._amounts: List[float] = []
+        self._locked: List[bool] = []
+        self._total_weight = 0.0
+        self._quantity_mode = "g"
+        self._disabled_brush = QColor("#f0f0f0")
+        self._enabled_brush = QColor("white")
+
+    # ---- Qt model API ----
+    def rowCount(self, parent: QModelIndex | QPersistentModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._items)
+
+    def columnCount(self, parent: QModelIndex | QPersistentModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.DisplayRole) -> Any:
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            if 0 <= section < len(self.HEADERS):
+                return self.HEADERS[section]
+            return None
+        return super().headerData(section, orientation, role)
+
+    def data(self, index: QModelIndex | QPersistentModelIndex, role: int = Qt.DisplayRole) -> Any:
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        if row >= len(self._items):
+            return None
+
+        if role == Qt.DisplayRole:
+            item = self._items[row]
+            if col == self.FDC_ID_COLUMN:
+                return str(item.get("fdc_id", ""))
+            if col == self.DESCRIPTION_COLUMN:
+                return item.get("description", "")
+            if col == self.AMOUNT_G_COLUMN:
+                return f"{self._amounts[row]:.1f}"
+            if col == self.PERCENT_COLUMN:
+                return f"{self.percent_for_row(row):.2f}"
+            if col == self.BRAND_COLUMN:
+                return item.get("brand", "")
+            return None
+        if role == Qt.CheckStateRole and col == self.LOCK_COLUMN:
+            return Qt.Checked if self._locked[row] else Qt.Unchecked
+        if role == Qt.BackgroundRole and col in self._quantity_columns():
+            return self._enabled_brush if self._column_enabled(col) else self._disabled_brush
+        return None
+
+    def flags(self, index: QModelIndex | QPersistentModelIndex) -> Qt.ItemFlags:
+        if not index.isValid():
+            return Qt.NoItemFlags
+        col = index.column()
+        flags = Qt.ItemIsSelectable
+        if col == self.LOCK_COLUMN:
+            flags |= Qt.ItemIsUserCheckable
+        if col not in self._quantity_columns() or self._column_enabled(col):
+            flags |= Qt.ItemIsEnabled
+        return flags
+
+    def setData(self, index: QModelIndex | QPersistentModelIndex, value: Any, role: int = Qt.EditRole) -> bool:
+        if not index.isValid() or index.column() != self.LOCK_COLUMN or role != Qt.CheckStateRole:
+            return False
+        desired = Qt.CheckState(value) == Qt.Checked
+        # The view only reports the request; the lock changes once the window applies it
+        # to the items and calls refresh_quantities().
+        self.lock_toggle_requested.emit(index.row(), desired)
+        return False
+
+    # ---- State sync ----
+    @property
+    def quantity_mode(self) -> str:
+        return self._quantity_mode
+
+    def total_weight(self) -> float:
+        return self._total_weight
+
+    def percent_for_row(self, row: int) -> float:
+        if self._total_weight <= 0:
+            return 0.0
+        return (self._amounts[row] / self._total_weight) * 100.0
+
+    def set_quantity_mode(self, mode: str) -> None:
+        """Switch which quantity columns are enabled (grams vs percent + lock)."""
+        if mode == self._quantity_mode:
+            return
+        self._quantity_mode = mode
+        # Flags change too, so notify every role.
+        self._emit_columns_changed(self.AMOUNT_G_COLUMN, self.LOCK_COLUMN, [])
+
+    def sync_items(self, items: List[Dict[str, Any]]) -> None:
+        """
+        Track ``items`` as the model rows.
+
+        Rows are matched by identity: a removed or appended ingredient becomes a single
+        remove/insert notification, and the quantities of the remaining rows are diffed.
+        """
+        new_ids = [id(item) for item in items]
+        if new_ids == self._row_ids:
+            self.refresh_quantities()
+            return
+
+        old_ids = self._row_ids
+        prefix = 0
+        limit = min(len(old_ids), len(new_ids))
+        while prefix < limit and old_ids[prefix] == new_ids[prefix]:
+            prefix += 1
+        suffix = 0
+        while (
+            suffix < limit - prefix
+            and old_ids[len(old_ids) - 1 - suffix] == new_ids[len(new_ids) - 1 - suffix]
+        ):
+            suffix += 1
+        removed = len(old_ids) - prefix - suffix
+        inserted = len(new_ids) - prefix - suffix
+
+        if removed and inserted:
+            # Rows replaced in place (e.g. an import): let the views start over.
+            self.beginResetModel()
+            self._set_rows(items)
+            self.endResetModel()
+            return
+
+        if removed:
+            self.beginRemoveRows(QModelIndex(), prefix, prefix + removed - 1)
+            del self._row_ids[prefix:prefix + removed]
+            del self._amounts[prefix:prefix + removed]
+            del self._locked[prefix:prefix + removed]
+            self._items = list(items)
+            self.endRemoveRows()
+        elif inserted:
+            self.beginInsertRows(QModelIndex(), prefix, prefix + inserted - 1)
+            added = items[prefix:prefix + inserted]
+            self._row_ids[prefix:prefix] = [id(item) for item in added]
+            self._amounts[prefix:prefix] = [self._amount_of(item) for item in added]
+            self._locked[prefix:prefix] = [bool(item.get("locked")) for item in added]
+            self._items = list(items)
+            self.endInsertRows()
+        self.refresh_quantities()
+
+    def refresh_quantities(self) -> None:
+        """Re-read grams/locks from the items and notify only the cells that changed."""
+        amount_rows: List[int] = []
+        lock_rows: List[int] = []
+        for row, item in enumerate(self._items):
+            amount = self._amount_of(item)
+            if amount != self._amounts[row]:
+                self._amounts[row] = amount
+                amount_rows.append(row)
+            locked = bool(item.get("locked"))
+            if locked != self._locked[row]:
+                self._locked[row] = locked
+                lock_rows.append(row)
+
+        total_weight = float(sum(self._amounts))
+        total_changed = total_weight != self._total_weight
+        self._total_weight = total_weight
+
+        if total_changed:
+            # Every percentage depends on the total weight.
+            self._emit_rows_changed(amount_rows, self.AMOUNT_G_COLUMN, self.AMOUNT_G_COLUMN)
+            self._emit_columns_changed(self.PERCENT_COLUMN, self.PERCENT_COLUMN)
+        else:
+            self._emit_rows_changed(amount_rows, self.AMOUNT_G_COLUMN, self.PERCENT_COLUMN)
+        self._emit_rows_changed(lock_rows, self.LOCK_COLUMN, self.LOCK_COLUMN, [Qt.CheckStateRole])
+
+    # ---- Helpers ----
+    def _set_rows(self, items: List[Dict[str, Any]]) -> None:
+        self._items = list(items)
+        self._row_ids = [id(item) for item in items]
+        self._amounts = [self._amount_of(item) for item in items]
+        self._locked = [bool(item.get("locked")) for item in items]
+        self._total_weight = float(sum(self._amounts))
+
+    @staticmethod
+    def _amount_of(item: Dict[str, Any]) -> float:
+        return float(item.get("amount_g", 0.0) or 0.0)
+
+    def _quantity_columns(self) -> tuple[int, int, int]:
+        return (self.AMOUNT_G_COLUMN, self.PERCENT_COLUMN, self.LOCK_COLUMN)
+
+    def _column_enabled(self, column: int) -> bool:
+        if column == self.AMOUNT_G_COLUMN:
+            return self._quantity_mode == "g"
+        return self._quantity_mode == "%"
+
+
+class TotalsTableModel(_RowDiffTableModel):
+    """
+    Table model over the formulation totals with per-nutrient export checkboxes.
+
+    The display order (category rank, catalog order, name) is computed once per set of
+    nutrient IDs and cached; while the set is unchanged ``set_totals`` only diffs the
+    amounts and repaints the cells that changed.
+    """
+
+    NAME_COLUMN = 0
+    AMOUNT_COLUMN = 1
+    UNIT_COLUMN = 2
+    EXPORT_COLUMN = 3
+    HEADERS = ["Nutriente", "Total", "Unidad", "Exportar"]
+    MAX_CACHED_ORDERS = 8
+
+    # Emitted whenever export checkboxes change (user click, toggle-all or new rows).
+    export_flags_changed = Signal()
+
+    def __init__(self, registry: NutrientRegistry, parent=None) -> None:
+        super().__init__(parent)
+        self._registry = registry
+        self._keys: List[str] = []
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._amounts: List[float] = []
+        self._signature: Tuple[int, FrozenSet[Any]] | None = None
+        self._order_cache: OrderedDict[Tuple[int, FrozenSet[Any]], List[str]] = OrderedDict()
+        self._export_flags: Dict[str, bool] = {}
+        self.export_header_icon: QIcon | None = None
+        self.export_header_tooltip = ""
+
+    # ---- Qt model API ----
+    def rowCount(self, parent: QModelIndex | QPersistentModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._keys)
+
+    def columnCount(self, parent: QModelIndex | QPersistentModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.DisplayRole) -> Any:
+        if orientation == Qt.Horizontal and 0 <= section < len(self.HEADERS):
+            if role == Qt.DisplayRole:
+                return self.HEADERS[section]
+            if section == self.EXPORT_COLUMN:
+                if role == Qt.DecorationRole:
+                    return self.export_header_icon
+                if role == Qt.ToolTipRole and self.export_header_tooltip:
+                    return self.export_header_tooltip
+            return None
+        return super().headerData(section, orientation, role)
+
+    def data(self, index: QModelIndex | QPersistentModelIndex, role: int = Qt.DisplayRole) -> Any:
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        if row >= len(self._keys):
+            return None
+        key = self._keys[row]
+
+        if role == Qt.DisplayRole:
+            entry = self._entries[key]
+            if col == self.NAME_COLUMN:
+                return entry.get("name", "")
+            if col == self.AMOUNT_COLUMN:
+                return f"{self._amounts[row]:.2f}"
+            if col == self.UNIT_COLUMN:
+                return entry.get("unit", "")
+            return None
+        if role == Qt.CheckStateRole and col == self.EXPORT_COLUMN:
+            return Qt.Checked if self._export_flags.get(key, True) else Qt.Unchecked
+        if role == Qt.UserRole and col in (self.NAME_COLUMN, self.EXPORT_COLUMN):
+            return key
+        return None
+
+    def flags(self, index: QModelIndex | QPersistentModelIndex) -> Qt.ItemFlags:
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsSelectable | Qt.ItemIsEnabled
+        if index.column() == self.EXPORT_COLUMN:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+    def setData(self, index: QModelIndex | QPersistentModelIndex, value: Any, role: int = Qt.EditRole) -> bool:
+        if not index.isValid() or index.column() != self.EXPORT_COLUMN or role != Qt.CheckStateRole:
+            return False
+        self._export_flags[self._keys[index.row()]] = Qt.CheckState(value) == Qt.Checked
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        self.export_flags_changed.emit()
+        return True
+
+    # ---- State sync ----
+    @property
+    def export_flags(self) -> Dict[str, bool]:
+        """Export checkbox state keyed by nutrient header key."""
+        return self._export_flags
+
+    def set_export_flags(self, flags: Dict[str, bool]) -> None:
+        """Replace export flags (e.g. from an imported formulation); missing rows default on."""
+        merged = {key: bool(value) for key, value in flags.items()}
+        for key in self._keys:
+            merged.setdefault(key, True)
+        self._export_flags = merged
+        self._emit_columns_changed(self.EXPORT_COLUMN, self.EXPORT_COLUMN, [Qt.CheckStateRole])
+        self.export_flags_changed.emit()
+
+    def set_all_exported(self, exported: bool) -> None:
+        for key in self._export_flags:
+            self._export_flags[key] = exported
+        self._emit_columns_changed(self.EXPORT_COLUMN, self.EXPORT_COLUMN, [Qt.CheckStateRole])
+        self.export_flags_changed.emit()
+
+    def set_totals(self, totals: Dict[str, Dict[str, Any]]) -> None:
+        """Show ``totals`` (header key -> entry); rows are only rebuilt if the nutrient set changed."""
+        signature = (
+            self._registry.version,
+            frozenset(entry.get("nid", key) for key, entry in totals.items()),
+        )
+        if signature == self._signature and len(totals) == len(self._keys):
+            self._entries = totals
+            changed: List[int] = []
+            for row, key in enumerate(self._keys):
+                amount = float(totals[key].get("amount", 0.0))
+                if amount != self._amounts[row]:
+                    self._amounts[row] = amount
+                    changed.append(row)
+            self._emit_rows_changed(changed, self.AMOUNT_COLUMN, self.AMOUNT_COLUMN)
+            return
+
+        self.beginResetModel()
+        self._signature = signature
+        self._entries = totals
+        self._keys = self._sorted_keys(signature, totals)
+        self._amounts = [float(totals[key].get("amount", 0.0)) for key in self._keys]
+        # Keep the user's choices for nutrients still present; new ones default on.
+        self._export_flags = {key: self._export_flags.get(key, True) for key in self._keys}
+        self.endResetModel()
+        self.export_flags_changed.emit()
+
+    # ---- Helpers ----
+    def _sorted_keys(
+        self, signature: Tuple[int, FrozenSet[Any]], totals: Dict[str, Dict[str, Any]]
+    ) -> List[str]:
+        cached = self._order_cache.get(signature)
+        if cached is not None and all(key in totals for key in cached):
+            self._order_cache.move_to_end(signature)
+            return list(cached)
+
+        registry = self._registry
+        rank_by_category: Dict[str, int] = {}
+
+        def _sort_key(key: str) -> tuple[int, float, str]:
+            entry = totals[key]
+            nid = entry.get("nid")
+            if nid is None:
+                nid = registry.id_for_key(key)
+            if nid is None:
+                return (len(registry.category_order) + 1, float("inf"), entry.get("name", "").lower())
+            # Cached per nutrient ID: the same category/order the engine columns use.
+            info = registry.info(nid)
+            rank = rank_by_category.get(info.category)
+            if rank is None:
+                rank = rank_by_category[info.category] = registry.category_rank(info.category)
+            order = info.order if info.order is not None else float("inf")
+            return (rank, order, info.name.lower())
+
+        keys = sorted(totals, key=_sort_key)
+        self._order_cache[signature] = keys
+        while len(self._order_cache) > self.MAX_CACHED_ORDERS:
+            self._order_cache.popitem(last=False)
+        return list(keys)
+
+
+class SearchResultsModel(QAbstractTableModel):
+    """
+    Search results kept as compact row tuples and exposed lazily.
+
+    Only ``FETCH_BATCH`` rows are visible at first; views pull more through
+    ``fetchMore`` as the user scrolls (infinite scrolling instead of pages).
+    """
+
+    FDC_ID_COLUMN = 0
+    DESCRIPTION_COLUMN = 1
+    BRAND_COLUMN = 2
+    DATA_TYPE_COLUMN = 3
+    HEADERS = ["FDC ID", "Descripción", "Marca / Origen", "Tipo de dato"]
+    FETCH_BATCH = 50
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self._rows: List[Tuple[str, str, str, str]] = []
+        self._haystacks: List[str] = []
+        self._loaded = 0
+
+    # ---- Qt model API ----
+    def rowCount(self, parent: QModelIndex | QPersistentModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else self._loaded
+
+    def columnCount(self, parent: QModelIndex | QPersistentModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.DisplayRole) -> Any:
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.HEADERS[section] if 0 <= section < len(self.HEADERS) else None
+        return str(section + 1)
+
+    def data(self, index: QModelIndex | QPersistentModelIndex, role: int = Qt.DisplayRole) -> Any:
+        if not index.isValid() or index.row() >= self._loaded:
+            return None
+        value = self._rows[index.row()][index.column()]
+        if role == Qt.DisplayRole:
+            return value
+        if role == Qt.UserRole:
+            # Sort key: numeric for FDC IDs, case-insensitive text otherwise.
+            if index.column() == self.FDC_ID_COLUMN:
+                return int(value) if value.isdigit() else 0
+            return value.casefold()
+        return None
+
+    def canFetchMore(self, parent: QModelIndex | QPersistentModelIndex = QModelIndex()) -> bool:
+        return not parent.isValid() and self._loaded < len(self._rows)
+
+    def fetchMore(self, parent: QModelIndex | QPersistentModelIndex = QModelIndex()) -> None:
+        if parent.isValid():
+            return
+        remaining = len(self._rows) - self._loaded
+        if remaining <= 0:
+            return
+        count = min(self.FETCH_BATCH, remaining)
+        self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + count - 1)
+        self._loaded += count
+        self.endInsertRows()
+
+    # ---- State sync ----
+    def set_results(self, foods: List[Dict[str, Any]]) -> None:
+        """Replace the result set (USDA search dicts, already in display order)."""
+        self.beginResetModel()
+        self._rows = []
+        self._haystacks = []
+        for food in foods:
+            row = (
+                str(food.get("fdcId", "") or ""),
+                food.get("description", "") or "",
+                food.get("brandOwner", "") or "",
+                food.get("dataType", "") or "",
+            )
+            self._rows.append(row)
+            self._haystacks.append(f"{row[1]} {row[2]} {row[0]}".lower())
+        self._loaded = min(self.FETCH_BATCH, len(self._rows))
+        self.endResetModel()
+
+    def fetch_all(self) -> None:
+        """Expose every row (used before sorting so the whole set is ordered)."""
+        remaining = len(self._rows) - self._loaded
+        if remaining <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._loaded, len(self._rows) - 1)
+        self._loaded = len(self._rows)
+        self.endInsertRows()
+
+    def total_count(self) -> int:
+        return len(self._rows)
+
+    def haystack(self, row: int) -> str:
+        """Lower-cased description + brand + FDC ID used for query filtering."""
+        return self._haystacks[row]
+
+
+class SearchResultsProxyModel(QSortFilterProxyModel):
+    """Client-side query filtering and column sorting over ``SearchResultsModel``."""
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self._tokens: List[str] = []
+        self.setSortRole(Qt.UserRole)
+
+    def set_query(self, query: str) -> None:
+        """Keep only rows whose description/brand/FDC ID contain every query token."""
+        tokens = [token for token in query.lower().split() if token]
+        if hasattr(self, "beginFilterChange"):  # Qt >= 6.9
+            self.beginFilterChange()
+            self._tokens = tokens
+            self.endFilterChange()
+        else:
+            self._tokens = tokens
+            self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row: int, source_parent: QModelIndex | QPersistentModelIndex) -> bool:
+        return self._matches(self.sourceModel().haystack(source_row))
+
+    def matching_count(self) -> int:
+        """Rows of the whole result set accepted by the filter, loaded or not."""
+        source = self.sourceModel()
+        if source is None:
+            return 0
+        return sum(1 for row in range(source.total_count()) if self._matches(source.haystack(row)))
+
+    def _matches(self, haystack: str) -> bool:
+        return all(token in haystack for token in self._tokens)
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.DisplayRole) -> Any:
+        if orientation == Qt.Vertical and role == Qt.DisplayRole:
+            # Number rows as displayed, not by their position in the source.
+            return str(section + 1)
+        return super().headerData(section, orientation, role)
+
+    def fetchMore(self, parent: QModelIndex | QPersistentModelIndex) -> None:
+        # A selective query can hide whole source batches; keep pulling until a batch
+        # worth of rows is actually visible so scrolling never stalls on an empty page.
+        source = self.sourceModel()
+        if source is None or parent.isValid():
+            return
+        visible_before = self.rowCount()
+        while (
+            source.canFetchMore(QModelIndex())
+            and self.rowCount() - visible_before < source.FETCH_BATCH
+        ):
+            source.fetchMore(QModelIndex())
+
+    def sort(self, column: int, order: Qt.SortOrder = Qt.AscendingOrder) -> None:
+        source = self.sourceModel()
+        if column >= 0 and source is not None:
+            source.fetch_all()
+        super().sort(column, order)
+
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import logging
+from typing import Callable, Dict, List
+
+from PySide6.QtCore import QObject, QTimer
+
+
+class RefreshScheduler(QObject):
+    """
+    Coalesce view refresh requests.
+
+    Callers mark named views as dirty; pending views are flushed once, in registration
+    order, on the next event-loop turn (or after ``interval_ms``). Views that were not
+    marked are skipped, so e.g. scrubbing the portion size only rebuilds the label.
+    """
+
+    def __init__(self, parent: QObject | None = None, interval_ms: int = 0) -> None:
+        super().__init__(parent)
+        self._views: Dict[str, Callable[[], None]] = {}
+        self._order: List[str] = []
+        self._dirty: set[str] = set()
+        self._flushing = False
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(max(0, int(interval_ms)))
+        self._timer.timeout.connect(self.flush)
+
+    def register(self, name: str, callback: Callable[[], None]) -> None:
+        """Register a view refresher; views flush in the order they were registered."""
+        if name not in self._views:
+            self._order.append(name)
+        self._views[name] = callback
+
+    def mark_dirty(self, *names: str) -> None:
+        """Mark views as needing a refresh and schedule a flush if none is pending."""
+        for name in names:
+            if name not in self._views:
+                raise KeyError(f"Unknown view: {name}")
+            self._dirty.add(name)
+        # Do not restart an active timer: continuous input (e.g. holding a spin box
+        # arrow) still gets one refresh per interval instead of waiting for it to stop.
+        if self._dirty and not self._timer.isActive() and not self._flushing:
+            self._timer.start()
+
+    def is_dirty(self, name: str) -> bool:
+        return name in self._dirty
+
+    def has_pending(self) -> bool:
+        return bool(self._dirty)
+
+    def flush(self) -> None:
+        """Run pending refreshers now (also used before reading widgets for export)."""
+        if self._flushing:
+            return
+        self._timer.stop()
+        pending = self._dirty
+        self._dirty = set()
+        self._flushing = True
+        try:
+            for name in self._order:
+                if name not in pending:
+                    continue
+                try:
+                    self._views[name]()
+                except Exception:  # noqa: BLE001 - one failing view must not block others
+                    logging.exception(f"RefreshScheduler view '{name}' failed")
+        finally:
+            self._flushing = False
+        if self._dirty:
+            # Views marked while flushing go out on the next turn.
+            self._timer.start()
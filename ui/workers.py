@@ -1,10 +1,13 @@
 from __future__ import annotations
 
 import logging
-from typing import Any, Dict, List
+from pathlib import Path
+from typing import Any, Callable, Dict, List
 
 from PySide6.QtCore import QObject, Signal, Slot
 
+from services.formulation_export import atomic_write
+from services.nutrition_label import LabelEvaluationCache
 from services.usda_api import get_food_details
 
 
@@ -61,8 +64,14 @@ class ImportWorker(QObject):
             base_item = dict(item)
             base_item["fdc_id"] = fdc_id_int
 
+            # Rows re-imported from an exported workbook already carry their nutrients.
+            details: Dict[str, Any] | None = base_item.pop("details", None)
+            if details is not None:
+                self.progress.emit(f"{idx}/{total} ID #{fdc_id_int}")
+                hydrated_payload.append({"base": base_item, "details": details})
+                continue
+
             attempts = 0
-            details: Dict[str, Any] | None = None
             while attempts < self.max_attempts:
                 attempts += 1
                 self.progress.emit(f"{idx}/{total} ID #{fdc_id_int}")
@@ -145,3 +154,69 @@ class AddWorker(QObject):
                     f"No se pudo cargar el FDC {self.fdc_id} tras {self.max_attempts} intentos: {exc}"
                 )
                 return
+
+
+class ComputeWorker(QObject):
+    """
+    Evaluate totals and label math for a formulation snapshot in a long-lived thread.
+    Requests carry a generation number; superseded generations are skipped.
+    """
+
+    finished = Signal(int, object)
+    error = Signal(int, str)
+
+    def __init__(self, cache: LabelEvaluationCache | None = None) -> None:
+        super().__init__()
+        # Written by the GUI thread before each request; plain int reads are atomic.
+        self.latest_generation = 0
+        self.cache = cache or LabelEvaluationCache()
+
+    @Slot(int, object, object)
+    def compute(self, generation: int, snapshot, settings) -> None:
+        if generation < self.latest_generation:
+            return
+        try:
+            evaluation = self.cache.evaluate(snapshot.version, settings, snapshot.totals)
+        except Exception as exc:  # noqa: BLE001 - surface to UI
+            logging.exception("ComputeWorker failed")
+            self.error.emit(generation, str(exc))
+            return
+        self.finished.emit(generation, evaluation)
+
+
+class ExportWorker(QObject):
+    """
+    Serialize an export snapshot in a worker thread.
+
+    ``write(tmp_path, report)`` produces the file; it is renamed onto ``path`` only
+    once complete. ``report`` forwards short progress text (e.g. "120/300").
+    """
+
+    progress = Signal(str)
+    finished = Signal(str)
+    error = Signal(str, str)
+
+    def __init__(
+        self,
+        path: str,
+        write: Callable[[Path, Callable[[str], None]], None],
+        description: str,
+    ) -> None:
+        super().__init__()
+        self.path = path
+        self.write = write
+        self.description = description
+
+    def _report(self, message: str) -> None:
+        self.progress.emit(f"{self.description} {message}")
+
+    @Slot()
+    def run(self) -> None:
+        self.progress.emit(self.description)
+        try:
+            atomic_write(self.path, lambda target: self.write(target, self._report))
+        except Exception as exc:  # noqa: BLE001 - surface to UI
+            logging.exception(f"ExportWorker failed path={self.path}")
+            self.error.emit(self.path, str(exc))
+            return
+        self.finished.emit(self.path)